@@ -7,8 +7,6 @@ usage() {
 	echo "	-curl                    (sudo apt-get install curl)"
 	echo "	-miniconda/anaconda      (see intall_dependencies_aws.txt)"
 	echo "	-biopython               (pip install biopython)"
-	echo "	-emboss                  (sudo apt-get install emboss)"
-	echo "	-hhsuite                 (sudo apt-get install hhsuite)"
 	echo "	-RoseTTAFold 2-track     (see intall_dependencies_aws.txt)"
 	echo "	-LocalColabFold          (see intall_dependencies_aws.txt)"
 	echo ""
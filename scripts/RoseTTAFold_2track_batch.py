@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+"""
+Runs RoseTTAFold 2-track over a queue of heterodimer MSAs loading the network
+only once.
+
+Each line of the queue file (written by RoseTTAFold_2track_run.sh -q) has the
+direct and the switched MSA of a pair:
+
+    direct.a3m  direct.npz  L1  switched.a3m  switched.npz  L2  [...]
+
+Extra columns are used by RoseTTAFold_2track_run.sh -Q to post-process each
+pair. The 8th one (MSA depth reported in the plot and metrics) is updated to
+the depth of the MSAs that were predicted (e.g. after cropping). The predictions are computed with the Predictor class
+of predict_msa.py, so the outputs are the same .npz files produced running
+predict_msa.py once per MSA. Pairs whose .npz files already exist are skipped.
+
+Before each prediction the peak memory is estimated from the combined length
+and the MSA depth (see rf2_memory.py) to decide whether it runs on GPU, on GPU
+with the MSA cropped to the depth that fits, or on CPU. The CPU Predictor is
+only loaded when needed. Each prediction is recorded in the runs log with the
+decision and the measured peak memory, and the estimator is calibrated with the
+runs recorded there. If a GPU prediction still fails, only that MSA is retried
+on CPU.
+
+The path to predict_msa.py can be changed with the RF2_PREDICT_MSA environment
+variable (e.g. to a module that defines a Predictor class with the same
+interface). With RF2_PREDICT_MSA=stub, StubPredictor is used instead of the
+network, so the runner can be tested on CPU without RoseTTAFold (see
+utils/check_RF2_batch.py). Other environment variables:
+
+    RF2_RUNS_LOG  runs log (default ./RoseTTAFold_2track_results/RF2_runs.tsv)
+    RF2_GPU_GB    GPU memory in GB (default: detected with torch)
+"""
+
+import sys
+import os
+import time
+import shutil
+import tempfile
+import importlib.util
+import types
+
+from a3m_utils import (read_a3m, write_a3m, open_a3m, is_compressed, plain_a3m,
+                       strip_compression)
+import rf2_memory
+
+# Check input
+if __name__ == "__main__" and len(sys.argv) not in (2, 3):
+    print("ERROR: missing positional arguments", file=sys.stderr)
+    print("USAGE: python RoseTTAFold_2track_batch.py <queue.tsv> [--cpu]", file=sys.stderr)
+    print("")
+    print("   queue.tsv   TSV file with one pair per line:")
+    print("               direct.a3m direct.npz L1 switched.a3m switched.npz L2")
+    print("   --cpu       run all the predictions on CPU")
+    print("OUTPUT:")
+    print("   One line per pair with its status (done, skipped, failed)")
+    print("   Runs log with the device chosen and the peak memory of each prediction")
+    sys.exit(1)
+
+# Default location of RoseTTAFold 2-track
+DEFAULT_PREDICT_MSA = os.path.expanduser("~/RoseTTAFold/network_2track/predict_msa.py")
+
+# Default runs log (decisions and measured peak memory)
+DEFAULT_RUNS_LOG = "./RoseTTAFold_2track_results/RF2_runs.tsv"
+
+
+def load_predict_msa(path=None):
+    """
+    Imports predict_msa.py as a module. Its directory is added to sys.path
+    because it imports the network modules that live next to it.
+
+    Parameters
+    ----------
+    path : str, optional
+        Path to predict_msa.py. By default, RF2_PREDICT_MSA environment
+        variable or ~/RoseTTAFold/network_2track/predict_msa.py.
+
+    Returns
+    -------
+    module
+        The imported module. It must define a Predictor class. With the
+        path "stub", a module with StubPredictor.
+
+    """
+    if path is None:
+        path = os.environ.get("RF2_PREDICT_MSA", DEFAULT_PREDICT_MSA)
+    if path == "stub":
+        return types.SimpleNamespace(Predictor=StubPredictor)
+    if not os.path.isfile(path):
+        print(f"ERROR: {path} not found", file=sys.stderr)
+        sys.exit(1)
+
+    path = os.path.abspath(path)
+    sys.path.insert(0, os.path.dirname(path))
+    spec = importlib.util.spec_from_file_location("predict_msa", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def read_queue(queue_file):
+    """
+    Reads the queue file.
+
+    Returns
+    -------
+    pairs : list of list of tuple
+        One element per pair with its two (a3m, npz, L1) predictions.
+
+    """
+    pairs = []
+    with open(queue_file) as queue:
+        for line in queue:
+            if line.startswith("#") or not line.strip():
+                continue
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 6:
+                print(f"ERROR: wrong number of columns in {queue_file}: {line}", file=sys.stderr)
+                sys.exit(1)
+            pairs.append([(fields[0], fields[1], int(fields[2])),
+                          (fields[3], fields[4], int(fields[5]))])
+    return pairs
+
+
+def gpu_memory_GB():
+    """
+    Total memory of the GPU in GB (0 if there is no GPU). It can be set with
+    the RF2_GPU_GB environment variable.
+    """
+    if "RF2_GPU_GB" in os.environ:
+        return float(os.environ["RF2_GPU_GB"])
+    torch = sys.modules.get("torch")
+    if torch is None or not torch.cuda.is_available():
+        return 0.0
+    return torch.cuda.get_device_properties(torch.cuda.current_device()).total_memory / 1e9
+
+
+def count_sequences(a3m_file):
+    with open_a3m(a3m_file, "rb") as a3m:
+        return sum(1 for line in a3m if line.startswith(b">"))
+
+
+def crop_a3m(a3m_file, depth):
+    """
+    Writes the first depth sequences of a3m_file to a new file next to it
+    and returns its path. The name is unique, so runs of the same MSA can
+    overlap.
+    """
+    cardinality, records = read_a3m(a3m_file)
+    name = os.path.splitext(os.path.basename(strip_compression(a3m_file)))[0]
+    fd, cropped_file = tempfile.mkstemp(prefix=f".{name}_", suffix="_cropped.a3m",
+                                        dir=os.path.dirname(a3m_file) or ".")
+    os.close(fd)
+    write_a3m(cropped_file, records[:depth], cardinality)
+    return cropped_file
+
+
+class StubPredictor:
+    """
+    Stand-in for the Predictor of predict_msa.py that loads no network: it
+    writes an empty contact map (dist, L x L) for the query of each MSA.
+    """
+
+    def __init__(self, use_cpu=False):
+        self.use_cpu = use_cpu
+
+    def predict(self, a3m_file, npz_file, L1):
+        import numpy as np
+        _, records = read_a3m(a3m_file)
+        L = sum(1 for residue in records[0][1] if not residue.islower())
+        np.savez_compressed(npz_file, dist=np.zeros((L, L), dtype=np.float32))
+
+
+class BatchPredictor:
+    """
+    Keeps the Predictor instances alive between predictions. Each Predictor
+    (GPU and CPU) is only created the first time it is needed.
+    """
+
+    def __init__(self, predict_msa):
+        self.predict_msa = predict_msa
+        self._gpu = None
+        self._cpu = None
+
+    def _predictor(self, cpu):
+        if cpu:
+            if self._cpu is None:
+                self._cpu = self.predict_msa.Predictor(use_cpu=True)
+            return self._cpu
+        if self._gpu is None:
+            self._gpu = self.predict_msa.Predictor(use_cpu=False)
+        return self._gpu
+
+    def predict(self, a3m_file, npz_file, L1, cpu=False):
+        """
+        Predicts a single MSA.
+
+        Returns
+        -------
+        peak_GB : float
+            Peak GPU memory reserved during the prediction (0 on CPU or if
+            it cannot be measured).
+
+        """
+        torch = sys.modules.get("torch")
+        measure = not cpu and torch is not None and torch.cuda.is_available()
+        if measure:
+            torch.cuda.reset_peak_memory_stats()
+
+        self._predictor(cpu).predict(a3m_file, npz_file, L1)
+
+        return torch.cuda.max_memory_reserved() / 1e9 if measure else 0.0
+
+    def release_gpu_memory(self):
+        torch = sys.modules.get("torch")
+        if torch is not None and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
+def run_msa(batch, a3m_file, npz_file, L1, combined_L, gpu_GB, coefficients, runs_log):
+    """
+    Plans and runs the prediction of a single MSA, recording it in the
+    runs log. If it fails on GPU, it is retried on CPU. A compressed MSA is
+    predicted from a temporary plain copy. Returns the run recorded last
+    (with its device and used_depth).
+    """
+    depth = count_sequences(a3m_file)
+    device, used_depth, estimated_GB = rf2_memory.plan_run(combined_L, depth, gpu_GB, coefficients)
+    run = {"name": os.path.basename(npz_file), "combined_L": combined_L, "depth": depth,
+           "device": device, "used_depth": used_depth, "estimated_GB": f"{estimated_GB:.2f}",
+           "peak_GB": "0.00", "seconds": "0.0", "status": "done"}
+
+    plain_dir = tempfile.mkdtemp(prefix=".plain_", dir=os.path.dirname(a3m_file) or ".") \
+        if is_compressed(a3m_file) else None
+    plain_file = plain_a3m(a3m_file, plain_dir) if plain_dir else a3m_file
+    input_file = crop_a3m(a3m_file, used_depth) if device == "crop" else plain_file
+    start = time.time()
+    try:
+        peak_GB = batch.predict(input_file, npz_file, L1, cpu=(device == "cpu"))
+        run.update(peak_GB=f"{peak_GB:.2f}", seconds=f"{time.time() - start:.1f}")
+        rf2_memory.append_run(runs_log, run)
+    except Exception as error:
+        if device == "cpu":
+            raise
+        # Record the failed GPU attempt and retry only this MSA on CPU
+        run.update(seconds=f"{time.time() - start:.1f}", status="failed")
+        rf2_memory.append_run(runs_log, run)
+        print(f"WARNING: GPU prediction of {a3m_file} failed ({error}), trying with CPU...",
+              file=sys.stderr)
+        batch.release_gpu_memory()
+
+        start = time.time()
+        batch.predict(plain_file, npz_file, L1, cpu=True)
+        run.update(device="cpu", used_depth=depth, seconds=f"{time.time() - start:.1f}",
+                   status="done")
+        rf2_memory.append_run(runs_log, run)
+    finally:
+        if input_file != plain_file:
+            os.remove(input_file)
+        if plain_dir:
+            shutil.rmtree(plain_dir, ignore_errors=True)
+
+    return run
+
+
+def update_depths(queue_file, depths):
+    """
+    Writes the predicted MSA depth of each pair ({direct npz: depth}) in the
+    8th column of the queue file.
+    """
+    with open(queue_file) as queue:
+        lines = queue.readlines()
+    with open(queue_file + ".tmp", "w") as queue:
+        for line in lines:
+            fields = line.rstrip("\n").split("\t")
+            if not line.startswith("#") and len(fields) >= 8 and fields[1] in depths:
+                fields[7] = str(depths[fields[1]])
+                line = "\t".join(fields) + "\n"
+            queue.write(line)
+    os.replace(queue_file + ".tmp", queue_file)
+
+
+def run_queue(queue_file, use_cpu=False, predict_msa=None, runs_log=None):
+    """
+    Runs all the pairs of the queue.
+
+    Returns
+    -------
+    failed : int
+        Number of pairs with at least one failed prediction.
+
+    """
+    pairs = read_queue(queue_file)
+    if predict_msa is None:
+        predict_msa = load_predict_msa()
+    if runs_log is None:
+        runs_log = os.environ.get("RF2_RUNS_LOG", DEFAULT_RUNS_LOG)
+    if os.path.dirname(runs_log):
+        os.makedirs(os.path.dirname(runs_log), exist_ok=True)
+
+    batch = BatchPredictor(predict_msa)
+    gpu_GB = 0.0 if use_cpu else gpu_memory_GB()
+    coefficients = rf2_memory.calibrated_coefficients(runs_log)
+
+    failed = 0
+    depths = {}
+    for pair in pairs:
+        name = os.path.basename(pair[0][1])
+        if all(os.path.isfile(npz_file) for _, npz_file, _ in pair):
+            print(f"skipped\t{name}\t-\t0.0")
+            continue
+
+        combined_L = sum(L1 for _, _, L1 in pair)
+        start = time.time()
+        devices = []
+        try:
+            used_depths = []
+            for a3m_file, npz_file, L1 in pair:
+                run = run_msa(batch, a3m_file, npz_file, L1, combined_L, gpu_GB, coefficients, runs_log)
+                devices.append(run["device"])
+                used_depths.append(run["used_depth"])
+            depths[pair[0][1]] = min(used_depths)
+            status = "done"
+        except Exception as error:
+            print(f"ERROR: {name} failed: {error}", file=sys.stderr)
+            status = "failed"
+            failed += 1
+        print(f"{status}\t{name}\t{','.join(devices) or '-'}\t{time.time() - start:.1f}", flush=True)
+
+    if depths:
+        update_depths(queue_file, depths)
+    return failed
+
+
+if __name__ == "__main__":
+    queue_file = sys.argv[1]
+    use_cpu = len(sys.argv) == 3 and sys.argv[2] == "--cpu"
+
+    if not os.path.isfile(queue_file):
+        print(f"ERROR: {queue_file} is not a file", file=sys.stderr)
+        sys.exit(1)
+
+    failed = run_queue(queue_file, use_cpu)
+    sys.exit(1 if failed else 0)
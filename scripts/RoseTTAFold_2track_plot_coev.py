@@ -1,14 +1,16 @@
 # -*- coding: utf-8 -*-
 import sys
 import os
-import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
+
+# Only the metrics and contacts (no plots, matplotlib is not imported)
+metrics_only = "--metrics-only" in sys.argv[1:]
+if metrics_only:
+    sys.argv.remove("--metrics-only")
 
 # Check if command-line arguments have been provided
 if len(sys.argv) != 5:
     print("ERROR: missing positional arguments", file=sys.stderr)
-    print("USAGE: python RoseTTAFold_2track_plot_coev.py <npz_file_d> <npz_file_r> <top> <a3m_seqs_N>", file=sys.stderr)
+    print("USAGE: python RoseTTAFold_2track_plot_coev.py [--metrics-only] <npz_file_d> <npz_file_r> <top> <a3m_seqs_N>", file=sys.stderr)
     print("")
     print("   npz_file_d  .npz file with coevolutionary info produced with")
     print("               RoseTTAFold_2track_run.sh. It is expected to have")
@@ -18,6 +20,7 @@ if len(sys.argv) != 5:
     print("               the format <proteinID2__vs__proteinID1.npz>")
     print("   top         Number of contacts to display (integer)")
     print("   a3m_seqs_N  Number of sequences in the original MSA")    
+    print("   --metrics-only  Do not plot the heatmaps (only outputs 2-4)")
     print("")
     print("OUTPUT:")
     print("")
@@ -38,6 +41,8 @@ if len(sys.argv) != 5:
     print("        tsv file with the computed metrics to predict PPIs")
     sys.exit(1)
 
+import numpy as np
+
 # Assign the command-line arguments to variables
 npz_file_d = sys.argv[1]    # direct
 npz_file_r = sys.argv[2]    # reversed
@@ -50,6 +55,10 @@ npz_file_basename = os.path.basename(npz_file_d)
 npz_file_name = os.path.splitext(npz_file_basename)[0]
 ID_1, ID_2 = npz_file_name.split("__vs__")
 
+# Opt-in profiling (DISCOBA_PROFILE, see profiling.py)
+from profiling import profile_if_enabled
+profile_if_enabled(npz_file_name, ".")
+
 # Debugging (ctrl +1)
 # print("Dirname:", npz_file_dirname)
 # print("Basename:", npz_file_basename)
@@ -63,6 +72,8 @@ def plot_coevolution(distance_matrix,
                      a3m_seqs_N,
                      protein1="protein 1", protein2="protein 2",
                      title="RF2-track contacts"):
+    # Imported only when plotting
+    import matplotlib.pyplot as plt
 
     # Plot the array as a heatmap
     plt.imshow(distance_matrix, cmap='hot', interpolation='nearest',
@@ -122,7 +133,7 @@ def obtain_metrics(distance_matrix,
 
     Returns
     -------
-    metrics_df : pandas df
+    metrics : dict
         contains several metrics for PPI prediction
 
     """
@@ -187,9 +198,6 @@ def obtain_metrics(distance_matrix,
         "paired_seqs_number" : a3m_seqs_N
         }
     
-    # Create a pandas dataframe from the dictionary and save as tsv
-    metrics_df = pd.DataFrame(metrics, index=[0])
-    
     # Find the indices that would sort the "dist" array in descending order
     sorted_indices = np.argsort(distance_matrix, axis=None)[::-1]
     
@@ -228,7 +236,21 @@ def obtain_metrics(distance_matrix,
     file_1.close()
     file_2.close()
     
-    return metrics_df
+    return metrics
+
+
+def write_metrics(metrics_rows, metrics_file):
+    """
+    Saves the metrics of each method as a tsv (one row per method). The
+    values of each column are written with a common type, as a table of
+    the rows would: ints if all of them are ints and floats otherwise.
+    """
+    columns = list(metrics_rows[0].keys())
+    values = {column: np.array([metrics[column] for metrics in metrics_rows]) for column in columns}
+    with open(metrics_file, "w") as metrics_tsv:
+        metrics_tsv.write("\t".join(columns) + "\n")
+        for row in range(len(metrics_rows)):
+            metrics_tsv.write("\t".join(str(values[column][row]) for column in columns) + "\n")
 
 
 ###############################################################################
@@ -263,24 +285,18 @@ dist_mean = (dist_d + dist_rt) / 2
 ###############################################################################
 
 # Obtain the metrics of each normalization method
-mertics_df_d = obtain_metrics(dist_d, top, npz_file_name, ID_1, ID_2, "direct", a3m_seqs_N)
-mertics_df_rt = obtain_metrics(dist_rt, top, npz_file_name, ID_1, ID_2, "reversed", a3m_seqs_N)
-mertics_df_min = obtain_metrics(dist_min, top, npz_file_name, ID_1, ID_2, "min", a3m_seqs_N)
-mertics_df_max = obtain_metrics(dist_max, top, npz_file_name, ID_1, ID_2, "max", a3m_seqs_N)
-mertics_df_mean = obtain_metrics(dist_mean, top, npz_file_name, ID_1, ID_2, "mean", a3m_seqs_N)
-
-# Merge the metrics dataframes
-full_metrics_df = pd.concat([mertics_df_d,
-                             mertics_df_rt,
-                             mertics_df_min,
-                             mertics_df_max,
-                             mertics_df_mean],
-                            # Merge rows axis
-                            axis=0)
-
-# Save DF as tsv
+mertics_d = obtain_metrics(dist_d, top, npz_file_name, ID_1, ID_2, "direct", a3m_seqs_N)
+mertics_rt = obtain_metrics(dist_rt, top, npz_file_name, ID_1, ID_2, "reversed", a3m_seqs_N)
+mertics_min = obtain_metrics(dist_min, top, npz_file_name, ID_1, ID_2, "min", a3m_seqs_N)
+mertics_max = obtain_metrics(dist_max, top, npz_file_name, ID_1, ID_2, "max", a3m_seqs_N)
+mertics_mean = obtain_metrics(dist_mean, top, npz_file_name, ID_1, ID_2, "mean", a3m_seqs_N)
+
+# Save the metrics of all the methods as tsv
 metrics_file = npz_file_name + ".metrics"
-full_metrics_df.to_csv(metrics_file , sep='\t', index=False)
+write_metrics([mertics_d, mertics_rt, mertics_min, mertics_max, mertics_mean], metrics_file)
+
+if metrics_only:
+    sys.exit(0)
 
 ###############################################################################
 ######################## Plot coevolution heatmap #############################
@@ -11,10 +11,31 @@ script_remove_p=$DiscobaMultimerPath/scripts/remove_paired.sh
 script_remove_u=$DiscobaMultimerPath/scripts/remove_unpaired.sh
 # Path to plot_coev_RoseTTAFold_2track_run.py
 script_plot=$DiscobaMultimerPath/scripts/RoseTTAFold_2track_plot_coev.py
+# Path to sort_a3m_by_similarity.py
+script_sort=$DiscobaMultimerPath/scripts/sort_a3m_by_similarity.py
+# Path to filter_a3m_diversity.py
+script_filter=$DiscobaMultimerPath/scripts/filter_a3m_diversity.py
+# Path to RoseTTAFold_2track_batch.py
+script_batch=$DiscobaMultimerPath/scripts/RoseTTAFold_2track_batch.py
+# Path to job_db.py
+script_jobs=$DiscobaMultimerPath/scripts/job_db.py
+# Path to discoba_worker.py
+WORKER_SCRIPT=$DiscobaMultimerPath/scripts/discoba_worker.py
 # --------------------------------------------------------------------
 
+# Runs a Python helper in the worker of the batch if one is running, with its
+# modules already imported (see discoba_worker.py). Otherwise runs it directly.
+run_helper() {
+	if [ -S "${DISCOBA_WORKER_SOCKET:-}" ]; then
+		python -S $WORKER_SCRIPT run "$@"
+	else
+		python "$@"
+	fi
+}
+
 usage() {
-  echo "Usage: $0 [-p|-u] [-t <int>] -f <path/to/file.a3m>" 1>&2
+  echo "Usage: $0 [-p|-u] [-t <int>] [-b <GB>] [-q <queue.tsv>] -f <path/to/file.a3m>" 1>&2
+  echo "       $0 -Q <queue.tsv>" 1>&2
   echo "Mandatory argument:"
   echo "-f path : path to the a3m file produced with MMseqs2 (ColabFold)"
   echo "	 the name must be formatted like this: ID1__vs__ID2.a3m"
@@ -22,8 +43,12 @@ usage() {
   echo "-p      : remove the paired part of the a3m file (NOT RECOMENDED)"
   echo "-u      : remove the unpaired part of the a3m file (RECOMENDED)"
   echo "-t int  : top contacts to calculate (default 30)"
+  echo "-b GB   : memory available for RF2-track, used to choose the MSA depth (default 12)"
   echo "-o	: order by sequence similarity the MSA befor calculations"
   echo "-s      : plot number of sequences in the output heatmap"
+  echo "-q file : only preprocess the MSAs and add them to the queue file (no prediction)"
+  echo "-Q file : predict all the pairs of the queue file loading RoseTTAFold 2-track once,"
+  echo "          then produce their plots and contact files (-f is not needed)"
   echo "NOTE: if no -p/-u option is passed, the complete a3m file will be used,"
   echo "      i.e. paired+unpaired (NOT RECOMENDED, but better than -p)"
   echo "Output files: (OUTDATED)"
@@ -38,9 +63,11 @@ usage() {
 
 # top_contacts by default
 top_contacts=30
+# memory budget (GB) used to choose the MSA depth by default
+memory_budget=12
 
 # Check arguments and options --------------------------------------------------
-while getopts "put:sf:o" opt; do
+while getopts "put:sf:ob:q:Q:" opt; do
   case ${opt} in
       	p) p_flag=1;;
 	u) u_flag=1;;
@@ -48,13 +75,16 @@ while getopts "put:sf:o" opt; do
 	f) f_flag=1 ; input_a3m=$OPTARG;;
 	s) s_flag=1;;
 	o) o_flag=1;;
+	b) memory_budget=$OPTARG;;
+	q) q_flag=1 ; queue_file=$OPTARG;;
+	Q) Q_flag=1 ; queue_file=$OPTARG;;
 	\?) usage;;
 	*) usage;;
   esac
 done
 
 # Check if option -f was passed
-if [[ $f_flag -ne 1 ]]; then
+if [[ $f_flag -ne 1 && $Q_flag -ne 1 ]]; then
 	echo "Error: No -f option was passed" ; usage
 fi
 
@@ -63,9 +93,26 @@ if [[ $u_flag -eq 1 && $p_flag -eq 1 ]]; then
   echo "Error: -u and -p cannot be passed together" ; usage
 fi
 
+# Compressed MSAs (<name>.a3m.zst or <name>.a3m.gz, see a3m_utils.py) are
+# preprocessed from a plain copy next to them, removed when the script exits
+if [[ $f_flag -eq 1 ]] && [[ "$input_a3m" == *.zst || "$input_a3m" == *.gz ]]; then
+	plain_a3m=${input_a3m%.*}
+	if [ ! -f "$plain_a3m" ]; then
+		case "$input_a3m" in
+			*.zst) zstd -dcq $input_a3m > $plain_a3m.tmp ;;
+			*.gz) gzip -dc $input_a3m > $plain_a3m.tmp ;;
+		esac
+		mv $plain_a3m.tmp $plain_a3m
+		trap "rm -f $plain_a3m" EXIT
+	fi
+	input_a3m=$plain_a3m
+fi
+
 # Test if a3m file starts with cardinality 
 card_regex="^#[0-9]\{1,5\},[0-9]\{1,5\}[[:space:]][0-9]\{1,2\},[0-9]\{1,2\}$"
-if head -1 $input_a3m | grep -q $card_regex; then
+if [[ $Q_flag -eq 1 ]]; then
+	: # No a3m file to test in queue mode
+elif head -1 $input_a3m | grep -q $card_regex; then
 	echo "a3m test PASSED: a3m file contains cardinality"
 else
 	echo "a3m test NOT PASSED: a3m file does not contain cardinality (e.g. #123,523	1,1)"
@@ -146,70 +193,6 @@ switch_a3m() {
 	done < "$no_card_a3m"
 }
 
-# Sorts the sequences in the a3m file by decreasing similarity to the queries
-sort_a3m(){
-
-	unsorted_a3m=$1
-	sorted_a3m=$2
-	basename_unsorted_a3m=$(basename $unsorted_a3m .a3m)
-
-	head -n 2 $unsorted_a3m > ${basename_unsorted_a3m}temp_first
-	rest_seqs_fasta=$(tail -n +3 $unsorted_a3m)
-
-	HEADERS=()
-	SEQUENCES=()
-	SCORES=()
-
-	while read -r line1 && read -r line2; do
-
-		# Header and sequence
-		header=$line1
-		sequence=$line2
-		echo ">subject" > ${basename_unsorted_a3m}temp_second
-		echo "$sequence" >> ${basename_unsorted_a3m}temp_second
-		
-		# Calculate global alignment
-		needle -asequence ${basename_unsorted_a3m}temp_first -bsequence ${basename_unsorted_a3m}temp_second -gapopen 10.0 -gapextend 0.5 -outfile ${basename_unsorted_a3m}temp_global &> /dev/null
-
-		# Extract score
-		score=$(grep "Score:" ${basename_unsorted_a3m}temp_global)
-		score=${score##*" "}
-
-		HEADERS+=($header)
-		SEQUENCES+=($sequence)
-		SCORES+=($score)
-
-	done <<< "$rest_seqs_fasta"
-
-	# Combine the arrays into a single file
-	paste <(printf '%s\n' "${HEADERS[@]}") \
-	      <(printf '%s\n' "${SEQUENCES[@]}") \
-	      <(printf '%s\n' "${SCORES[@]}") \
-	      > ${basename_unsorted_a3m}temp.txt
-
-	# Sort the file based on the third column (the scores)
-	sort -rn -k3 ${basename_unsorted_a3m}temp.txt > ${basename_unsorted_a3m}sorted.txt
-
-	# Extract the sorted arrays
-	HEADERS_sorted=($(cut -f1 ${basename_unsorted_a3m}sorted.txt))
-	SEQUENCES_sorted=($(cut -f2 ${basename_unsorted_a3m}sorted.txt))
-	SCORES_sorted=($(cut -f3 ${basename_unsorted_a3m}sorted.txt))
-
-	# Remove the temporary files
-	rm ${basename_unsorted_a3m}temp.txt ${basename_unsorted_a3m}sorted.txt ${basename_unsorted_a3m}temp_first ${basename_unsorted_a3m}temp_second ${basename_unsorted_a3m}temp_global
-
-	# Write sorted a3m
-	head -n 2 $unsorted_a3m > $sorted_a3m
-	for i in "${!SCORES_sorted[@]}"; do
-		if [ "${HEADERS_sorted[$i]}" == "^>"* ]; then
-			echo "${HEADERS_sorted[$i]}" >> $sorted_a3m
-		else
-			echo ">${HEADERS_sorted[$i]}" >> $sorted_a3m
-		fi
-		echo "${SEQUENCES_sorted[$i]}" >> $sorted_a3m
-	done
-}
-
 # Checks if any sequence has troubles and removes it
 format_a3m() {
 	
@@ -261,8 +244,87 @@ add_time() {
 }
 
 
+# Needed to run RoseTTAFold 2-track
+activate_RoseTTAFold_env() {
+	. ~/anaconda3/etc/profile.d/conda.sh || . ~/miniconda3/etc/profile.d/conda.sh	# source the conda.sh script (necessary)
+	conda init bash > /dev/null
+	conda activate RoseTTAFold
+}
+
+# Plots the contact map of a pair and moves its outputs to the output directory
+postprocess_pair() {
+
+	# function input
+	pair_npz=$1		# direct npz
+	pair_npz_switched=$2	# switched npz
+	pair_top_contacts=$3
+	pair_remaining_seqs=$4
+	pair_name=$(basename $pair_npz .npz)
+
+	# Plot contact map and 
+	run_helper $script_plot $pair_npz $pair_npz_switched $pair_top_contacts $pair_remaining_seqs
+
+	# Move everything to a temporary directory and rename it to the output
+	# directory when it is complete
+	output_dir=./RoseTTAFold_2track_results/${pair_name}
+	tmp_output_dir=./RoseTTAFold_2track_results/.${pair_name}.tmp
+	rm -rf $tmp_output_dir
+	mkdir -p $tmp_output_dir
+	mv $pair_npz $tmp_output_dir
+	mv $pair_npz_switched $tmp_output_dir
+	mv ./*${pair_name}-coevolution.png $tmp_output_dir
+	mv ./*${pair_name}.metrics $tmp_output_dir
+	mv ./*${pair_name}.contacts $tmp_output_dir
+	mv ./*${pair_name}.chimeraX $tmp_output_dir
+	mv -T $tmp_output_dir $output_dir
+}
+
+# Predicts all the pairs of a queue file loading RoseTTAFold 2-track once.
+# The device of each prediction (GPU, GPU with cropped MSA or CPU) is planned
+# before launching it from the estimated peak memory (see rf2_memory.py)
+predict_queue() {
+
+	# function input
+	queue_file=$1
+
+	add_time "Obtaining co-evolutionary information for $(grep -vc '^#' $queue_file) pairs in $queue_file..."
+	activate_RoseTTAFold_env
+	RF2_PREDICT_MSA=${RF2_PREDICT_MSA:-$rosetta_2track} python $script_batch $queue_file || add_time "WARNING: some RoseTTAFold 2-track predictions failed"
+	conda deactivate
+
+	# Queue columns: direct.a3m direct.npz L1 switched.a3m switched.npz L2 top_contacts remaining_seqs
+	while IFS=$'\t' read -r q_a3m q_npz q_L1 q_switched_a3m q_npz_switched q_L2 q_top_contacts q_remaining_seqs; do
+		[[ "$q_a3m" == "#"* ]] && continue
+		rm -f $q_a3m $q_switched_a3m
+
+		if [ -f "$q_npz" ] && [ -f "$q_npz_switched" ]; then
+			add_time "Output files: $q_npz"
+			add_time "Output files: $q_npz_switched"
+			postprocess_pair $q_npz $q_npz_switched $q_top_contacts $q_remaining_seqs
+			python $script_jobs finish rf2 $(basename $q_npz .npz) 0
+		else
+			add_time "RoseTTAFold 2-track failed for $(basename $q_npz .npz). Potential cause: no enough VRAM"
+			python $script_jobs finish rf2 $(basename $q_npz .npz) 1
+		fi
+	done < "$queue_file"
+
+	rm $queue_file
+}
+
 #-------------------------------------------------------------------------------
 
+#############################################################################
+############### Queue mode: predict all the queued pairs at once ############
+#############################################################################
+
+if [[ $Q_flag -eq 1 ]]; then
+	if [ ! -f "$queue_file" ]; then
+		echo "Error: queue file $queue_file does not exist" ; usage
+	fi
+	predict_queue $queue_file
+	exit 0
+fi
+
 # Usefull variables with names
 input_a3m_dirname=`dirname $input_a3m`
 input_a3m_basename=`basename $input_a3m`
@@ -335,40 +397,16 @@ elif [[ $u_flag -eq 1 ]]; then
 	remaining_seqs=`grep -c "^>" $temp_a3m`
 	echo "Remainig sequences: $remaining_seqs"
 	
-	# Sometimes the MSA is too big and needs to be reduced using hhblits diversity filter
-	if [ "$remaining_seqs" -gt "50000" ]; then
-		add_time "Remaining sequences are bigger than 50000"
-		add_time "Applying hhfilter to reduce the MSA length"
-		echo "hhfilter options: "
-		hhfilter -i $temp_a3m -o ${input_a3m_name}temp_filtered.a3m -v 2 -diff 1000 -qid 0.0,0.2,0.4,0.6,0.8,1.0 -qsc 0 -id 95
-		mv ${input_a3m_name}temp_filtered.a3m $temp_a3m
-		remaining_seqs=`grep -c "^>" $temp_a3m`
-		add_time "Remaining filtered sequences: $remaining_seqs"
-
-	elif [ "$remaining_seqs" -gt "30000" ]; then
-		add_time "Remaining sequences are bigger than 30000"
-		add_time "Applying hhfilter to reduce the MSA length"
-		echo "hhfilter options: "
-		hhfilter -i $temp_a3m -o ${input_a3m_name}temp_filtered.a3m -v 2 -diff 1500 -qid 0.0,0.2,0.4,0.6,0.8,1.0 -qsc 0 -id 95
-		mv ${input_a3m_name}temp_filtered.a3m $temp_a3m
-		remaining_seqs=`grep -c "^>" $temp_a3m`
-		add_time "Remaining filtered sequences: $remaining_seqs"
-
-	elif [ "$remaining_seqs" -gt "10000" ]; then
-		add_time "Remaining sequences are bigger than 10000"
-		add_time "Applying hhfilter to reduce the MSA length"
-		echo "hhfilter options: "
-		hhfilter -i $temp_a3m -o ${input_a3m_name}temp_filtered.a3m -v 2 -diff 2000 -qid 0.0,0.2,0.4,0.6,0.8,1.0 -qsc 0 -id 95
-		mv ${input_a3m_name}temp_filtered.a3m $temp_a3m
-		remaining_seqs=`grep -c "^>" $temp_a3m`
-		add_time "Remaining filtered sequences: $remaining_seqs"
-	fi
+	# Reduce the MSA to the depth that fits the memory budget (diversity filter)
+	add_time "Applying diversity filter to fit the MSA in ${memory_budget} GB..."
+	python $script_filter $temp_a3m $temp_a3m $combined_seq_length $memory_budget
+	remaining_seqs=`grep -c "^>" $temp_a3m`
+	add_time "Remaining filtered sequences: $remaining_seqs"
 	
 	# Sort by similarity to query (TO DO) before RF2-track calculations	
 	if [[ $o_flag -eq 1 ]]; then
 		add_time "Reordering sequences by similarity to the query..."
-		sort_a3m $temp_a3m ${input_a3m_name}temp_sorted_direct
-		mv ${input_a3m_name}temp_sorted_direct $temp_a3m
+		python $script_sort $temp_a3m $temp_a3m
 		add_time "Reordering paired MSA complete"
 	fi	
 
@@ -390,42 +428,17 @@ else
 
 	remaining_seqs=`grep -c "^>" $temp_a3m`
 
-	# Sometimes the MSA is too big and needs to be reduced using hhblits diversity filter
-	if [ "$remaining_seqs" -gt "50000" ]; then
-		add_time "Remaining sequences are bigger than 50000"
-		add_time "Applying hhfilter to reduce the MSA length"
-		echo "hhfilter options: "
-		hhfilter -i $temp_a3m -o ${input_a3m_name}temp_filtered.a3m -v 2 -diff 500 -qid 0.0,0.2,0.4,0.6,0.8,1.0 -qsc 0 -id 95
-		mv ${input_a3m_name}temp_filtered.a3m $temp_a3m
-		remaining_seqs=`grep -c "^>" $temp_a3m`
-		add_time "Remaining filtered sequences: $remaining_seqs"
-
-	elif [ "$remaining_seqs" -gt "30000" ]; then
-		add_time "Remaining sequences are bigger than 30000"
-		add_time "Applying hhfilter to reduce the MSA length"
-		echo "hhfilter options: "
-		hhfilter -i $temp_a3m -o ${input_a3m_name}temp_filtered.a3m -v 2 -diff 700 -qid 0.0,0.2,0.4,0.6,0.8,1.0 -qsc 0 -id 95
-		mv ${input_a3m_name}temp_filtered.a3m $temp_a3m
-		remaining_seqs=`grep -c "^>" $temp_a3m`
-		add_time "Remaining filtered sequences: $remaining_seqs"
-
-	elif [ "$remaining_seqs" -gt "10000" ]; then
-		add_time "Remaining sequences are bigger than 10000"
-		add_time "Applying hhfilter to reduce the MSA length"
-		echo "hhfilter options: "
-		hhfilter -i $temp_a3m -o ${input_a3m_name}temp_filtered.a3m -v 2 -diff 900 -qid 0.0,0.2,0.4,0.6,0.8,1.0 -qsc 0 -id 95
-		mv ${input_a3m_name}temp_filtered.a3m $temp_a3m
-		remaining_seqs=`grep -c "^>" $temp_a3m`
-		add_time "Remaining filtered sequences: $remaining_seqs"
-
-	fi
+	# Reduce the MSA to the depth that fits the memory budget (diversity filter)
+	add_time "Applying diversity filter to fit the MSA in ${memory_budget} GB..."
+	python $script_filter $temp_a3m $temp_a3m $combined_seq_length $memory_budget
+	remaining_seqs=`grep -c "^>" $temp_a3m`
+	add_time "Remaining filtered sequences: $remaining_seqs"
 		
 	
 	# Sort by similarity to query (TO DO) before RF2-track calculations	
 	if [[ $o_flag -eq 1 ]]; then
 		add_time "Reordering sequences by similarity to the query..."
-		sort_a3m $temp_a3m ${input_a3m_name}temp_sorted_direct
-		mv ${input_a3m_name}temp_sorted_direct $temp_a3m
+		python $script_sort $temp_a3m $temp_a3m
 		add_time "Reordering paired MSA complete"
 	fi	
 
@@ -446,59 +459,21 @@ add_time "Formating a3m before process..."
 format_a3m $temp_a3m $combined_seq_length
 format_a3m $switched_a3m $combined_seq_length
 
-add_time "Obtaining co-evolutionary information with GPU..."
-
-# Needed to run RoseTTAFold 2-track
-. ~/anaconda3/etc/profile.d/conda.sh || . ~/miniconda3/etc/profile.d/conda.sh	# source the conda.sh script (necessary)
-conda init bash > /dev/null
-conda activate RoseTTAFold
-
-run_failed=false
+# Depth of the MSA given to RoseTTAFold 2-track (RoseTTAFold_2track_batch.py
+# updates it in the queue if the MSA is cropped)
+remaining_seqs=`grep -c "^>" $temp_a3m`
 
-# Run the 2-track prediction
-
-# Try with GPU
-python $rosetta_2track -msa $temp_a3m -npz $output_npz -L1 $first_seq_length || run_failed=true
-python $rosetta_2track -msa $switched_a3m -npz $output_npz_switched -L1 $second_seq_length || run_failed=true
-
-if [ "$run_failed" == "true" ]; then
-	# Use CPU
-	add_time "GPU failed, trying with CPU..."
-	python $rosetta_2track -msa $temp_a3m -npz $output_npz -L1 $first_seq_length --cpu
-	python $rosetta_2track -msa $switched_a3m -npz $output_npz_switched -L1 $second_seq_length --cpu
+# Queue the pair to be predicted later with -Q (RoseTTAFold 2-track loaded once)
+# or predict it now as a queue of one pair
+if [[ $q_flag -ne 1 ]]; then
+	queue_file=./${input_a3m_name}_queue.tsv
+	rm -f $queue_file
 fi
+printf '%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\n' $temp_a3m $output_npz $first_seq_length \
+	$switched_a3m $output_npz_switched $second_seq_length $top_contacts $remaining_seqs >> $queue_file
 
-# Check if RoseTTAFold 2-track succeded
-if [ "$?" != "0" ]; then
-	add_time "RoseTTAFold 2-track failed. Potential cause: no enough VRAM"
+if [[ $q_flag -eq 1 ]]; then
+	add_time "Pair added to queue: $queue_file"
 else
-	add_time "Output files: $output_npz"
-	add_time "Output files: $output_npz_switched"
+	predict_queue $queue_file
 fi
-
-conda deactivate
-
-rm $temp_a3m
-rm $switched_a3m
-
-
-#############################################################################
-##################### Produce plot and contact heatmap ######################
-#############################################################################
-
-# Convert to integer
-remaining_seqs=$((remaining_seqs))
-
-# Plot contact map and 
-python $script_plot $output_npz $output_npz_switched $top_contacts $remaining_seqs
-
-# Move everything to output directory
-output_dir=./RoseTTAFold_2track_results/${input_a3m_name}
-mkdir -p $output_dir
-mv $output_npz $output_dir
-mv $output_npz_switched $output_dir
-mv ./*${input_a3m_name}-coevolution.png $output_dir
-mv ./*${input_a3m_name}.metrics $output_dir
-mv ./*${input_a3m_name}.contacts $output_dir
-mv ./*${input_a3m_name}.chimeraX $output_dir
-
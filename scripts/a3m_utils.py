@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+"""
+Helper functions shared by the DiscobaMultimer Python scripts to read and
+write a3m files.
+
+An a3m file produced by the pipeline may start with a cardinality line
+(e.g. "#192,125	1,1") followed by header/sequence pairs, one line each.
+
+The readers also accept MSA stores (<name>.a3mb, see msa_store.py): their
+records are the ones of the a3m file they were packed from.
+
+Compressed a3m files (<name>.a3m.zst or <name>.a3m.gz) are read and written
+transparently by open_a3m (zstd with the zstd command, gzip with the gzip
+module). find_a3m returns the a3m file of a stage whether it was compressed
+or not, and plain_a3m writes a plain copy for the tools that only read plain
+text (colabfold_batch).
+"""
+
+import os
+import io
+import shutil
+import tempfile
+
+COMPRESSED_EXTENSIONS = (".zst", ".gz")
+
+
+###############################################################################
+############################### Compressed files ##############################
+###############################################################################
+
+def is_compressed(a3m_file):
+    return a3m_file.endswith(COMPRESSED_EXTENSIONS)
+
+
+def strip_compression(a3m_file):
+    """
+    Returns the path without its compression extension (x.a3m.zst -> x.a3m).
+    """
+    for extension in COMPRESSED_EXTENSIONS:
+        if a3m_file.endswith(extension):
+            return a3m_file[:-len(extension)]
+    return a3m_file
+
+
+def find_a3m(a3m_file):
+    """
+    Returns the path of an a3m file or of its compressed version
+    (<a3m_file>.zst or <a3m_file>.gz), or None if none of them exists.
+    """
+    plain = strip_compression(a3m_file)
+    for candidate in [plain] + [plain + extension for extension in COMPRESSED_EXTENSIONS]:
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+
+class _PipeFile:
+    """
+    File object of a zstd process (its stdout when reading, its stdin when
+    writing). Closing it waits for the process and raises OSError if it
+    failed (e.g. a corrupted file).
+    """
+    def __init__(self, process, stream, a3m_file):
+        self.process = process
+        self.stream = stream
+        self.a3m_file = a3m_file
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def __iter__(self):
+        return iter(self.stream)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        try:
+            self.stream.close()
+        except BrokenPipeError:
+            pass
+        # A reader closed before the end stops zstd with SIGPIPE (-13)
+        if self.process.wait() not in (0, -13):
+            raise OSError(f"zstd failed with {self.a3m_file} (exit code {self.process.returncode})")
+
+
+def _open_zstd(a3m_file, mode):
+    import subprocess   # only imported for compressed files
+    if shutil.which("zstd") is None:
+        raise OSError(f"zstd is not installed (needed to open {a3m_file})")
+    if mode.startswith("r"):
+        if not os.path.isfile(a3m_file):
+            raise FileNotFoundError(f"No such file: '{a3m_file}'")
+        process = subprocess.Popen(["zstd", "-dcq", a3m_file], stdout=subprocess.PIPE)
+        stream = process.stdout
+    else:
+        process = subprocess.Popen(["zstd", "-qf", "-o", a3m_file], stdin=subprocess.PIPE)
+        stream = process.stdin
+    if "b" not in mode:
+        stream = io.TextIOWrapper(stream)
+    return _PipeFile(process, stream, a3m_file)
+
+
+def open_a3m(a3m_file, mode="r"):
+    """
+    Opens a plain or compressed (.zst or .gz) a3m file.
+
+    Parameters
+    ----------
+    a3m_file : str
+        Path to the a3m file. Its extension sets the compression.
+    mode : str
+        "r", "w", "rb" or "wb".
+
+    Returns
+    -------
+    file object
+        Text (or binary with "b") file object of the uncompressed content.
+
+    """
+    if a3m_file.endswith(".gz"):
+        import gzip
+        return gzip.open(a3m_file, mode if "b" in mode else mode + "t", compresslevel=6)
+    if a3m_file.endswith(".zst"):
+        return _open_zstd(a3m_file, mode)
+    return open(a3m_file, mode)
+
+
+def plain_a3m(a3m_file, directory, name=None):
+    """
+    Returns the path of a plain copy of a compressed a3m file, written to
+    directory with the name of the a3m file or name (colabfold_batch names
+    its outputs after its input). Plain a3m files are returned as they are.
+    """
+    if not is_compressed(a3m_file):
+        return a3m_file
+    plain_file = os.path.join(directory, name or os.path.basename(strip_compression(a3m_file)))
+    with open_a3m(a3m_file, "rb") as compressed, open(plain_file, "wb") as plain:
+        shutil.copyfileobj(compressed, plain, 1 << 20)
+    return plain_file
+
+
+###############################################################################
+################################# a3m records #################################
+###############################################################################
+
+
+def read_a3m(a3m_file):
+    """
+    Reads an a3m file keeping headers and sequences exactly as they are.
+
+    Parameters
+    ----------
+    a3m_file : str
+        Path to the a3m file. It may start with a cardinality line.
+
+    Returns
+    -------
+    cardinality : str or None
+        First line of the file if it starts with "#" (without newline).
+    records : list of tuples
+        (header, sequence) pairs. Headers keep the leading ">".
+
+    """
+    if a3m_file.endswith(".a3mb"):
+        from msa_store import MSAStore
+        store = MSAStore(a3m_file)
+        return store.cardinality, list(store.records())
+
+    cardinality = None
+    records = []
+    header = None
+    sequence = []
+
+    with open_a3m(a3m_file, "r") as file_read:
+        for i, line in enumerate(file_read):
+            line = line.rstrip("\n")
+            if i == 0 and line.startswith("#"):
+                cardinality = line
+            elif line.startswith(">"):
+                if header is not None:
+                    records.append((header, "".join(sequence)))
+                header = line
+                sequence = []
+            elif line.strip() != "" and header is not None:
+                sequence.append(line.strip())
+
+    if header is not None:
+        records.append((header, "".join(sequence)))
+
+    return cardinality, records
+
+
+def iter_a3m(a3m_file):
+    """
+    Iterates over the records of an a3m file without loading it in memory.
+    The cardinality line (if any) is skipped (see read_cardinality).
+
+    Yields
+    ------
+    tuple
+        (header, sequence) pairs. Headers keep the leading ">".
+
+    """
+    if a3m_file.endswith(".a3mb"):
+        from msa_store import MSAStore
+        yield from MSAStore(a3m_file).records()
+        return
+
+    header = None
+    sequence = []
+    with open_a3m(a3m_file, "r") as file_read:
+        for i, line in enumerate(file_read):
+            line = line.rstrip("\n")
+            if i == 0 and line.startswith("#"):
+                continue
+            if line.startswith(">"):
+                if header is not None:
+                    yield header, "".join(sequence)
+                header = line
+                sequence = []
+            elif line.strip() != "" and header is not None:
+                sequence.append(line.strip())
+
+    if header is not None:
+        yield header, "".join(sequence)
+
+
+def read_cardinality(a3m_file):
+    """
+    Returns the cardinality line of an a3m file (without newline), or None
+    if it does not start with one.
+    """
+    if a3m_file.endswith(".a3mb"):
+        from msa_store import MSAStore
+        return MSAStore(a3m_file).cardinality
+    with open_a3m(a3m_file, "r") as file_read:
+        first_line = file_read.readline().rstrip("\n")
+    return first_line if first_line.startswith("#") else None
+
+
+def write_a3m(a3m_file, records, cardinality=None):
+    """
+    Writes an a3m file atomically: the content is written to a temporary file
+    in the same directory and then renamed, so concurrent runs never see (or
+    collide on) half-written files.
+
+    Parameters
+    ----------
+    a3m_file : str
+        Path of the output a3m file. Can be the same as the input file. It is
+        compressed if it ends with .zst or .gz.
+    records : iterable of tuples
+        (header, sequence) pairs. A ">" is added to headers lacking it.
+    cardinality : str, optional
+        Cardinality line to write first (e.g. "#192,125	1,1").
+
+    Returns
+    -------
+    None.
+
+    """
+    output_dir = os.path.dirname(os.path.abspath(a3m_file))
+    suffix = ".a3m" + a3m_file[len(strip_compression(a3m_file)):]
+    fd, temp_file = tempfile.mkstemp(prefix=".tmp_", suffix=suffix, dir=output_dir)
+    os.close(fd)
+    try:
+        with open_a3m(temp_file, "w") as file_write:
+            if cardinality is not None:
+                file_write.write(cardinality + "\n")
+            for header, sequence in records:
+                if not header.startswith(">"):
+                    header = ">" + header
+                file_write.write(header + "\n" + sequence + "\n")
+        os.replace(temp_file, a3m_file)
+    except BaseException:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+
+
+def parse_cardinality(cardinality):
+    """
+    Parses a cardinality line.
+
+    Parameters
+    ----------
+    cardinality : str
+        Cardinality line (e.g. "#192,125	1,1").
+
+    Returns
+    -------
+    lengths : list of int
+        Length of each unique protein (e.g. [192, 125]).
+    numbers : list of int
+        Number of copies of each unique protein (e.g. [1, 1]).
+
+    """
+    lengths, numbers = cardinality.lstrip("#").strip().split("\t")[:2]
+    lengths = [int(L) for L in lengths.split(",")]
+    numbers = [int(N) for N in numbers.split(",")]
+    return lengths, numbers
+
+
+def combined_length(cardinality):
+    """
+    Returns the total number of residues of the complex described by a
+    cardinality line (e.g. "#192,125	2,1" gives 192*2 + 125*1 = 509).
+    """
+    lengths, numbers = parse_cardinality(cardinality)
+    return sum(L * N for L, N in zip(lengths, numbers))
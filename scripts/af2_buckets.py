@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""
+Runs AF2 predictions grouped in length buckets, one colabfold_batch call per
+bucket.
+
+Each colabfold_batch call pays the Python/JAX start-up, the loading of the
+weights and the XLA compilation for the length of its input. colabfold_batch
+accepts a directory of inputs, so the jobs are sorted by length and grouped
+in buckets (at most BUCKET_SIZE jobs whose lengths differ at most
+BUCKET_WIDTH residues). Each bucket is staged as an input directory (links to
+the MSAs named after their output directory) and predicted with a single
+colabfold_batch call, so the weights are loaded once per bucket and similar
+lengths can reuse the compilation.
+
+The outputs of each bucket are moved back to the output directory of each job
+(files are assigned to the job whose name is their longest prefix; shared
+files like config.json are copied to all of them, and each job gets the part
+of log.txt about its query, after the header of the log). A job without
+its .done.txt file after its bucket (e.g. the MSA that made colabfold_batch
+crash, and the ones after it) is run again alone, so a bad MSA only fails
+itself. Jobs whose output directory already has a .done.txt file are skipped.
+
+The colabfold_batch executable and the bucket limits can be changed with the
+COLABFOLD_BATCH, AF2_BUCKET_SIZE and AF2_BUCKET_WIDTH environment variables.
+"""
+
+import sys
+import os
+import glob
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+
+from a3m_utils import is_compressed, plain_a3m
+from telemetry import telemetry_command
+
+# Check input
+if __name__ == "__main__" and (len(sys.argv) < 2 or sys.argv[1].startswith("-")):
+    print("ERROR: missing positional arguments", file=sys.stderr)
+    print("USAGE: python af2_buckets.py <jobs.tsv> [<colabfold_batch options>]", file=sys.stderr)
+    print("")
+    print("   jobs.tsv    TSV file with one job per line:")
+    print("               input.a3m  output_dir  length")
+    print("   options     passed to every colabfold_batch call")
+    print("OUTPUT:")
+    print("   colabfold_batch outputs in each output_dir")
+    print("   One log per bucket in ./reports/AF2_buckets/")
+    sys.exit(1)
+
+# Bucket limits: jobs per bucket and length difference (residues)
+BUCKET_SIZE = int(os.environ.get("AF2_BUCKET_SIZE", 16))
+BUCKET_WIDTH = int(os.environ.get("AF2_BUCKET_WIDTH", 64))
+
+# Staging directories of the buckets and logs
+BUCKETS_DIR = "./AF2_buckets"
+LOGS_DIR = "./reports/AF2_buckets"
+
+# Start of the section of each query in the ColabFold log, e.g.
+# 2024-01-01 12:00:00,000 Query 2/16: ID1__vs__ID2 (length 512)
+QUERY_LINE = re.compile(r"Query \d+/\d+: (\S+)")
+
+
+def job_name(output_dir):
+    return os.path.basename(os.path.normpath(output_dir))
+
+
+def is_done(output_dir):
+    return bool(glob.glob(os.path.join(output_dir, "*.done.txt")))
+
+
+def read_jobs(jobs_file):
+    """
+    Reads the jobs file. Returns a list of (input_a3m, output_dir, length)
+    sorted by length (shortest first).
+    """
+    jobs = []
+    with open(jobs_file) as jobs_tsv:
+        for line in jobs_tsv:
+            if line.startswith("#") or not line.strip():
+                continue
+            input_a3m, output_dir, length = line.rstrip("\n").split("\t")[:3]
+            jobs.append((input_a3m, output_dir, int(length)))
+    return sorted(jobs, key=lambda job: job[2])
+
+
+def make_buckets(jobs, size=BUCKET_SIZE, width=BUCKET_WIDTH):
+    """
+    Groups the jobs (sorted by length) in buckets of at most size jobs whose
+    lengths differ at most width residues.
+    """
+    buckets = []
+    for job in jobs:
+        if buckets and len(buckets[-1]) < size and job[2] - buckets[-1][0][2] <= width:
+            buckets[-1].append(job)
+        else:
+            buckets.append([job])
+    return buckets
+
+
+def stage_bucket(bucket, bucket_dir):
+    """
+    Creates the input directory of a bucket with links to the MSAs named
+    after their jobs (plain copies of the compressed MSAs). Returns the input
+    and output directories.
+    """
+    input_dir = os.path.join(bucket_dir, "input")
+    output_dir = os.path.join(bucket_dir, "output")
+    shutil.rmtree(bucket_dir, ignore_errors=True)
+    os.makedirs(input_dir)
+    os.makedirs(output_dir)
+    for input_a3m, job_output_dir, _ in bucket:
+        if is_compressed(input_a3m):
+            plain_a3m(input_a3m, input_dir, job_name(job_output_dir) + ".a3m")
+        else:
+            os.symlink(os.path.abspath(input_a3m), os.path.join(input_dir, job_name(job_output_dir) + ".a3m"))
+    return input_dir, output_dir
+
+
+def split_log(log_file):
+    """
+    Splits a ColabFold log by query. Returns the lines before the first
+    query and {query name: lines of its section}.
+    """
+    header, sections, query = [], {}, None
+    with open(log_file, errors="replace") as log:
+        for line in log:
+            match = QUERY_LINE.search(line)
+            if match:
+                query = match.group(1)
+                sections.setdefault(query, [])
+            (sections[query] if query else header).append(line)
+    return header, sections
+
+
+def fan_out(bucket_output_dir, bucket):
+    """
+    Moves the outputs of a bucket to the output directory of each job.
+    Files that do not belong to any job are copied to all of them, except
+    log.txt: each job gets its header and the section of its query, so the
+    scores of the log are the ones of the job.
+    """
+    output_dirs = {job_name(job_output_dir): job_output_dir for _, job_output_dir, _ in bucket}
+    # Longest names first (A__vs__B_... is a prefix of A__vs__B__vs__C_...)
+    names = sorted(output_dirs, key=len, reverse=True)
+    for output_dir in output_dirs.values():
+        os.makedirs(output_dir, exist_ok=True)
+
+    shared = []
+    for file_name in sorted(os.listdir(bucket_output_dir)):
+        owner = next((name for name in names
+                      if file_name.startswith(name + "_") or file_name.startswith(name + ".")), None)
+        path = os.path.join(bucket_output_dir, file_name)
+        if owner is None:
+            shared.append(path)
+        else:
+            os.replace(path, os.path.join(output_dirs[owner], file_name))
+
+    for path in shared:
+        if os.path.basename(path) == "log.txt" and os.path.isfile(path):
+            header, sections = split_log(path)
+            for name, output_dir in output_dirs.items():
+                with open(os.path.join(output_dir, "log.txt"), "w") as log:
+                    log.writelines(header + sections.get(name, []))
+            continue
+        for output_dir in output_dirs.values():
+            destination = os.path.join(output_dir, os.path.basename(path))
+            if os.path.isdir(path):
+                shutil.copytree(path, destination, dirs_exist_ok=True)
+            else:
+                shutil.copy2(path, destination)
+
+
+def run_colabfold(colabfold_options, input_path, output_dir, log_file, stage, name, length):
+    """
+    Runs colabfold_batch recording its telemetry event (see telemetry.py).
+    A compressed MSA is given to colabfold_batch as a temporary plain copy.
+    """
+    colabfold_batch = os.environ.get("COLABFOLD_BATCH", "colabfold_batch")
+    plain_dir = tempfile.mkdtemp(prefix=".plain_", dir=output_dir) if is_compressed(input_path) else None
+    try:
+        if plain_dir:
+            input_path = plain_a3m(input_path, plain_dir)
+        command = telemetry_command(stage, name, [colabfold_batch] + colabfold_options + [input_path, output_dir],
+                                    length)
+        with open(log_file, "a") as log:
+            return subprocess.run(command, stdout=log, stderr=subprocess.STDOUT).returncode
+    finally:
+        if plain_dir:
+            shutil.rmtree(plain_dir, ignore_errors=True)
+
+
+def run_buckets(jobs, colabfold_options):
+    """
+    Runs the jobs in length buckets and retries alone the jobs that did not
+    finish in their bucket.
+
+    Returns
+    -------
+    failed : list of str
+        Output directories of the failed jobs.
+
+    """
+    os.makedirs(LOGS_DIR, exist_ok=True)
+    pending = [job for job in jobs if not is_done(job[1])]
+    skipped = len(jobs) - len(pending)
+    if skipped:
+        print(f"{skipped} AF2 predictions already done", flush=True)
+
+    failed = []
+    buckets = make_buckets(pending)
+    for index, bucket in enumerate(buckets, start=1):
+        bucket_dir = os.path.join(BUCKETS_DIR, f"bucket_{index}")
+        log_file = os.path.join(LOGS_DIR, f"bucket_{index}.log")
+        print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} START bucket {index}/{len(buckets)}: "
+              f"{len(bucket)} jobs (L={bucket[0][2]}-{bucket[-1][2]})", flush=True)
+
+        input_dir, bucket_output_dir = stage_bucket(bucket, bucket_dir)
+        exit_code = run_colabfold(colabfold_options, input_dir, bucket_output_dir, log_file,
+                                  "af2_bucket", f"bucket_{index}", sum(job[2] for job in bucket))
+        fan_out(bucket_output_dir, bucket)
+        shutil.rmtree(bucket_dir, ignore_errors=True)
+
+        # Jobs that did not finish in the bucket are run alone
+        unfinished = [job for job in bucket if not is_done(job[1])]
+        print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} {'DONE' if exit_code == 0 else 'FAILED'} "
+              f"bucket {index}: {len(bucket) - len(unfinished)}/{len(bucket)} jobs finished", flush=True)
+        for input_a3m, output_dir, length in unfinished:
+            print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} RETRY alone: {input_a3m} (L={length})", flush=True)
+            job_log = os.path.join(LOGS_DIR, f"{job_name(output_dir)}.log")
+            if run_colabfold(colabfold_options, input_a3m, output_dir, job_log,
+                             "af2", job_name(output_dir), length) != 0 or not is_done(output_dir):
+                failed.append(output_dir)
+                print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} FAILED: {input_a3m}", flush=True)
+
+    if os.path.isdir(BUCKETS_DIR) and not os.listdir(BUCKETS_DIR):
+        os.rmdir(BUCKETS_DIR)
+    return failed
+
+
+if __name__ == "__main__":
+    jobs_file = sys.argv[1]
+    colabfold_options = sys.argv[2:]
+
+    if not os.path.isfile(jobs_file):
+        print(f"ERROR: {jobs_file} is not a file", file=sys.stderr)
+        sys.exit(1)
+
+    failed = run_buckets(read_jobs(jobs_file), colabfold_options)
+    if failed:
+        print(f"ERROR: {len(failed)} AF2 jobs failed: {' '.join(failed)}", file=sys.stderr)
+        sys.exit(1)
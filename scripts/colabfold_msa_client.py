@@ -0,0 +1,474 @@
+# -*- coding: utf-8 -*-
+"""
+MSA-only client for ColabFold-compatible MSA servers.
+
+get_ColabFold_MSA.sh used to run a full colabfold_batch prediction (loading
+the AF2 weights on the GPU) only to keep its .a3m file. This client talks
+directly to the MSA server API used by colabfold_batch:
+
+    POST /ticket/msa   (q=<fasta>, mode=env)          unpaired MSAs
+    POST /ticket/pair  (q=<fasta>, mode=pairgreedy)   paired MSAs
+    GET  /ticket/<id>                                 status of the job
+    GET  /result/download/<id>                        results (tar.gz)
+
+and assembles colabfold_MSA/<name>.a3m exactly like colabfold_batch does
+(cardinality line, paired rows, then the unpaired rows of each protein padded
+with gaps).
+
+Many IDs lines are fetched concurrently (asyncio): the HTTP requests run in
+a pool of persistent connections, all of them go through a rate limiter
+(requests per second) and failed requests (connection errors, HTTP 429/5xx,
+RATELIMIT/MAINTENANCE statuses) are retried with exponential backoff.
+
+Unpaired MSAs are fetched once per unique sequence and reused by all the
+complexes that contain it (e.g. the partners of a protein in an all-vs-all),
+so only the paired MSA is fetched for each IDs line. The results of each
+query are stored in a local cache keyed by the SHA-256 of the mode and the
+sequences, so the same query is never sent twice.
+
+The server is https://api.colabfold.com by default (COLABFOLD_HOST
+environment variable or --host, e.g. http://localhost:8080 for a local
+server) and the cache is ~/.cache/DiscobaMultimer/colabfold_MSA
+(COLABFOLD_MSA_CACHE environment variable).
+"""
+
+import sys
+import os
+import argparse
+import asyncio
+import gzip
+import hashlib
+import http.client
+import io
+import json
+import queue
+import random
+import tarfile
+import tempfile
+import time
+import urllib.parse
+
+from a3m_utils import find_a3m
+from telemetry import record_cache_lookup
+
+# Server and cache
+DEFAULT_HOST = os.environ.get("COLABFOLD_HOST", "https://api.colabfold.com")
+CACHE_DIR = os.environ.get("COLABFOLD_MSA_CACHE",
+                           os.path.expanduser("~/.cache/DiscobaMultimer/colabfold_MSA"))
+
+# Modes of the server (same defaults as colabfold_batch)
+UNPAIRED_MODE = "env"
+PAIRED_MODE = "pairgreedy"
+
+# Files of the results of each mode
+UNPAIRED_FILES = ["uniref.a3m", "bfd.mgnify30.metaeuk30.smag30.a3m"]
+PAIRED_FILES = ["pair.a3m"]
+
+# First query number (ColabFold numbers the queries 101, 102, ...)
+FIRST_QUERY = 101
+
+OUTPUT_DIR = "./colabfold_MSA"
+USER_AGENT = "DiscobaMultimer"
+
+
+###############################################################################
+############################## Input sequences ################################
+###############################################################################
+
+def read_database(database, wanted=None):
+    """
+    Returns {ID: sequence} for the IDs in the fasta database (all of them if
+    wanted is None).
+    """
+    sequences = {}
+    current = None
+    with open(database) as fasta:
+        for line in fasta:
+            line = line.strip()
+            if line.startswith(">"):
+                current = line[1:] if wanted is None or line[1:] in wanted else None
+                if current is not None:
+                    sequences[current] = []
+            elif current is not None:
+                sequences[current].append(line)
+    return {ID: "".join(sequence).upper() for ID, sequence in sequences.items()}
+
+
+def read_IDs_lines(IDs_table_file):
+    lines = []
+    with open(IDs_table_file) as IDs_table:
+        for line in IDs_table:
+            if line.startswith("#") or not line.strip():
+                continue
+            lines.append(line.rstrip("\n").split("\t"))
+    return lines
+
+
+def unique_sequences(sequences):
+    """
+    Unique sequences (in order of appearance) and their cardinality.
+    """
+    unique, cardinality = [], []
+    for sequence in sequences:
+        if sequence in unique:
+            cardinality[unique.index(sequence)] += 1
+        else:
+            unique.append(sequence)
+            cardinality.append(1)
+    return unique, cardinality
+
+
+###############################################################################
+######################## a3m assembly (as colabfold_batch) ####################
+###############################################################################
+
+def pair_sequences(a3m_lines, query_sequences, query_cardinality):
+    paired = [""] * len(a3m_lines[0].splitlines())
+    for n, _ in enumerate(query_sequences):
+        lines = a3m_lines[n].splitlines()
+        for i, line in enumerate(lines):
+            if line.startswith(">"):
+                if n != 0:
+                    line = line.replace(">", "\t", 1)
+                paired[i] = paired[i] + line
+            else:
+                paired[i] = paired[i] + line * query_cardinality[n]
+    return "\n".join(paired)
+
+
+def pad_sequences(a3m_lines, query_sequences, query_cardinality):
+    blank = [("-" * len(sequence)) for n, sequence in enumerate(query_sequences)
+             for _ in range(query_cardinality[n])]
+    combined = []
+    position = 0
+    for n, _ in enumerate(query_sequences):
+        for _ in range(query_cardinality[n]):
+            for line in a3m_lines[n].split("\n"):
+                if len(line) == 0:
+                    continue
+                if line.startswith(">"):
+                    combined.append(line)
+                else:
+                    combined.append("".join(blank[:position] + [line] + blank[position + 1:]))
+            position += 1
+    return "\n".join(combined)
+
+
+def msa_to_str(unpaired_msa, paired_msa, query_sequences, query_cardinality):
+    """
+    Complex MSA with cardinality line, like the .a3m of colabfold_batch.
+    """
+    msa = "#" + ",".join(str(len(sequence)) for sequence in query_sequences) + "\t"
+    msa += ",".join(str(number) for number in query_cardinality) + "\n"
+    # The rows are built with cardinality 1 (as colabfold_batch does)
+    ones = [1] * len(query_cardinality)
+    if paired_msa is None:
+        msa += pad_sequences(unpaired_msa, query_sequences, ones)
+    else:
+        msa += pair_sequences(paired_msa, query_sequences, ones) + "\n" \
+            + pad_sequences(unpaired_msa, query_sequences, ones)
+    return msa
+
+
+def parse_results(tar_bytes, files, number_of_queries):
+    """
+    Splits the a3m files of the results in one MSA per query (the query
+    numbers are the headers after a \\x00 separator).
+    """
+    a3m_lines = {}
+    with tarfile.open(fileobj=io.BytesIO(tar_bytes), mode="r:gz") as tar:
+        names = tar.getnames()
+        for file_name in files:
+            if file_name not in names:
+                continue
+            update, query = True, None
+            for line in tar.extractfile(file_name).read().decode().splitlines(keepends=True):
+                if len(line) > 0:
+                    if "\x00" in line:
+                        line = line.replace("\x00", "")
+                        update = True
+                    if line.startswith(">") and update:
+                        query = int(line[1:].rstrip())
+                        update = False
+                        a3m_lines.setdefault(query, [])
+                    a3m_lines[query].append(line)
+    return ["".join(a3m_lines.get(FIRST_QUERY + n, [])) for n in range(number_of_queries)]
+
+
+###############################################################################
+################################# HTTP client #################################
+###############################################################################
+
+class ServerError(Exception):
+    pass
+
+
+class RateLimiter:
+    """
+    Allows at most rate requests per second among all the coroutines.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.next_time = 0.0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self.lock:
+            now = time.monotonic()
+            if self.next_time > now:
+                await asyncio.sleep(self.next_time - now)
+            self.next_time = max(now, self.next_time) + self.interval
+
+
+class ConnectionPool:
+    """
+    Persistent HTTP(S) connections to the server, reused between requests.
+    """
+
+    def __init__(self, host, size):
+        url = urllib.parse.urlsplit(host)
+        self.connection_class = (http.client.HTTPSConnection if url.scheme == "https"
+                                 else http.client.HTTPConnection)
+        self.netloc = url.netloc
+        self.base_path = url.path.rstrip("/")
+        self.connections = queue.LifoQueue()
+        for _ in range(size):
+            self.connections.put(None)
+
+    def request(self, method, path, body=None, headers=None, timeout=60):
+        """
+        Sends a request (blocking) and returns (HTTP status, body).
+        """
+        connection = self.connections.get()
+        try:
+            if connection is None:
+                connection = self.connection_class(self.netloc, timeout=timeout)
+            connection.request(method, self.base_path + path, body=body, headers=headers or {})
+            response = connection.getresponse()
+            data = response.read()
+            if response.getheader("Connection", "").lower() == "close":
+                connection.close()
+                connection = None
+            return response.status, data
+        except (OSError, http.client.HTTPException):
+            if connection is not None:
+                connection.close()
+            connection = None
+            raise
+        finally:
+            self.connections.put(connection)
+
+
+class MSAClient:
+    """
+    Fetches MSAs from the server with pooled connections, rate limiting,
+    retries with exponential backoff and a local cache.
+    """
+
+    def __init__(self, host=DEFAULT_HOST, connections=8, rate=2.0, retries=6,
+                 backoff_seconds=2.0, poll_seconds=5.0, cache_dir=CACHE_DIR):
+        self.pool = ConnectionPool(host, connections)
+        self.rate_limiter = RateLimiter(rate)
+        self.retries = retries
+        self.backoff_seconds = backoff_seconds
+        self.poll_seconds = poll_seconds
+        self.cache_dir = cache_dir
+        self.in_flight = {}
+
+    async def request(self, method, path, data=None):
+        """
+        Sends a request retrying with exponential backoff. Returns the body.
+        """
+        body, headers = None, {"User-Agent": USER_AGENT}
+        if data is not None:
+            body = urllib.parse.urlencode(data)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+
+        for attempt in range(self.retries + 1):
+            await self.rate_limiter.wait()
+            try:
+                status, response = await asyncio.to_thread(self.pool.request, method, path, body, headers)
+                if status == 200:
+                    return response
+                error = f"HTTP {status}"
+                if status not in (429, 500, 502, 503, 504):
+                    raise ServerError(f"{method} {path}: {error}")
+            except (OSError, http.client.HTTPException) as exception:
+                error = str(exception) or type(exception).__name__
+            if attempt == self.retries:
+                raise ServerError(f"{method} {path}: {error} (after {self.retries} retries)")
+            await self.backoff(attempt, f"{method} {path}: {error}")
+
+    async def backoff(self, attempt, reason):
+        delay = self.backoff_seconds * 2 ** attempt * (1 + random.random())
+        print(f"WARNING: {reason}. Retrying in {delay:.1f} s...", file=sys.stderr, flush=True)
+        await asyncio.sleep(delay)
+
+    async def submit(self, endpoint, query, mode):
+        """
+        Submits a job and waits until it is complete. Returns its ID.
+        """
+        for attempt in range(self.retries + 1):
+            ticket = json.loads(await self.request("POST", f"/ticket/{endpoint}", {"q": query, "mode": mode}))
+            while ticket.get("status") in ("PENDING", "RUNNING"):
+                await asyncio.sleep(self.poll_seconds * (1 + random.random()))
+                ticket = json.loads(await self.request("GET", f"/ticket/{ticket['id']}"))
+            status = ticket.get("status")
+            if status == "COMPLETE":
+                return ticket["id"]
+            if status == "ERROR":
+                raise ServerError(f"the server could not compute the MSA ({endpoint}, mode {mode})")
+            # RATELIMIT, MAINTENANCE or UNKNOWN: submit again later
+            if attempt == self.retries:
+                raise ServerError(f"job not accepted by the server (status {status})")
+            await self.backoff(attempt, f"server status {status}")
+
+    def _cache_file(self, mode, sequences):
+        key = hashlib.sha256((mode + "\n" + "\n".join(sequences)).encode()).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key + ".json.gz")
+
+    async def run(self, endpoint, mode, files, sequences):
+        """
+        MSAs of the sequences (one a3m string per sequence), from the cache
+        or from the server. Concurrent calls for the same query share a
+        single request.
+        """
+        cache_file = self._cache_file(mode, sequences)
+        if cache_file not in self.in_flight:
+            self.in_flight[cache_file] = asyncio.ensure_future(
+                self._fetch(endpoint, mode, files, sequences, cache_file))
+        try:
+            return await asyncio.shield(self.in_flight[cache_file])
+        finally:
+            if self.in_flight.get(cache_file) is not None and self.in_flight[cache_file].done():
+                del self.in_flight[cache_file]
+
+    async def _fetch(self, endpoint, mode, files, sequences, cache_file):
+        record_cache_lookup("colabfold_msa", os.path.isfile(cache_file))
+        if os.path.isfile(cache_file):
+            with gzip.open(cache_file, "rt") as cached:
+                return json.load(cached)
+
+        query = "".join(f">{FIRST_QUERY + n}\n{sequence}\n" for n, sequence in enumerate(sequences))
+        job_id = await self.submit(endpoint, query, mode)
+        tar_bytes = await self.request("GET", f"/result/download/{job_id}")
+        a3m_lines = parse_results(tar_bytes, files, len(sequences))
+
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        fd, temp_file = tempfile.mkstemp(dir=os.path.dirname(cache_file), suffix=".tmp")
+        with gzip.open(os.fdopen(fd, "wb"), "wt") as cached:
+            json.dump(a3m_lines, cached)
+        os.replace(temp_file, cache_file)
+        return a3m_lines
+
+    async def unpaired_msa(self, sequence, query_number=FIRST_QUERY):
+        """
+        Unpaired MSA of a single sequence. It is fetched (and cached) once
+        per sequence and reused by every complex that contains it: only the
+        query headers are renumbered (>101, >102, ...) as if the sequence
+        had been submitted with the rest of the complex.
+        """
+        a3m = (await self.run("msa", UNPAIRED_MODE, UNPAIRED_FILES, [sequence]))[0]
+        if query_number == FIRST_QUERY:
+            return a3m
+        return "".join(f">{query_number}\n" if line == f">{FIRST_QUERY}\n" else line
+                       for line in a3m.splitlines(keepends=True))
+
+    async def complex_msa(self, sequences):
+        """
+        MSA of a complex (or a monomer) as written by colabfold_batch. Only
+        the paired MSA is specific to the complex.
+        """
+        unique, cardinality = unique_sequences(sequences)
+        unpaired = await asyncio.gather(*(self.unpaired_msa(sequence, FIRST_QUERY + n)
+                                          for n, sequence in enumerate(unique)))
+        paired = None
+        if len(unique) > 1:
+            paired = await self.run("pair", PAIRED_MODE, PAIRED_FILES, unique)
+        return msa_to_str(unpaired, paired, unique, cardinality)
+
+
+###############################################################################
+################################### Driver ####################################
+###############################################################################
+
+async def fetch_lines(client, lines, sequences, output_dir=OUTPUT_DIR, concurrent_lines=8):
+    """
+    Writes output_dir/<name>.a3m for every IDs line (skipping the existing
+    ones), fetching up to concurrent_lines lines at the same time.
+
+    Returns
+    -------
+    failed : list of str
+        Names of the lines that could not be fetched.
+
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    semaphore = asyncio.Semaphore(concurrent_lines)
+    failed = []
+
+    async def fetch_line(IDs):
+        name = "__vs__".join(IDs)
+        output_a3m = os.path.join(output_dir, name + ".a3m")
+        if find_a3m(output_a3m):
+            return      # fetched before (it may have been compressed)
+        async with semaphore:
+            start = time.time()
+            try:
+                msa = await client.complex_msa([sequences[ID] for ID in IDs])
+            except ServerError as error:
+                print(f"ERROR: ColabFold MSA of {name} failed: {error}", file=sys.stderr, flush=True)
+                failed.append(name)
+                return
+            fd, temp_file = tempfile.mkstemp(dir=output_dir, prefix=".tmp_", suffix=".a3m")
+            with os.fdopen(fd, "w") as output:
+                output.write(msa)
+            os.chmod(temp_file, 0o644)
+            os.replace(temp_file, output_a3m)
+            print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} DONE: ColabFold MSA saved in {output_a3m} "
+                  f"({time.time() - start:.1f} s)", flush=True)
+
+    await asyncio.gather(*(fetch_line(IDs) for IDs in lines))
+    return failed
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Fetches ColabFold MSAs (colabfold_MSA/<name>.a3m) "
+                                                 "from a ColabFold MSA server.")
+    parser.add_argument("database", help="protein database (only ID headers)")
+    parser.add_argument("IDs", nargs="*", help="IDs of a single line")
+    parser.add_argument("--table", help="IDs table: fetch all its lines concurrently")
+    parser.add_argument("--host", default=DEFAULT_HOST, help=f"MSA server (default {DEFAULT_HOST})")
+    parser.add_argument("--lines", type=int, default=8, help="lines fetched at the same time (default 8)")
+    parser.add_argument("--connections", type=int, default=8, help="pooled connections (default 8)")
+    parser.add_argument("--rate", type=float, default=2.0, help="maximum requests per second (default 2)")
+    parser.add_argument("--poll", type=float, default=5.0, help="seconds between status checks (default 5)")
+    parser.add_argument("--output-dir", default=OUTPUT_DIR, help=f"output directory (default {OUTPUT_DIR})")
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.database):
+        parser.error(f"database argument {args.database} is not a file")
+    if bool(args.IDs) == bool(args.table):
+        parser.error("give the IDs of a line or an IDs table (--table)")
+    if args.table and not os.path.isfile(args.table):
+        parser.error(f"IDs table {args.table} is not a file")
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    lines = read_IDs_lines(args.table) if args.table else [args.IDs]
+    wanted = {ID for IDs in lines for ID in IDs}
+    sequences = read_database(args.database, wanted)
+    missing = wanted - set(sequences)
+    if missing:
+        print(f"ERROR: IDs not found in {args.database}: {' '.join(sorted(missing))}", file=sys.stderr)
+        sys.exit(1)
+
+    client = MSAClient(args.host, args.connections, args.rate, poll_seconds=args.poll)
+    failed = asyncio.run(fetch_lines(client, lines, sequences, args.output_dir, args.lines))
+    if failed:
+        print(f"ERROR: {len(failed)} ColabFold MSAs failed: {' '.join(failed)}", file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compresses the a3m files of a project in place (<name>.a3m -> <name>.a3m.zst
+or <name>.a3m.gz) and decompresses them back.
+
+The MSAs are text with long runs of gaps and repeated residues, so they
+shrink several times. Every stage of the pipeline reads a compressed MSA
+when the a3m file is missing (see a3m_utils.open_a3m and find_a3m), so the
+folders can be compressed once their lines are finished.
+
+Each file is compressed to a temporary file next to it, checked (its
+decompressed content must be the original one) and renamed, keeping the
+modification time of the original. Only then is the original removed. Links
+to compressed files (e.g. the permutations of the IDs table linked to their
+canonical MSA) are replaced by links to the compressed files. Files are
+compressed in parallel with --jobs.
+
+    cd project_folder
+    python $DiscobaMultimerPath/scripts/compress_msa.py compress merged_MSA colabfold_MSA discoba_paired_unpaired
+    python $DiscobaMultimerPath/scripts/compress_msa.py decompress merged_MSA
+    python $DiscobaMultimerPath/scripts/compress_msa.py benchmark merged_MSA --sample 20
+
+Do not compress the folders of a batch that is still running: a stage that
+has already chosen a file name could miss it.
+"""
+
+import sys
+import os
+import argparse
+import hashlib
+import shutil
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from a3m_utils import COMPRESSED_EXTENSIONS, is_compressed, open_a3m, strip_compression
+
+CODECS = {"zst": ".zst", "gz": ".gz"}
+DEFAULT_LEVELS = {"zst": 3, "gz": 6}
+
+
+###############################################################################
+################################### Listing ###################################
+###############################################################################
+
+def list_a3m(paths, compressed):
+    """
+    Returns the a3m files (plain or compressed) and the links to a3m files
+    of the paths (files or folders, walked recursively).
+    """
+    def is_a3m(name):
+        return strip_compression(name).endswith(".a3m") and is_compressed(name) == compressed
+
+    files, links = [], []
+    for path in paths:
+        if not os.path.isdir(path):
+            (links if os.path.islink(path) else files).append(path)
+            continue
+        for root, folders, names in os.walk(path):
+            folders[:] = sorted(folder for folder in folders if not folder.startswith("."))
+            for name in sorted(names):
+                if name.startswith(".") or not is_a3m(name):
+                    continue
+                file_path = os.path.join(root, name)
+                (links if os.path.islink(file_path) else files).append(file_path)
+    return files, links
+
+
+###############################################################################
+################################ Compression ##################################
+###############################################################################
+
+def _sha256(file_object):
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: file_object.read(1 << 20), b""):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _write_compressed(source_file, output_file, codec, level):
+    if codec == "zst":
+        subprocess.run(["zstd", "-q", "-f", f"-{level}", "-o", output_file, source_file], check=True,
+                       stdin=subprocess.DEVNULL)
+    else:
+        import gzip
+        with open(source_file, "rb") as source, gzip.open(output_file, "wb", compresslevel=level) as output:
+            shutil.copyfileobj(source, output, 1 << 20)
+
+
+def convert_file(a3m_file, codec=None, level=None, keep=False):
+    """
+    Compresses a plain a3m file (codec "zst" or "gz") or decompresses a
+    compressed one (codec None). The new file is checked before the
+    original is removed. Returns (new_file, original_size, new_size).
+    """
+    if codec:
+        new_file = a3m_file + CODECS[codec]
+    else:
+        new_file = strip_compression(a3m_file)
+    if os.path.lexists(new_file):
+        raise FileExistsError(f"{new_file} already exists")
+
+    directory = os.path.dirname(os.path.abspath(a3m_file))
+    fd, temporary_file = tempfile.mkstemp(prefix=".tmp_", suffix=os.path.basename(new_file), dir=directory)
+    os.close(fd)
+    try:
+        if codec:
+            _write_compressed(a3m_file, temporary_file, codec, level)
+            with open(a3m_file, "rb") as original, open_a3m(temporary_file, "rb") as converted:
+                if _sha256(original) != _sha256(converted):
+                    raise OSError(f"the compressed {a3m_file} is not the original")
+        else:
+            with open_a3m(a3m_file, "rb") as source, open(temporary_file, "wb") as output:
+                shutil.copyfileobj(source, output, 1 << 20)
+        stat = os.stat(a3m_file)
+        os.chmod(temporary_file, stat.st_mode & 0o777)
+        os.utime(temporary_file, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        os.replace(temporary_file, new_file)
+    except BaseException:
+        if os.path.exists(temporary_file):
+            os.remove(temporary_file)
+        raise
+    if not keep:
+        os.remove(a3m_file)
+    return new_file, stat.st_size, os.path.getsize(new_file)
+
+
+def repoint_link(link, compress):
+    """
+    Replaces a link to an a3m file that was (de)compressed by a link with
+    the new name to the new file. Returns the new link or None.
+    """
+    target = os.readlink(link)
+    if os.path.exists(link):
+        return None     # its target was kept
+    if compress:
+        extension = next((extension for extension in COMPRESSED_EXTENSIONS
+                          if os.path.exists(os.path.join(os.path.dirname(link), target + extension))), None)
+        if extension is None:
+            return None
+        new_link, new_target = link + extension, target + extension
+    else:
+        new_link, new_target = strip_compression(link), strip_compression(target)
+        if not os.path.exists(os.path.join(os.path.dirname(link), new_target)):
+            return None
+    if os.path.lexists(new_link):
+        return None
+    os.symlink(new_target, new_link)
+    os.remove(link)
+    return new_link
+
+
+###############################################################################
+################################## Benchmark ##################################
+###############################################################################
+
+def benchmark(a3m_files, level_zst, level_gz):
+    """
+    Returns {format: (bytes, seconds to write, seconds to read)} of the a3m
+    files plain and compressed with each codec (read with read_a3m).
+    """
+    from a3m_utils import read_a3m
+    results = {}
+    work_dir = tempfile.mkdtemp(prefix="discoba_compress_msa.")
+    try:
+        for name, codec, level in (("a3m", None, None), ("a3m.zst", "zst", level_zst), ("a3m.gz", "gz", level_gz)):
+            size = write_seconds = read_seconds = 0
+            for index, a3m_file in enumerate(a3m_files):
+                copy = os.path.join(work_dir, f"{index}.a3m") + (CODECS[codec] if codec else "")
+                start = time.perf_counter()
+                if codec:
+                    _write_compressed(a3m_file, copy, codec, level)
+                else:
+                    shutil.copyfile(a3m_file, copy)
+                write_seconds += time.perf_counter() - start
+                size += os.path.getsize(copy)
+                start = time.perf_counter()
+                read_a3m(copy)
+                read_seconds += time.perf_counter() - start
+                os.remove(copy)
+            results[name] = (size, write_seconds, read_seconds)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+###############################################################################
+##################################### CLI #####################################
+###############################################################################
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Compresses and decompresses the a3m files of a project.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    compress = commands.add_parser("compress", help="compress the a3m files (<name>.a3m -> <name>.a3m.zst)")
+    compress.add_argument("paths", nargs="+", help="a3m files or folders (walked recursively)")
+    compress.add_argument("--codec", choices=list(CODECS), default="zst", help="compression (default zst)")
+    compress.add_argument("--level", type=int, help="compression level (default: 3 for zst, 6 for gz)")
+    compress.add_argument("--keep", action="store_true", help="keep the plain a3m files")
+    compress.add_argument("--jobs", type=int, default=os.cpu_count(), help="files compressed at the same time")
+
+    decompress = commands.add_parser("decompress", help="decompress the a3m files (<name>.a3m.zst -> <name>.a3m)")
+    decompress.add_argument("paths", nargs="+", help="compressed a3m files or folders (walked recursively)")
+    decompress.add_argument("--keep", action="store_true", help="keep the compressed files")
+    decompress.add_argument("--jobs", type=int, default=os.cpu_count(), help="files decompressed at the same time")
+
+    bench = commands.add_parser("benchmark", help="size and read time of the a3m files plain and compressed")
+    bench.add_argument("paths", nargs="+", help="a3m files or folders (walked recursively)")
+    bench.add_argument("--sample", type=int, default=20, help="number of files measured (default 20)")
+    args = parser.parse_args()
+    if args.command == "compress" and args.level is None:
+        args.level = DEFAULT_LEVELS[args.codec]
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    for path in args.paths:
+        if not os.path.lexists(path):
+            print(f"ERROR: {path} not found", file=sys.stderr)
+            sys.exit(1)
+    if (args.command == "benchmark" or getattr(args, "codec", None) == "zst") and not shutil.which("zstd"):
+        print("ERROR: zstd is not installed (use --codec gz)", file=sys.stderr)
+        sys.exit(1)
+
+    if args.command == "benchmark":
+        a3m_files, _ = list_a3m(args.paths, compressed=False)
+        a3m_files = a3m_files[:max(1, args.sample)]
+        if not a3m_files:
+            print("ERROR: no a3m files found", file=sys.stderr)
+            sys.exit(1)
+        results = benchmark(a3m_files, DEFAULT_LEVELS["zst"], DEFAULT_LEVELS["gz"])
+        plain_size = results["a3m"][0]
+        print(f"{len(a3m_files)} a3m files")
+        print(f"{'format':<10}{'MB':>10}{'ratio':>8}{'write_s':>10}{'read_s':>10}")
+        for name, (size, write_seconds, read_seconds) in results.items():
+            print(f"{name:<10}{size / 1e6:10.2f}{plain_size / size:8.2f}{write_seconds:10.2f}{read_seconds:10.2f}")
+        sys.exit(0)
+
+    compress = args.command == "compress"
+    a3m_files, links = list_a3m(args.paths, compressed=not compress)
+    start = time.time()
+
+    def convert(a3m_file):
+        try:
+            return a3m_file, convert_file(a3m_file, args.codec if compress else None,
+                                          args.level if compress else None, args.keep), None
+        except (OSError, subprocess.CalledProcessError) as error:
+            return a3m_file, None, str(error)
+
+    failed, original_bytes, new_bytes = 0, 0, 0
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+        for a3m_file, result, error in executor.map(convert, a3m_files):
+            if error:
+                failed += 1
+                print(f"ERROR: {a3m_file}: {error}", file=sys.stderr)
+            else:
+                original_bytes += result[1]
+                new_bytes += result[2]
+    relinked = sum(repoint_link(link, compress) is not None for link in links)
+
+    print(f"{len(a3m_files) - failed} files {args.command}ed ({original_bytes / 1e6:.1f} MB -> "
+          f"{new_bytes / 1e6:.1f} MB), {relinked} links updated in {time.time() - start:.1f} s")
+    sys.exit(1 if failed else 0)
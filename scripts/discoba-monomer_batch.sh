@@ -12,6 +12,8 @@ usage(){
 	echo " -s <MIN_MAX>		: minimum and maximum sizes to compute AF2 monomers"
 	echo " -c <AF2.conf>		: path to custom AF2 configuration file"
 	echo " -i <MSAs_path>		: path to custom MSAs (a3m format with cardinality)"
+	echo " -b			: with -a, run AF2 predictions in length buckets (one colabfold_batch"
+	echo "			  call per bucket: weights loaded and compiled once per bucket)"
 	echo ""
 	echo "Any bugs? ---> rodriguezaraya@ibr-conicet.gov.ar"
 	exit 1
@@ -30,6 +32,12 @@ GetDiscobaMSA=$DiscobaMultimerPath/scripts/run_MMseqs2_to_get_DiscobaMSA_3.0.sh
 
 GENERATE_PLOT=$DiscobaMultimerPath/scripts/plot_msa.py
 
+WORKER_SCRIPT=$DiscobaMultimerPath/scripts/discoba_worker.py
+	# USAGE: python $WORKER_SCRIPT run <script.py> [arguments] (see run_helper)
+
+AF2_BUCKETS=$DiscobaMultimerPath/scripts/af2_buckets.py
+	# USAGE: python $AF2_BUCKETS <jobs.tsv> [<colabfold_batch options>]
+
 
 # SUB-DEPENDENCIES ---------------------------------------------------------
 
@@ -57,8 +65,9 @@ sizes_tag=""
 AF2_conf=false
 AF2_conf_tag=""
 AF2_conf_file=""
+bucket_AF2=false
 # while getopts "mpa:c:i:s:" opt; do
-while getopts "mpac:i:s:" opt; do
+while getopts "mpac:i:s:b" opt; do
   case ${opt} in
     m)
       make_MSA=true
@@ -103,6 +112,9 @@ while getopts "mpac:i:s:" opt; do
       max_size=${OPTARG#*_}
       sizes_tag="-s $OPTARG"
       ;;
+    b)
+      bucket_AF2=true
+      ;;
     \?)
       echo "Invalid option: -$OPTARG" >&2
       usage
@@ -142,6 +154,11 @@ if [ "$sizes" == "true" ]; then
 	fi
 fi
 
+if [ "$bucket_AF2" == "true" ] && [ "$alphafold" != "true" ]; then
+	echo "ERROR: -b only possible if -a was passed"
+	usage
+fi
+
 
 add_time() {
   # Get the current time in the format "YYYY-MM-DD HH:MM:SS"
@@ -154,6 +171,44 @@ add_time() {
   echo "$output_string"
 }
 
+# Runs a Python helper in the worker of the batch if one is running, with its
+# modules already imported (see discoba_worker.py). Otherwise runs it directly.
+run_helper() {
+	if [ -S "${DISCOBA_WORKER_SOCKET:-}" ]; then
+		python -S $WORKER_SCRIPT run "$@"
+	else
+		python "$@"
+	fi
+}
+
+# Compressed MSAs (<name>.a3m.zst or <name>.a3m.gz, see a3m_utils.py). The
+# stages read an MSA whether it was compressed or not:
+#	a3m_find <name>.a3m		prints the a3m file or its compressed version (returns 1 if none exists)
+#	a3m_cat <a3m_file>		prints the uncompressed content
+#	a3m_plain <a3m_file> <dir>	prints the path of a plain copy written to dir (for colabfold_batch)
+a3m_find() {
+	local a3m
+	for a3m in "$1" "$1.zst" "$1.gz"; do
+		if [ -f "$a3m" ]; then
+			echo "$a3m"
+			return 0
+		fi
+	done
+	return 1
+}
+a3m_cat() {
+	case "$1" in
+		*.zst) zstd -dcq "$1" ;;
+		*.gz) gzip -dc "$1" ;;
+		*) cat "$1" ;;
+	esac
+}
+a3m_plain() {
+	local plain_a3m=$2/$(basename "${1%.a3m*}").a3m
+	a3m_cat "$1" > "$plain_a3m"
+	echo "$plain_a3m"
+}
+
 # Assign positional arguments to variables
 database_file=$1
 IDs_table_file=$2
@@ -214,14 +269,14 @@ if [ "$make_MSA" == "true" ]; then
 		add_time "Merging ColabFold and Discoba MSAs..."
 
 		# If protein_ID merged MSA was already computed, do not compute it
-		if [ -f ./merged_MSA/${protein_ID}.a3m ]; then
+		if a3m_find ./merged_MSA/${protein_ID}.a3m > /dev/null; then
 			add_time "WARNING: ./merged_MSA/${protein_ID}.a3m already exists. Merging not performed."
 		# If protein_ID merged MSA does not exists, compute it
 		else
-			# Concatenate ColabFoldMSA with DiscobaMSA monomers
-			cat ./colabfold_MSA/${protein_ID}.a3m > ./merged_MSA/${protein_ID}.a3m
+			# Concatenate ColabFoldMSA with DiscobaMSA monomers (compressed or not)
+			a3m_cat $(a3m_find ./colabfold_MSA/${protein_ID}.a3m) > ./merged_MSA/${protein_ID}.a3m
 			echo "" >> ./merged_MSA/${protein_ID}.a3m
-			cat ./discoba_mmseqs_alignments/${protein_ID}/${protein_ID}.a3m >> ./merged_MSA/${protein_ID}.a3m
+			a3m_cat $(a3m_find ./discoba_mmseqs_alignments/${protein_ID}/${protein_ID}.a3m) >> ./merged_MSA/${protein_ID}.a3m
 		fi
 		add_time "DONE: output in ./merged_MSA/${protein_ID}.a3m"
 		
@@ -231,7 +286,7 @@ if [ "$make_MSA" == "true" ]; then
 			output_png="${protein_ID}_msa.png"
 			if [ ! -f ./msa_plots/$output_png ]; then
 				add_time "Generating MSA plot $output_png..."
-				python $GENERATE_PLOT ./merged_MSA/${protein_ID}.a3m
+				run_helper $GENERATE_PLOT $(a3m_find ./merged_MSA/${protein_ID}.a3m)
 				mv $output_png ./msa_plots
 				add_time "DONE: output in ./msa_plots/$output_png"
 			else
@@ -277,6 +332,13 @@ if [ "$alphafold" == "true" ]; then
 	# Create output folder if it does not exists
 	[ ! -d ./AF2 ] && mkdir ./AF2/ || add_time "AF2 directory already exist. Continuing."
 
+	# With -b the predictions are collected and run at the end in length buckets
+	if [ "$bucket_AF2" == "true" ]; then
+		[ ! -d ./reports ] && mkdir ./reports/
+		AF2_jobs_file=./reports/AF2_buckets_jobs_$(basename $IDs_table_file).tsv
+		rm -f $AF2_jobs_file
+	fi
+
 	# Scan IDs_file one line at a time
 	while IFS=$'\t' read -r -a IDs_array; do
 
@@ -299,19 +361,20 @@ if [ "$alphafold" == "true" ]; then
 		if [ "$import_MSA" == "true" ]; then
 			input_a3m_file=$merged_msa_path/${protein_ID}.a3m
 			add_time "Using precomputed MSA"
-			if [ ! -f "$input_a3m_file" ]; then
+			if ! a3m_find $input_a3m_file > /dev/null; then
 				add_time "ERROR: $input_a3m_file is missing in custom MSA database"
 				usage
 			fi
 		else
 			input_a3m_file=./merged_MSA/${protein_ID}.a3m
 		fi
+		input_a3m_file=$(a3m_find $input_a3m_file || echo $input_a3m_file)
 
 		# dir to store AF2 models
 		output_dir_AF2=./AF2/${protein_ID}/
 
 		# Check protein size
-		protein_sequence=$(grep -A 1 "^>" $input_a3m_file | tail -n 1)
+		protein_sequence=$(a3m_cat $input_a3m_file | grep -A 1 "^>" | tail -n 1)
 		protein_length=$(echo -n "$protein_sequence" | wc -c)
 
 		# If size is outside range, ignore it
@@ -344,15 +407,36 @@ if [ "$alphafold" == "true" ]; then
 			# Use AF2.conf file as configurations
 			echo "AF2 with config file: $AF2_conf_file"
 			echo "Options: $options"
-			colabfold_batch $options $input_a3m_file $output_dir_AF2
 
 		else
 			# Use default configuration
+			options="--num-models 5 --num-recycle 3 --rank plddt --recycle-early-stop-tolerance 0.5 --num-relax 1 --use-gpu-relax"
 			echo "AF2 without config"
-			echo "Options: --num-models 5 --num-recycle 3 --rank plddt --recycle-early-stop-tolerance 0.5 --num-relax 1 --use-gpu-relax"
-			colabfold_batch --num-models 5 --num-recycle 3 --rank plddt --recycle-early-stop-tolerance 0.5 --num-relax 1 --use-gpu-relax $input_a3m_file ./AF2/$protein_ID
+			echo "Options: $options"
+		fi
+
+		if [ "$bucket_AF2" == "true" ]; then
+			printf '%s\t%s\t%s\n' $input_a3m_file $output_dir_AF2 $protein_length >> $AF2_jobs_file
+			add_time "AF2 prediction added to the queue (length: $protein_length)"
+		else
+			# colabfold_batch reads plain MSAs: temporary copy of a compressed one
+			AF2_input=$input_a3m_file
+			if [[ "$input_a3m_file" == *.zst || "$input_a3m_file" == *.gz ]]; then
+				mkdir -p ./AF2
+				AF2_input=$(a3m_plain $input_a3m_file $(mktemp -d ./AF2/.plain_XXXXXX))
+			fi
+			colabfold_batch $options $AF2_input $output_dir_AF2
+			if [ "$AF2_input" != "$input_a3m_file" ]; then
+				rm -rf $(dirname $AF2_input)
+			fi
 		fi
 	done < "$IDs_table_file"
+
+	# Run the collected predictions in length buckets
+	if [ "$bucket_AF2" == "true" ] && [ -f "$AF2_jobs_file" ]; then
+		add_time "Running AF2 predictions in length buckets (logs in ./reports/AF2_buckets)..."
+		python $AF2_BUCKETS $AF2_jobs_file $options || add_time "WARNING: some AF2 predictions failed"
+	fi
 fi
 
 add_time "discoba-monomer-batch FINISHED"
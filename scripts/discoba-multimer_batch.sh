@@ -3,8 +3,17 @@
 # DEPENDENCIES -------------------------------------------------------------
 GetDiscobaMSA=$DiscobaMultimerPath/scripts/get_Discoba_MSA.sh
 GetColabFoldMSA=$DiscobaMultimerPath/scripts/get_ColabFold_MSA.sh
+COLABFOLD_MSA_CLIENT=$DiscobaMultimerPath/scripts/colabfold_msa_client.py
 GENERATE_PLOT=$DiscobaMultimerPath/scripts/plot_msa.py
+MERGE_MSA=$DiscobaMultimerPath/scripts/merge_MSA.py
 RF2track_run=$DiscobaMultimerPath/scripts/RoseTTAFold_2track_run.sh
+GPU_PACKING=$DiscobaMultimerPath/scripts/gpu_packing.py
+AF2_BUCKETS=$DiscobaMultimerPath/scripts/af2_buckets.py
+RESULT_CACHE=$DiscobaMultimerPath/scripts/result_cache.py
+JOB_DB=$DiscobaMultimerPath/scripts/job_db.py
+TELEMETRY=$DiscobaMultimerPath/scripts/telemetry.py
+METRICS_EXPORTER=$DiscobaMultimerPath/scripts/metrics_exporter.py
+WORKER_SCRIPT=$DiscobaMultimerPath/scripts/discoba_worker.py
 
 # SUB-DEPENDENCIES ---------------------------------------------------------
 # Path to run_MMseqs2_to_get_DiscobaMSA.sh
@@ -41,6 +50,16 @@ usage() {
 	echo " -c <AF2.conf>		: path to custom AF2 configuration file"
 	echo " -i <MSAs_path>		: path to custom MSAs (a3m format with cardinality)"
 	echo " -s <MIN_MAX>		: minimum and maximum sizes to compute with RF and AF2"
+	echo " -k			: with -a, run several AF2 predictions at the same time on each GPU"
+	echo "			  (as many as fit in its memory, estimated from the complex size)"
+	echo " -b			: with -a, run AF2 predictions in length buckets (one colabfold_batch"
+	echo "			  call per bucket: weights loaded and compiled once per bucket)"
+	echo " -D <integer>		: with -m/-M, maximum number of sequences of the merged MSAs"
+	echo "			  (paired sequences are kept first)"
+	echo " -n <integer>		: monomer searches to run at the same time with -m/-M (default 1)"
+	echo "			  (the cores are shared among them)"
+	echo " -q <queue.tsv>		: with -r, only add the pairs to the RF2-track queue file"
+	echo "			  (predict them later with RoseTTAFold_2track_run.sh -Q <queue.tsv>)"
 	echo "" 
 	echo "*NOT IMPLEMENTED"
 	echo ""
@@ -181,7 +200,10 @@ AF2_conf_file=""
 # custom_filter=false
 # custom_threshold=false
 use_multiple_GPUs=false
-while getopts "hmMpag:c:ri:s:" opt; do
+search_jobs=1
+pack_AF2=false
+bucket_AF2=false
+while getopts "hmMpag:c:ri:s:q:n:kbD:" opt; do
   case ${opt} in
     h)
       help_msg
@@ -251,6 +273,30 @@ while getopts "hmMpag:c:ri:s:" opt; do
       max_size=${OPTARG#*_}
       sizes_tag="-s $OPTARG"
       ;;
+    q)
+      RF2track_queue_file=$OPTARG
+      ;;
+    k)
+      pack_AF2=true
+      ;;
+    b)
+      bucket_AF2=true
+      ;;
+    D)
+      max_depth=$OPTARG
+      if [[ ! $max_depth =~ ^[0-9]+$ ]] || [[ $max_depth -eq 0 ]]; then
+	echo "ERROR: -D argument must be a positive integer"
+	usage
+      fi
+      max_depth_tag="--max-depth $max_depth"
+      ;;
+    n)
+      search_jobs=$OPTARG
+      if [[ ! $search_jobs =~ ^[0-9]+$ ]] || [[ $search_jobs -eq 0 ]]; then
+	echo "ERROR: -n argument must be a positive integer"
+	usage
+      fi
+      ;;
     \?)
       echo "Invalid option: -$OPTARG" >&2
       usage
@@ -288,6 +334,23 @@ elif [ "$make_MSA" == "false" ] && [ "$make_plot" == "true" ]; then
 	usage
 fi
 
+if [ "$pack_AF2" == "true" ] && [ "$use_multiple_GPUs" == "true" ]; then
+	echo "ERROR: -k and -g options are incompatible (-k already uses all the GPUs)"
+	usage
+elif [ "$pack_AF2" == "true" ] && [ "$alphafold" != "true" ]; then
+	echo "ERROR: -k only possible if -a was passed"
+	usage
+elif [ "$bucket_AF2" == "true" ] && [ "$alphafold" != "true" ]; then
+	echo "ERROR: -b only possible if -a was passed"
+	usage
+elif [ "$bucket_AF2" == "true" ] && [ "$pack_AF2" == "true" ]; then
+	echo "ERROR: -b and -k options are incompatible"
+	usage
+elif [ "$bucket_AF2" == "true" ] && [ "$use_multiple_GPUs" == "true" ]; then
+	echo "ERROR: -b and -g options are incompatible (-g predicts one IDs line at a time)"
+	usage
+fi
+
 # Check MSA methods compatibility
 if [ "$import_MSA" == "true" ] && [ "$make_MSA_greedy" == "true" ]; then
 	echo "ERROR: -i and -M options are incompatible"
@@ -321,6 +384,113 @@ add_time() {
   echo "$output_string"
 }
 
+# Combined length of the complex from the cardinality line of an MSA
+# (e.g. #421,512	1,2 --> 421*1 + 512*2). Prints 0 if the MSA does not exist.
+msa_combined_length() {
+	if a3m_find $1 > /dev/null; then
+		a3m_cat $(a3m_find $1) | head -1 | awk -F '\t' '{gsub("#", "", $1); n = split($1, L, ","); split($2, N, ",");
+			total = 0; for (i = 1; i <= n; i++) total += L[i] * N[i]; print total}'
+	else
+		echo 0
+	fi
+}
+
+# Removes the first line of a queue file and prints it (nothing if it is empty).
+# Several processes can take lines from the same queue at the same time.
+pop_queue_line() {
+	(
+		flock 9
+		head -1 $1
+		sed -i '1d' $1
+	) 9> $1.lock
+}
+
+# Job-state database of the project (see job_db.py). If the script exits with
+# an error (bash -e), the job being computed is recorded as failed.
+job_start() {
+	python $JOB_DB start $1 $2 --pid $$ --output $3
+	current_job="$1 $2"
+}
+job_finish() {
+	python $JOB_DB finish $1 $2 $3
+	current_job=""
+}
+trap 'exit_code=$?; [ -n "$current_job" ] && python $JOB_DB finish $current_job $exit_code' EXIT
+
+# Runs a command recording its wall and CPU time, peak RSS, input sizes and
+# exit code in ./reports/telemetry.jsonl (see telemetry.py):
+#	timed <stage> <paired_name> [--length L] [--a3m MSA] [--output file] -- <command>
+# It only needs the standard library, so Python starts without site-packages.
+timed() {
+	python -S $TELEMETRY run "$@"
+}
+
+# Combined length of IDs from the length index of the database (written by
+# telemetry.py lengths). Prints nothing if an ID is not in the index.
+#	index_combined_length <lengths_index> <ID1> <ID2> ...
+index_combined_length() {
+	local index=$1
+	shift
+	printf '%s\n' "$@" | awk -F '\t' 'NR == FNR {if (!($0 in wanted)) n++; wanted[$0]++; next}
+		FNR > 1 && ($1 in wanted) {total += $2 * wanted[$1]; found++; delete wanted[$1]}
+		END {if (n > 0 && found == n) print total}' - "$index" 2>/dev/null
+}
+
+# Runs a Python helper in the worker of the batch if one is running, with its
+# modules already imported (see discoba_worker.py). Otherwise runs it directly.
+run_helper() {
+	if [ -S "${DISCOBA_WORKER_SOCKET:-}" ]; then
+		python -S $WORKER_SCRIPT run "$@"
+	else
+		python "$@"
+	fi
+}
+
+# Compressed MSAs (<name>.a3m.zst or <name>.a3m.gz, see a3m_utils.py). The
+# stages read an MSA whether it was compressed or not:
+#	a3m_find <name>.a3m		prints the a3m file or its compressed version (returns 1 if none exists)
+#	a3m_cat <a3m_file>		prints the uncompressed content
+#	a3m_plain <a3m_file> <dir>	prints the path of a plain copy written to dir (for colabfold_batch)
+#	a3m_compress <a3m_file>		compresses it with DISCOBA_A3M_COMPRESSION (zst or gz), if it is set
+a3m_find() {
+	local a3m
+	for a3m in "$1" "$1.zst" "$1.gz"; do
+		if [ -f "$a3m" ]; then
+			echo "$a3m"
+			return 0
+		fi
+	done
+	return 1
+}
+a3m_cat() {
+	case "$1" in
+		*.zst) zstd -dcq "$1" ;;
+		*.gz) gzip -dc "$1" ;;
+		*) cat "$1" ;;
+	esac
+}
+a3m_plain() {
+	local plain_a3m=$2/$(basename "${1%.a3m*}").a3m
+	a3m_cat "$1" > "$plain_a3m"
+	echo "$plain_a3m"
+}
+a3m_compress() {
+	if [ -f "$1" ] && [ ! -L "$1" ]; then
+		case "${DISCOBA_A3M_COMPRESSION:-}" in
+			zst) zstd -q -f --rm "$1" ;;
+			gz) gzip -f "$1" ;;
+		esac
+	fi
+}
+
+# Writes the lines of the IDs table not finished in previous runs for the
+# given stages (comma-separated) and prints the name of the file
+pending_IDs_table() {
+	pending_file=./canonical_IDs/$(basename $IDs_table_file)_pending_${1//,/_}
+	python $JOB_DB pending $1 $IDs_table_file $pending_file >&2
+	echo $pending_file
+}
+
 # Assign positional arguments to variables
 database_file=$1
 IDs_table_file=$2
@@ -339,8 +509,51 @@ echo " - RF2    (-r): ${rosettafold}"
 echo " - AF2    (-a): ${alphafold}"
 echo " - Import (-i): $import_MSA" ; [ "$import_MSA" == "true" ] && echo "    path: $merged_msa_path"
 echo " - Sizes  (-s): $sizes" ; [ "$sizes" == "true" ] && echo "    min: $min_size" && echo "    max: $max_size"
+echo " - Pack   (-k): $pack_AF2"
+echo " - Buckets (-b): $bucket_AF2"
+echo " - Searches (-n): $search_jobs"
+echo " - Depth  (-D): ${max_depth:-no limit}"
 echo " - GPUs   (-g): $use_multiple_GPUs"; [ "$use_multiple_GPUs" == "true" ] && echo "    number: $gpus_number"
 
+#####################################################################################
+############################ Canonical order of IDs lines ###########################
+#####################################################################################
+
+# Permutations of the same complex (e.g. A B and B A) are computed once. The
+# permutation names given by the user are linked to the canonical outputs.
+stages_to_link=""
+[ "$make_MSA" == "true" ] && stages_to_link="$stages_to_link --link msa"
+[ "$alphafold" == "true" ] && stages_to_link="$stages_to_link --link af2"
+[ "$rosettafold" == "true" ] && stages_to_link="$stages_to_link --link rf2"
+[ "$import_MSA" == "true" ] && stages_to_link="$stages_to_link --msa-dir $merged_msa_path"
+mkdir -p ./canonical_IDs
+python $RESULT_CACHE canonicalize $IDs_table_file ./canonical_IDs/$(basename $IDs_table_file) $stages_to_link
+IDs_table_file=./canonical_IDs/$(basename $IDs_table_file)
+
+# Prometheus textfile metrics of the batch (see metrics_exporter.py), updated in
+# the background until it finishes. The batches started by this one (GPU workers
+# of -g) are covered by its exporter. DISCOBA_METRICS=0 disables them.
+if [ "${DISCOBA_METRICS:-1}" != "0" ] && [ -z "$DISCOBA_METRICS_EXPORTER" ]; then
+	export DISCOBA_METRICS_EXPORTER=$$
+	mkdir -p ./reports
+	python $METRICS_EXPORTER --table $IDs_table_file --database $database_file --watch-pid $$ \
+		>> ./reports/metrics_exporter.log 2>&1 &
+fi
+
+# Worker running the Python helpers of the IDs lines (pairing, reformat of the
+# MMseqs2 tables and plots) with their modules already imported, so they do not
+# start a new interpreter each time (see discoba_worker.py). Enabled with
+# DISCOBA_WORKER=1. The batches started by this one (GPU workers of -g) use it:
+# it also watches them before this batch exits.
+helper_worker_started=false
+if [ "${DISCOBA_WORKER:-0}" == "1" ] && [ -z "$DISCOBA_WORKER_SOCKET" ]; then
+	export DISCOBA_WORKER_SOCKET=${TMPDIR:-/tmp}/discoba_worker.$$.sock
+	mkdir -p ./reports
+	python $WORKER_SCRIPT serve --socket $DISCOBA_WORKER_SOCKET --watch-pid $$ \
+		>> ./reports/discoba_worker.log 2>&1 &
+	helper_worker_started=true
+fi
+
 #####################################################################################
 #################################### MSA module #####################################
 #####################################################################################
@@ -351,6 +564,33 @@ if [ "$make_MSA" == "true" ]; then
 	echo "---------------------------------------------------------------------------"
 	[ ! -d merged_MSA ] && mkdir merged_MSA		# Output path
 	add_time "Batch generation of MSA..."
+	MSA_IDs_table_file=$(pending_IDs_table msa)
+
+	# Length index of the database (see telemetry.py), read once per batch:
+	# the telemetry of each line gets its combined length from it
+	lengths_index=$(python -S $TELEMETRY lengths $database_file)
+
+	# Run the monomer searches of all the IDs (without duplicates) in parallel.
+	# The loop below will find them done.
+	if [ "$search_jobs" -gt 1 ]; then
+		threads_per_search=$(( $(nproc) / search_jobs ))
+		[ $threads_per_search -lt 1 ] && threads_per_search=1
+		mkdir -p ./reports/mmseqs_searches
+		add_time "Running monomer searches ($search_jobs at the same time, $threads_per_search threads each)..."
+		grep -v "^#" $MSA_IDs_table_file | tr '\t' '\n' | grep -v "^$" | sort -u | \
+			xargs -P $search_jobs -I {} sh -c 'python -S "$4" run search "$3" --database "$2" -- \
+				"$0" -t "$1" "$2" "$3" > ./reports/mmseqs_searches/"$3".log 2>&1' \
+				$RUN_MMSEQS_DISCOBA $threads_per_search $database_file {} $TELEMETRY \
+			|| add_time "WARNING: some monomer searches failed. Logs in ./reports/mmseqs_searches"
+		add_time "Monomer searches complete"
+	fi
+
+	# Fetch the ColabFold MSAs of all the lines concurrently from the MSA server.
+	# The loop below will find them done.
+	add_time "Fetching ColabFold MSAs..."
+	python $COLABFOLD_MSA_CLIENT --table $MSA_IDs_table_file $database_file \
+		|| add_time "WARNING: some ColabFold MSAs failed. They will be fetched again line by line."
+
 	while read line; do
 		
 		# Skip lines that start with '#' (comments)
@@ -380,32 +620,52 @@ if [ "$make_MSA" == "true" ]; then
 		if [ $IDs_number -lt 2 ]; then
 			add_time "	WARNING: At least 2 IDs are requiered. Ignoring IDs line."
 		else
+			job_start msa $paired_name ./merged_MSA/$paired_name.a3m
+			line_length=$(index_combined_length $lengths_index "${IDs_array[@]}")
+			length_option=${line_length:+--length $line_length}
+			length_option=${length_option:---database $database_file}
+
 			# -------------- Get MSAs --------------
 			# DiscobaMSA
+			discoba_a3m=./discoba_paired_unpaired/$paired_name.a3m
 			if [ "${make_MSA_greedy}" == "true" ]; then
-				$GetDiscobaMSA -greedy $database_file "${IDs_array[@]}"
+				timed msa_discoba $paired_name $length_option --a3m $discoba_a3m --output $discoba_a3m -- \
+					$GetDiscobaMSA -greedy $database_file "${IDs_array[@]}"
 			else
-				$GetDiscobaMSA $database_file "${IDs_array[@]}"
+				timed msa_discoba $paired_name $length_option --a3m $discoba_a3m --output $discoba_a3m -- \
+					$GetDiscobaMSA $database_file "${IDs_array[@]}"
 			fi
 			# ColabFoldMSA
-			$GetColabFoldMSA $database_file "${IDs_array[@]}"
+			colabfold_a3m=./colabfold_MSA/$paired_name.a3m
+			timed msa_colabfold $paired_name $length_option --a3m $colabfold_a3m --output $colabfold_a3m -- \
+				$GetColabFoldMSA $database_file "${IDs_array[@]}"
 			
-			# Merge the MSAs
+			# Merge the MSAs (written to a temporary file and renamed when it is
+			# complete, so an interrupted merge never leaves a partial MSA).
+			# Row counts of each source in ./merged_MSA/$paired_name.manifest.tsv
 			add_time "Merging ColabFold and Discoba MSAs..."
-			if [ -f ./merged_MSA/$paired_name.a3m ]; then
+			# The inputs can be compressed (the merged MSA is written plain)
+			colabfold_a3m=$(a3m_find $colabfold_a3m || echo $colabfold_a3m)
+			if a3m_find ./merged_MSA/$paired_name.a3m > /dev/null; then
 				add_time "WARNING: ./merged_MSA/$paired_name.a3m already exists. Merging not performed."
 			elif [ "$is_homooligomer" == "true" ]; then
 				# Use the discoba monomer MSA
-				cat ./colabfold_MSA/$paired_name.a3m > ./merged_MSA/$paired_name.a3m
-				echo "" >> ./merged_MSA/$paired_name.a3m
-				cat ./discoba_mmseqs_alignments/$first_element/$first_element.a3m >> ./merged_MSA/$paired_name.a3m
+				monomer_a3m=./discoba_mmseqs_alignments/$first_element/$first_element.a3m
+				timed msa_merge $paired_name $length_option --a3m ./merged_MSA/$paired_name.a3m -- \
+					python $MERGE_MSA --homooligomer $colabfold_a3m \
+						$(a3m_find $monomer_a3m || echo $monomer_a3m) ./merged_MSA/$paired_name.a3m
 			else
-				# Use the discoba paired+unpaired MSA
-				cat ./colabfold_MSA/$paired_name.a3m > ./merged_MSA/$paired_name.a3m
-				echo "" >> ./merged_MSA/$paired_name.a3m
-				tail -n +2 ./discoba_paired_unpaired/$paired_name.a3m >> ./merged_MSA/$paired_name.a3m
+				# Use the discoba paired+unpaired MSA (without duplicated rows)
+				timed msa_merge $paired_name $length_option --a3m ./merged_MSA/$paired_name.a3m -- \
+					python $MERGE_MSA $max_depth_tag $colabfold_a3m \
+						$(a3m_find $discoba_a3m || echo $discoba_a3m) ./merged_MSA/$paired_name.a3m
 			fi
 			add_time "DONE: output in ./merged_MSA/$paired_name.a3m"
+
+			# The ColabFold and Discoba MSAs of the line are only read by the
+			# merge: compressed with DISCOBA_A3M_COMPRESSION=zst|gz
+			a3m_compress ./colabfold_MSA/$paired_name.a3m
+			a3m_compress $discoba_a3m
 			
 			# Perform plot
 			if [ "$make_plot" = true ]; then
@@ -413,7 +673,7 @@ if [ "$make_MSA" == "true" ]; then
 				output_png="${paired_name}_msa.png"
 				if [ ! -f ./msa_plots/$output_png ]; then
 					add_time "Generating MSA plot $output_png..."
-					python $GENERATE_PLOT ./merged_MSA/$paired_name.a3m
+					run_helper $GENERATE_PLOT $(a3m_find ./merged_MSA/$paired_name.a3m)
 					mv $output_png ./msa_plots
 					add_time "DONE: output in ./msa_plots/$output_png"
 				else
@@ -421,9 +681,10 @@ if [ "$make_MSA" == "true" ]; then
 				fi
 				
 			fi
-					
+
+			job_finish msa $paired_name 0
 		fi
-	done < "$IDs_table_file"
+	done < "$MSA_IDs_table_file"
 fi
 
 # Return IFS to default value
@@ -454,8 +715,54 @@ if [ "$use_multiple_GPUs" == "true" ]; then
 		gpus_number=$((lines_number_in_IDs_file))
 	fi
 
-	# Split IDs_file for parallel process
-	split --numeric-suffixes=1 -n l/$gpus_number $IDs_table_file ./split_IDs/$(basename $IDs_table_file)_temp_
+	# Only the lines not finished in previous runs are queued
+	GPU_stages=$( ([ "$rosettafold" == "true" ] && echo rf2; [ "$alphafold" == "true" ] && echo af2) | paste -sd ,)
+	GPU_IDs_table_file=$IDs_table_file
+	[ -n "$GPU_stages" ] && GPU_IDs_table_file=$(pending_IDs_table $GPU_stages)
+
+	# Shared work queue: IDs lines sorted by combined length (longest first),
+	# taken from the cardinality line of each MSA. Lines without MSA go last.
+	queue_file=./split_IDs/$(basename $IDs_table_file)_queue
+	while read line; do
+		[[ "$line" =~ ^#.*$ || -z "$line" ]] && continue
+		IFS=$'\t' read -r -a IDs_array <<< "$line"
+		IFS=$' \t\n'
+		paired_name=`printf '%s__vs__' "${IDs_array[@]}" | sed 's/__vs__$//'`
+		if [ "$import_MSA" == "true" ]; then
+			msa_file=$merged_msa_path/$paired_name.a3m
+		else
+			msa_file=./merged_MSA/$paired_name.a3m
+		fi
+		printf '%s\t%s\n' "$(msa_combined_length $msa_file)" "$line"
+	done < "$GPU_IDs_table_file" | sort -s -t $'\t' -k1,1nr | cut -f 2- > $queue_file
+	add_time "Work queue with $(wc -l < $queue_file) IDs lines (longest first): $queue_file"
+
+	# Each GPU worker takes the next line of the queue as soon as it finishes
+	# the previous one. RF2-track pairs are queued and predicted at the end
+	# by each worker (RoseTTAFold 2-track loaded once per GPU).
+	gpu_worker() {
+		GPU_index=$1
+		report_file=$2
+		line_file=./split_IDs/$(basename $IDs_table_file)_GPU_${GPU_index}
+		RF2_queue_file=./split_IDs/$(basename $IDs_table_file)_RF2_queue_GPU_${GPU_index}.tsv
+		rm -f $RF2_queue_file
+		[ "$rosettafold" == "true" ] && RF2_queue_tag="-q $RF2_queue_file"
+
+		while true; do
+			line=$(pop_queue_line $queue_file)
+			[ -z "$line" ] && break
+			echo "$line" > $line_file
+			CUDA_VISIBLE_DEVICES=$GPU_index $0 $rosettafold_tag $RF2_queue_tag $alphafold_tag $sizes_tag $AF2_conf_tag $import_MSA_tag $database_file $line_file >> $report_file 2>&1 || \
+				echo "ERROR: failed IDs line: $line" >> $report_file
+		done
+
+		if [ -f "$RF2_queue_file" ]; then
+			CUDA_VISIBLE_DEVICES=$GPU_index $RF2track_run -Q $RF2_queue_file >> $report_file 2>&1
+			python $RESULT_CACHE store-keys ${RF2_queue_file%.tsv}_keys.tsv >> $report_file 2>&1
+		fi
+		rm -f $line_file
+		echo "$(date '+%Y-%m-%d %H:%M:%S') GPU $GPU_index: queue empty, worker finished" >> $report_file
+	}
 
 	# Perform parallel processing in the background	
 	date_to_add=$(date '+%Y%m%d_%H%M%S')
@@ -463,11 +770,23 @@ if [ "$use_multiple_GPUs" == "true" ]; then
 		add_time "Starting to process GPU number: $i"
 		GPU_index=$((i-1))
 		formatted_index=$(printf "%02d" "$i")
-		IDs_table_file_i=./split_IDs/${IDs_table_file}_temp_${formatted_index}
 		report_file_i=./reports/report_${date_to_add}_${formatted_index}.log
-		CUDA_VISIBLE_DEVICES=$GPU_index $0 $rosettafold_tag $alphafold_tag $sizes_tag $AF2_conf_tag $import_MSA_tag $database_file $IDs_table_file_i > $report_file_i 2>&1 &
+		gpu_worker $GPU_index $report_file_i &
+		worker_PIDs+=($!)
 		add_time "PID GPU number $i: $!"
 	done
+
+	# Keep the metrics updated until the GPU workers finish
+	if [ "$DISCOBA_METRICS_EXPORTER" == "$$" ]; then
+		python $METRICS_EXPORTER --table $IDs_table_file --database $database_file --watch-pid ${worker_PIDs[@]} \
+			>> ./reports/metrics_exporter.log 2>&1 &
+	fi
+	
+	# Keep the worker of the helpers running until the GPU workers finish
+	if [ "$helper_worker_started" == "true" ]; then
+		python $WORKER_SCRIPT watch ${worker_PIDs[@]} >> ./reports/discoba_worker.log 2>&1 \
+			|| add_time "WARNING: the worker of the helpers is not running"
+	fi
 	
 	add_time "Parallel processes running on the background..."
 
@@ -478,77 +797,34 @@ fi
 ############################## RoseTTAFold 2-track ##################################
 #####################################################################################
 
-sort_a3m(){
-
-	unsorted_a3m=$1
-	sorted_a3m=$2
-	basename_unsorted_a3m=$(basename $unsorted_a3m .a3m)
-
-	head -n 2 $unsorted_a3m > ${basename_unsorted_a3m}temp_first
-	rest_seqs_fasta=$(tail -n +3 $unsorted_a3m)
-
-	HEADERS=()
-	SEQUENCES=()
-	SCORES=()
-
-	while read -r line1 && read -r line2; do
-
-		# Header and sequence
-		header=$line1
-		sequence=$line2
-		echo "$header" > ${basename_unsorted_a3m}temp_second
-		echo "$sequence" >> ${basename_unsorted_a3m}temp_second
-
-		# Calculate global alignment
-		needle -asequence ${basename_unsorted_a3m}temp_first -bsequence ${basename_unsorted_a3m}temp_second -gapopen 10.0 -gapextend 0.5 -outfile ${basename_unsorted_a3m}temp_global &> /dev/null
-
-		# Extract score
-		score=$(grep "Score:" ${basename_unsorted_a3m}temp_global)
-		score=${score##*" "}
-
-		HEADERS+=($header)
-		SEQUENCES+=($sequence)
-		SCORES+=($score)
-
-	done <<< "$rest_seqs_fasta"
-
-	# Combine the arrays into a single file
-	paste <(printf '%s\n' "${HEADERS[@]}") \
-	      <(printf '%s\n' "${SEQUENCES[@]}") \
-	      <(printf '%s\n' "${SCORES[@]}") \
-	      > ${basename_unsorted_a3m}temp.txt
-
-	# Sort the file based on the third column (the scores)
-	sort -rn -k3 ${basename_unsorted_a3m}temp.txt > ${basename_unsorted_a3m}sorted.txt
-
-	# Extract the sorted arrays
-	HEADERS_sorted=($(cut -f1 ${basename_unsorted_a3m}sorted.txt))
-	SEQUENCES_sorted=($(cut -f2 ${basename_unsorted_a3m}sorted.txt))
-	SCORES_sorted=($(cut -f3 ${basename_unsorted_a3m}sorted.txt))
-
-	# Remove the temporary files
-	rm ${basename_unsorted_a3m}temp.txt ${basename_unsorted_a3m}sorted.txt ${basename_unsorted_a3m}temp_first ${basename_unsorted_a3m}temp_second ${basename_unsorted_a3m}temp_global
-
-	# Write sorted a3m
-	head -n 2 $unsorted_a3m > $sorted_a3m
-	for i in "${!SCORES_sorted[@]}"; do
-		if [ "${HEADERS_sorted[$i]}" == "^>"* ]; then
-			echo "${HEADERS_sorted[$i]}" >> $sorted_a3m
-		else
-			echo ">${HEADERS_sorted[$i]}" >> $sorted_a3m
-		fi
-		echo "${SEQUENCES_sorted[$i]}" >> $sorted_a3m
-#		echo "${SCORES_sorted[$i]}"
-	done
-}
-
-
-
 if [ "$rosettafold" == "true" ]; then
 	echo ""
 	echo "---------------------------------------------------------------------------"
 	add_time "Batch generation of RoseTTAFold 2-track contact maps..."
 
+	# Pairs are preprocessed one by one and predicted together at the end
+	# (RoseTTAFold 2-track is loaded only once)
+	if [ "$RF2track_queue_file" != "" ]; then
+		RF2track_queue=$RF2track_queue_file
+	else
+		RF2track_queue=./RoseTTAFold_2track_queue_$(basename $IDs_table_file).tsv
+		rm -f $RF2track_queue
+	fi
+	RF2_IDs_table_file=$(pending_IDs_table rf2)
+
+	# Options of the RF2-track preprocessing. They are part of the result
+	# cache key with the GPU memory, which decides the device and the depth
+	# to which the MSA is cropped (see RoseTTAFold_2track_batch.py)
+	RF2_options="-us -t 30 -b 12"
+	if [ -n "$RF2_GPU_GB" ]; then
+		RF2_GPU_memory=${RF2_GPU_GB}GB
+	else
+		RF2_GPU_index=${CUDA_VISIBLE_DEVICES:-0}
+		RF2_GPU_memory=$(nvidia-smi --query-gpu=memory.total --format=csv,noheader,nounits \
+			-i ${RF2_GPU_index%%,*} 2>/dev/null | head -1)MiB
+	fi
+	RF2_cache_options="$RF2_options gpu_memory=$RF2_GPU_memory"
+
 	# Scan IDs_file one line at a time
 	while read line; do
 		
@@ -567,18 +843,20 @@ if [ "$rosettafold" == "true" ]; then
 		# Select were to find MSAs
 		if [ "$import_MSA" == "true" ]; then
 			input_a3m_file=$merged_msa_path/$paired_name.a3m
-			if [ ! -f "$input_a3m_file" ]; then
+			if ! a3m_find $input_a3m_file > /dev/null; then
 				echo "ERROR: $input_a3m_file is missing in custom MSA database"
 				usage
 			fi
 		else
 			input_a3m_file=./merged_MSA/$paired_name.a3m
 		fi
+		input_a3m_file=$(a3m_find $input_a3m_file || echo $input_a3m_file)
 		
 		# Check if prediction was already performed
 		if [ -d "./RoseTTAFold_2track_results/$paired_name/" ]; then
 			add_time "RF2-track prediction for $paired_name already performed"
 			add_time "Ignoring line"
+			python $JOB_DB finish rf2 $paired_name 0
 			continue	
 		fi
 
@@ -598,6 +876,7 @@ if [ "$rosettafold" == "true" ]; then
 			add_time "WARNING: Only HETERO-dimers can be parsed"
 			add_time "WARNING: Ignoring IDs line. Saved in ./ignored.txt"
 			echo "ignored:RF-2track	reason:is_homooligomer	msa_file:$input_a3m_file" >> ignored.txt
+			python $JOB_DB skip rf2 $paired_name is_homooligomer
 
 		# If it has more than 2 proteins: ignore it (only pairwise comparisons)
 		elif [ $IDs_number -ne 2 ]; then
@@ -605,12 +884,13 @@ if [ "$rosettafold" == "true" ]; then
 			add_time "WARNING: Instead, $IDs_number IDs are in the line"
 			add_time "WARNING: Ignoring IDs line. Saved in ./ignored.txt"
 			echo "ignored:RF-2track	reason:proteins>2	msa_file:$input_a3m_file" >> ignored.txt
+			python $JOB_DB skip rf2 $paired_name "proteins>2"
 
 		# If it is a heterodimer: check size and compute coevolution
 		else
 			# Check combined size
-			L1=`head -1 $input_a3m_file | cut -d "#" -f 2 | cut -d "," -f 1`
-			L2=`head -1 $input_a3m_file | cut -d "#" -f 2 | cut -d "," -f 2 | cut -d $'\t' -f 1`
+			L1=`a3m_cat $input_a3m_file | head -1 | cut -d "#" -f 2 | cut -d "," -f 1`
+			L2=`a3m_cat $input_a3m_file | head -1 | cut -d "#" -f 2 | cut -d "," -f 2 | cut -d $'\t' -f 1`
 			combined_L=$(( L1 + L2 ))
 
 			# If size is outside range, ignore it
@@ -619,21 +899,41 @@ if [ "$rosettafold" == "true" ]; then
 					add_time "WARNING: $paired_name is smaller than $min_size"
 					add_time "WARNING: ignoring it. Saved in ./ignored.txt"
 					echo "ignored:RF-2track	reason:combined_size($combined_L)<min_size($min_size)	msa_file:$input_a3m_file" >> ignored.txt
+					python $JOB_DB skip rf2 $paired_name "combined_size($combined_L)<min_size($min_size)"
 					continue
 				elif [ "$combined_L" -gt "$max_size" ]; then
 					add_time "WARNING: $paired_name is bigger than $max_size"
 					add_time "WARNING: ignoring it. Saved in ./ignored.txt"
 					echo "ignored:RF-2track	reason:combined_size($combined_L)>max_size($max_size)	msa_file:$input_a3m_file" >> ignored.txt
+					python $JOB_DB skip rf2 $paired_name "combined_size($combined_L)>max_size($max_size)"
 					continue
 				fi
 			fi
 	
+			# Look for an equivalent prediction in the result cache
+			RF2_key=$(python $RESULT_CACHE key RF2 $database_file $input_a3m_file --options "$RF2_cache_options" "${IDs_array[@]}")
+			if python $RESULT_CACHE fetch $RF2_key ./RoseTTAFold_2track_results/$paired_name; then
+				add_time "RF2-track prediction for $paired_name found in result cache"
+				python $JOB_DB finish rf2 $paired_name 0
+				continue
+			fi
+
 			# Extract coevolution with RF 2-track
 			add_time "ROSETTAFOLD 2-track: $input_a3m_file"
 			[ -f $input_a3m_file ] && echo "File exists"
-			$RF2track_run -us -f $input_a3m_file
+			$RF2track_run $RF2_options -q $RF2track_queue -f $input_a3m_file
+			python $JOB_DB queue rf2 $paired_name --pid $$ --output ./RoseTTAFold_2track_results/$paired_name
+			printf '%s\t%s\t%s\n' $RF2_key ./RoseTTAFold_2track_results/$paired_name "*.metrics" >> ${RF2track_queue%.tsv}_keys.tsv
 		fi
-	done < "$IDs_table_file"
+	done < "$RF2_IDs_table_file"
+
+	# Predict all the queued pairs (unless the queue was given with -q)
+	if [ "$RF2track_queue_file" == "" ] && [ -f "$RF2track_queue" ]; then
+		echo ""
+		add_time "ROSETTAFOLD 2-track: predicting queued pairs..."
+		timed rf2_batch $(basename $RF2track_queue .tsv) -- $RF2track_run -Q $RF2track_queue
+		python $RESULT_CACHE store-keys ${RF2track_queue%.tsv}_keys.tsv
+	fi
 
 fi
 
@@ -663,6 +963,19 @@ if [ "$alphafold" == "true" ]; then
 	add_time "Batch generation of AF2 models..."
 	[ ! -d ./AF2 ] && mkdir ./AF2/ || add_time "AF2 directory already exist. Continuing."
 
+	# With -k the predictions are collected and run at the end packed on the GPUs.
+	# With -b they are collected and run at the end in length buckets.
+	if [ "$pack_AF2" == "true" ]; then
+		[ ! -d ./reports ] && mkdir ./reports/
+		AF2_jobs_file=./reports/AF2_packing_jobs_$(basename $IDs_table_file).tsv
+		rm -f $AF2_jobs_file
+	elif [ "$bucket_AF2" == "true" ]; then
+		[ ! -d ./reports ] && mkdir ./reports/
+		AF2_jobs_file=./reports/AF2_buckets_jobs_$(basename $IDs_table_file).tsv
+		rm -f $AF2_jobs_file
+	fi
+	AF2_IDs_table_file=$(pending_IDs_table af2)
+
 	# Scan IDs_file one line at a time
 	while read line; do
 
@@ -682,13 +995,14 @@ if [ "$alphafold" == "true" ]; then
 		if [ "$import_MSA" == "true" ]; then
 			input_a3m_file=$merged_msa_path/$paired_name.a3m
 			add_time "Using precomputed MSA"
-			if [ ! -f "$input_a3m_file" ]; then
+			if ! a3m_find $input_a3m_file > /dev/null; then
 				add_time "ERROR: $input_a3m_file is missing in custom MSA database"
 				usage
 			fi
 		else
 			input_a3m_file=./merged_MSA/$paired_name.a3m
 		fi
+		input_a3m_file=$(a3m_find $input_a3m_file || echo $input_a3m_file)
 		
 		# dir to store AF2 models
 		output_dir_AF2=./AF2/$paired_name/
@@ -704,7 +1018,7 @@ if [ "$alphafold" == "true" ]; then
 		done
 
 		# Check combined size
-		string=$(head -1 $input_a3m_file)
+		string=$(a3m_cat $input_a3m_file | head -1)
 		list1=$(echo "$string" | awk -F'\t' '{print $1}')
 		list2=$(echo "$string" | awk -F'\t' '{print $2}')
 		list1_arr=($(echo "${list1//\#/}" | tr ',' ' '))
@@ -722,12 +1036,14 @@ if [ "$alphafold" == "true" ]; then
 				add_time "WARNING: length smaller than $min_size. Ignoring it"
 				add_time "WARNING: ignored a3m file stored in ./ignored.txt"
 				echo "ignored:AF2	reason:combined_size($combined_L)<min_size($min_size)	msa_file:$input_a3m_file" >> ignored.txt
+				python $JOB_DB skip af2 $paired_name "combined_size($combined_L)<min_size($min_size)"
 				continue
 			elif [ "$combined_L" -gt "$max_size" ]; then
 				add_time "WARNING: $paired_name combined length is $combined_L"
 				add_time "WARNING: length bigger than $max_size. Ignoring it"
 				add_time "WARNING: ignored a3m file stored in ./ignored.txt"
 				echo "ignored:AF2	reason:combined_size($combined_L)>max_size($max_size)	msa_file:$input_a3m_file" >> ignored.txt
+				python $JOB_DB skip af2 $paired_name "combined_size($combined_L)>max_size($max_size)"
 				continue
 			fi
 		fi
@@ -745,15 +1061,58 @@ if [ "$alphafold" == "true" ]; then
 			# Use AF2.conf file as configurations
 			echo "AF2 with config file: $AF2_conf_file"
 			echo "Options: $options"
-			colabfold_batch $options $input_a3m_file $output_dir_AF2
-			
 		else 
 			# Use default configuration
+			options="--num-models 5 --num-recycle 10 --rank iptm --stop-at-score 80 --recycle-early-stop-tolerance 1.5 --num-relax 1 --use-gpu-relax"
 			echo "AF2 without config"
-			echo "Options: --num-models 5 --num-recycle 10 --rank iptm --stop-at-score 80 --recycle-early-stop-tolerance 1.5 --num-relax 1 --use-gpu-relax"
-			colabfold_batch --num-models 5 --num-recycle 10 --rank iptm --stop-at-score 80 --recycle-early-stop-tolerance 1.5 --num-relax 1 --use-gpu-relax $input_a3m_file ./AF2/$paired_name
+			echo "Options: $options"
+		fi
+
+		# Look for an equivalent prediction in the result cache
+		AF2_key=$(python $RESULT_CACHE key AF2 $database_file $input_a3m_file --options "$options" "${IDs_array[@]}")
+		if python $RESULT_CACHE fetch $AF2_key $output_dir_AF2; then
+			add_time "AF2 prediction for $paired_name found in result cache"
+			python $JOB_DB finish af2 $paired_name 0
+			continue
+		fi
+
+		if [ "$pack_AF2" == "true" ] || [ "$bucket_AF2" == "true" ]; then
+			printf '%s\t%s\t%s\n' $input_a3m_file $output_dir_AF2 $combined_L >> $AF2_jobs_file
+			printf '%s\t%s\t%s\n' $AF2_key $output_dir_AF2 "*.done.txt" >> ${AF2_jobs_file%.tsv}_keys.tsv
+			python $JOB_DB queue af2 $paired_name --pid $$ --output $output_dir_AF2
+			add_time "AF2 prediction added to the queue (combined length: $combined_L)"
+		else
+			job_start af2 $paired_name $output_dir_AF2
+			# colabfold_batch reads plain MSAs: temporary copy of a compressed one
+			AF2_input=$input_a3m_file
+			if [[ "$input_a3m_file" == *.zst || "$input_a3m_file" == *.gz ]]; then
+				mkdir -p ./AF2
+				AF2_input=$(a3m_plain $input_a3m_file $(mktemp -d ./AF2/.plain_XXXXXX))
+			fi
+			timed af2 $paired_name --length $combined_L --a3m $input_a3m_file -- \
+				colabfold_batch $options $AF2_input $output_dir_AF2
+			if [ "$AF2_input" != "$input_a3m_file" ]; then
+				rm -rf $(dirname $AF2_input)
+			fi
+			job_finish af2 $paired_name 0
+			python $RESULT_CACHE store $AF2_key $output_dir_AF2 --require "*.done.txt" || true
 		fi
-	done < "$IDs_table_file"
+	done < "$AF2_IDs_table_file"
+
+	# Run the collected predictions packed on the GPUs or in length buckets
+	if [ -n "$AF2_jobs_file" ] && [ -f "$AF2_jobs_file" ]; then
+		if [ "$pack_AF2" == "true" ]; then
+			add_time "Running AF2 predictions packed on the GPUs (logs in ./reports/AF2_packing)..."
+			python $GPU_PACKING $AF2_jobs_file $options || add_time "WARNING: some AF2 predictions failed"
+		else
+			add_time "Running AF2 predictions in length buckets (logs in ./reports/AF2_buckets)..."
+			python $AF2_BUCKETS $AF2_jobs_file $options || add_time "WARNING: some AF2 predictions failed"
+		fi
+		while IFS=$'\t' read -r job_a3m job_output_dir job_L; do
+			python $JOB_DB check af2 $(basename $job_output_dir) "$job_output_dir/*.done.txt" || true
+		done < $AF2_jobs_file
+		python $RESULT_CACHE store-keys ${AF2_jobs_file%.tsv}_keys.tsv
+	fi
 fi
 
 add_time "discoba-multimer-batch FINISHED"
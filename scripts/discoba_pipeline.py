@@ -0,0 +1,439 @@
+# -*- coding: utf-8 -*-
+"""
+Pipelined version of discoba-multimer_batch.sh.
+
+discoba-multimer_batch.sh runs one stage at a time over the whole IDs table
+(all the MSAs, then RF2-track, then AF2), so the GPU is idle while the MSAs
+are built and the CPUs are idle while AF2 runs. Here each line of the IDs
+table is a small dependency graph:
+
+    monomer search (one per ID) --> pairing --+
+                                              +--> merge --> plot
+    ColabFold MSA --------------------------+          |--> RF2-track
+                                                       +--> AF2 (after RF2-track is queued)
+
+and the tasks of all the lines are run by separate worker pools (lanes), so
+AF2 starts on the first merged MSA while the next MSAs are still being built:
+
+    mmseqs     monomer searches (-n at the same time, sharing the cores)
+    colabfold  ColabFold MSA server queries
+    cpu        pairing, merge, plot and RF2-track preprocessing
+    gpu        AF2 and RF2-track predictions (one worker per GPU)
+
+Each task calls the same scripts used by discoba-multimer_batch.sh (with a
+one-line IDs table), so the output layout is the same. RF2-track pairs are
+queued and predicted in batches (the network is loaded once per batch)
+whenever a GPU is free and no AF2 task is waiting. The output of each task is
+stored in ./reports/pipeline/ and a line is printed when a task starts and
+finishes. If a task fails, the tasks that depend on it are skipped.
+"""
+
+import sys
+import os
+import argparse
+import subprocess
+import time
+import shutil
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from telemetry import telemetry_command, combined_length
+
+# DEPENDENCIES ----------------------------------------------------------------
+if "DiscobaMultimerPath" not in os.environ:
+    print("ERROR: DiscobaMultimerPath not found. Install it using installation script. Aborting.",
+          file=sys.stderr)
+    sys.exit(1)
+SCRIPTS = os.path.join(os.environ["DiscobaMultimerPath"], "scripts")
+BATCH = os.path.join(SCRIPTS, "discoba-multimer_batch.sh")
+RUN_MMSEQS_DISCOBA = os.path.join(SCRIPTS, "run_MMseqs2_to_get_DiscobaMSA_3.0.sh")
+GET_DISCOBA_MSA = os.path.join(SCRIPTS, "get_Discoba_MSA.sh")
+GET_COLABFOLD_MSA = os.path.join(SCRIPTS, "get_ColabFold_MSA.sh")
+GENERATE_PLOT = os.path.join(SCRIPTS, "plot_msa.py")
+RF2TRACK_RUN = os.path.join(SCRIPTS, "RoseTTAFold_2track_run.sh")
+RESULT_CACHE = os.path.join(SCRIPTS, "result_cache.py")
+METRICS_EXPORTER = os.path.join(SCRIPTS, "metrics_exporter.py")
+WORKER_SCRIPT = os.path.join(SCRIPTS, "discoba_worker.py")
+# -----------------------------------------------------------------------------
+
+# Directories (relative to the working directory)
+REPORTS_DIR = "./reports/pipeline"
+LINES_DIR = "./reports/pipeline/IDs_lines"
+RF2_QUEUE = "./RoseTTAFold_2track_queue_pipeline.tsv"
+
+
+def add_time(message):
+    print(time.strftime("%Y-%m-%d %H:%M:%S"), message, flush=True)
+
+
+###############################################################################
+################################# Scheduler ###################################
+###############################################################################
+
+class Task:
+    """
+    A command of the pipeline.
+
+    Parameters
+    ----------
+    name : str
+        Unique name of the task (also used for its log file).
+    lane : str
+        Worker pool that runs the task.
+    command : list of str
+        Command to run.
+    dependencies : list of Task
+        Tasks that must finish successfully before this one starts.
+    order : int
+        Priority inside the lane (lower first). Tasks of the first lines of
+        the IDs table go first.
+
+    """
+
+    def __init__(self, name, lane, command, dependencies=(), order=0):
+        self.name = name
+        self.lane = lane
+        self.command = command
+        self.dependencies = list(dependencies)
+        self.order = order
+        self.state = "pending"      # pending, running, done, failed, skipped
+
+
+class Scheduler:
+    """
+    Runs tasks as soon as their dependencies are done, with a fixed number
+    of workers per lane. Each worker of the "gpu" lane owns a GPU index that
+    is passed to its tasks as CUDA_VISIBLE_DEVICES.
+
+    idle_callback(lane) is called when a lane has free workers and no ready
+    task. It can return a new Task to run (or None).
+    """
+
+    def __init__(self, lanes, gpu_ids=(), idle_callback=None):
+        self.lanes = lanes
+        self.free_gpus = list(gpu_ids)
+        self.idle_callback = idle_callback
+        self.tasks = []
+        self.running = {}       # future -> (task, gpu_id)
+        self.executor = ThreadPoolExecutor(max_workers=sum(lanes.values()))
+
+    def add(self, task):
+        self.tasks.append(task)
+        return task
+
+    def running_in_lane(self, lane):
+        return sum(1 for task, _ in self.running.values() if task.lane == lane)
+
+    def _update_skipped(self):
+        changed = True
+        while changed:
+            changed = False
+            for task in self.tasks:
+                if task.state == "pending" and any(dep.state in ("failed", "skipped")
+                                                   for dep in task.dependencies):
+                    task.state = "skipped"
+                    add_time(f"SKIPPED {task.name} (a dependency failed)")
+                    changed = True
+
+    def _ready(self, lane):
+        ready = [task for task in self.tasks
+                 if task.state == "pending" and task.lane == lane
+                 and all(dep.state == "done" for dep in task.dependencies)]
+        return sorted(ready, key=lambda task: task.order)
+
+    def _launch(self, task):
+        gpu_id = self.free_gpus.pop(0) if task.lane == "gpu" else None
+        task.state = "running"
+        add_time(f"START   {task.name}" + (f" (GPU {gpu_id})" if gpu_id is not None else ""))
+        future = self.executor.submit(run_command, task, gpu_id)
+        self.running[future] = (task, gpu_id)
+
+    def run(self):
+        """
+        Runs all the tasks. Returns the number of failed tasks.
+        """
+        while True:
+            self._update_skipped()
+            for lane, workers in self.lanes.items():
+                free_workers = workers - self.running_in_lane(lane)
+                ready = self._ready(lane)
+                for task in ready[:free_workers]:
+                    self._launch(task)
+                if free_workers > len(ready) and self.idle_callback is not None:
+                    task = self.idle_callback(lane)
+                    if task is not None:
+                        self.add(task)
+                        self._launch(task)
+
+            if not self.running:
+                break
+
+            finished, _ = wait(list(self.running), return_when=FIRST_COMPLETED)
+            for future in finished:
+                task, gpu_id = self.running.pop(future)
+                if gpu_id is not None:
+                    self.free_gpus.append(gpu_id)
+                try:
+                    task.state = "done" if future.result() == 0 else "failed"
+                except Exception as error:
+                    task.state = "failed"
+                    add_time(f"ERROR: {task.name} could not be run: {error}")
+                add_time(f"{task.state.upper():7} {task.name}")
+
+        self.executor.shutdown()
+        return sum(1 for task in self.tasks if task.state == "failed")
+
+
+def run_command(task, gpu_id=None):
+    """
+    Runs the command of a task storing its output in REPORTS_DIR.
+    Returns the exit code.
+    """
+    environment = dict(os.environ)
+    if gpu_id is not None:
+        environment["CUDA_VISIBLE_DEVICES"] = str(gpu_id)
+    with open(os.path.join(REPORTS_DIR, f"{task.name}.log"), "w") as log:
+        return subprocess.run(task.command, stdout=log, stderr=subprocess.STDOUT,
+                              stdin=subprocess.DEVNULL, env=environment).returncode
+
+
+###############################################################################
+################################# Pipeline ####################################
+###############################################################################
+
+def read_IDs_table(IDs_table_file):
+    """
+    Returns the lines of the IDs table as lists of IDs (comments and lines
+    with less than 2 IDs are ignored, like in discoba-multimer_batch.sh).
+    """
+    lines = []
+    with open(IDs_table_file) as IDs_table:
+        for line in IDs_table:
+            if line.startswith("#") or not line.strip():
+                continue
+            IDs = line.rstrip("\n").split("\t")
+            if len(IDs) < 2:
+                add_time(f"WARNING: At least 2 IDs are requiered. Ignoring IDs line: {line.strip()}")
+                continue
+            lines.append(IDs)
+    return lines
+
+
+def write_line_file(IDs):
+    """
+    Writes a one-line IDs table to pass a single line to
+    discoba-multimer_batch.sh. Returns its path.
+    """
+    line_file = os.path.join(LINES_DIR, "__vs__".join(IDs) + ".txt")
+    with open(line_file, "w") as line:
+        line.write("\t".join(IDs) + "\n")
+    return line_file
+
+
+class RF2Batcher:
+    """
+    Creates the RF2-track prediction tasks. The queued pairs are predicted
+    only when a GPU is free, no AF2 task is ready and no pair is being
+    added to the queue.
+    """
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.batches = 0
+
+    def __call__(self, lane):
+        if lane != "gpu" or not os.path.isfile(RF2_QUEUE) or os.path.getsize(RF2_QUEUE) == 0:
+            return None
+        if any(task.lane == "cpu" and task.name.endswith(".rf2_queue")
+               for task, _ in self.scheduler.running.values()):
+            return None
+
+        self.batches += 1
+        batch_queue = RF2_QUEUE.replace(".tsv", f"_{self.batches}.tsv")
+        os.replace(RF2_QUEUE, batch_queue)
+        # Result cache keys of the queued pairs (stored once they are predicted)
+        batch_keys = batch_queue.replace(".tsv", "_keys.tsv")
+        if os.path.isfile(RF2_QUEUE.replace(".tsv", "_keys.tsv")):
+            os.replace(RF2_QUEUE.replace(".tsv", "_keys.tsv"), batch_keys)
+        return Task(f"RoseTTAFold_2track_batch_{self.batches}.rf2", "gpu",
+                    ["bash", "-c", f"{RF2TRACK_RUN} -Q {batch_queue} && "
+                                   f"python {RESULT_CACHE} store-keys {batch_keys}"])
+
+
+def build_pipeline(scheduler, args):
+    """
+    Adds the tasks of every line of the IDs table to the scheduler.
+    """
+    batch_options = []
+    if args.s:
+        batch_options += ["-s", args.s]
+    if args.i:
+        batch_options += ["-i", args.i]
+    msa_option = "-M" if args.M else "-m"
+    threads_per_search = max(1, (os.cpu_count() or 1) // args.n)
+
+    searches = {}
+    for order, IDs in enumerate(read_IDs_table(args.IDs_table)):
+        paired_name = "__vs__".join(IDs)
+        line_file = write_line_file(IDs)
+        merged = []
+
+        if args.m or args.M:
+            # Lengths for the telemetry (from the length index of the database)
+            combined_L = combined_length(args.database, paired_name)
+            # Monomer searches are shared by all the lines with the same ID
+            for ID in IDs:
+                if ID not in searches:
+                    searches[ID] = scheduler.add(Task(
+                        f"{ID}.search", "mmseqs",
+                        telemetry_command("search", ID, [RUN_MMSEQS_DISCOBA, "-t", str(threads_per_search),
+                                                         args.database, ID],
+                                          length=combined_length(args.database, ID)),
+                        order=order))
+            discoba_a3m = f"./discoba_paired_unpaired/{paired_name}.a3m"
+            pairing = scheduler.add(Task(
+                f"{paired_name}.pairing", "cpu",
+                telemetry_command("msa_discoba", paired_name,
+                                  [GET_DISCOBA_MSA] + (["-greedy"] if args.M else []) + [args.database] + IDs,
+                                  a3m_file=discoba_a3m, output=discoba_a3m,
+                                  length=combined_L),
+                [searches[ID] for ID in IDs], order))
+            colabfold_a3m = f"./colabfold_MSA/{paired_name}.a3m"
+            colabfold = scheduler.add(Task(
+                f"{paired_name}.colabfold", "colabfold",
+                telemetry_command("msa_colabfold", paired_name, [GET_COLABFOLD_MSA, args.database] + IDs,
+                                  a3m_file=colabfold_a3m, output=colabfold_a3m,
+                                  length=combined_L),
+                order=order))
+            merged = [scheduler.add(Task(
+                f"{paired_name}.merge", "cpu",
+                [BATCH, msa_option] + (["-D", str(args.D)] if args.D else []) + [args.database, line_file],
+                [pairing, colabfold], order))]
+
+            if args.p:
+                # The plot is run in the worker of the helpers if there is one
+                python = f"python -S {WORKER_SCRIPT} run" if os.environ.get("DISCOBA_WORKER_SOCKET") else "python"
+                scheduler.add(Task(
+                    f"{paired_name}.plot", "cpu",
+                    ["bash", "-c", f'mkdir -p ./msa_plots && [ -f ./msa_plots/{paired_name}_msa.png ] || '
+                                   f'({python} {GENERATE_PLOT} ./merged_MSA/{paired_name}.a3m && '
+                                   f'mv {paired_name}_msa.png ./msa_plots)'],
+                    merged, order))
+
+        rf2_queue = []
+        if args.r:
+            rf2_queue = [scheduler.add(Task(
+                f"{paired_name}.rf2_queue", "cpu",
+                [BATCH, "-r", "-q", RF2_QUEUE] + batch_options + [args.database, line_file],
+                merged, order))]
+
+        if args.a:
+            # After the RF2-track queueing of the line: both run the batch on the
+            # same line file (canonical IDs table and job records of the line)
+            scheduler.add(Task(
+                f"{paired_name}.af2", "gpu",
+                [BATCH, "-a"] + (["-c", args.c] if args.c else []) + batch_options
+                + [args.database, line_file],
+                merged + rf2_queue, order))
+
+
+def count_GPUs():
+    nvidia_smi = os.environ.get("NVIDIA_SMI", "nvidia-smi")
+    if shutil.which(nvidia_smi) is None:
+        return 0
+    output = subprocess.run([nvidia_smi, "--query-gpu=name", "--format=csv,noheader"],
+                            capture_output=True, text=True).stdout
+    return len([line for line in output.splitlines() if line.strip()])
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description="Runs the stages of discoba-multimer_batch.sh as a pipeline "
+                    "(AF2 starts while the next MSAs are still being built).")
+    parser.add_argument("database", help="protein database (only ID headers)")
+    parser.add_argument("IDs_table", help="list of IDs to generate the paired+unpaired MSAs (.tsv)")
+    parser.add_argument("-m", action="store_true", help="computes MSAs (stringent mode)")
+    parser.add_argument("-M", action="store_true", help="computes MSAs (greedy mode - RECOMMENDED)")
+    parser.add_argument("-p", action="store_true", help="performs MSA plots")
+    parser.add_argument("-r", action="store_true", help="runs RoseTTAFold 2-track")
+    parser.add_argument("-a", action="store_true", help="runs AlphaFold2-multimer")
+    parser.add_argument("-c", metavar="AF2.conf", help="path to custom AF2 configuration file")
+    parser.add_argument("-i", metavar="MSAs_path", help="path to custom MSAs (a3m format with cardinality)")
+    parser.add_argument("-s", metavar="MIN_MAX", help="minimum and maximum sizes to compute with RF and AF2")
+    parser.add_argument("-g", type=int, metavar="GPUs",
+                        help="GPUs to use (default: all the GPUs, or 1 if they cannot be detected)")
+    parser.add_argument("-D", type=int, metavar="depth",
+                        help="maximum number of sequences of the merged MSAs (paired ones are kept first)")
+    parser.add_argument("-n", type=int, default=1, metavar="searches",
+                        help="monomer searches to run at the same time (default 1)")
+    parser.add_argument("-j", type=int, default=4, metavar="CPU_workers",
+                        help="tasks to run at the same time in the CPU lane (default 4)")
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.database):
+        parser.error(f"database argument {args.database} is not a file")
+    if not os.path.isfile(args.IDs_table):
+        parser.error(f"IDs_table argument {args.IDs_table} is not a file")
+    if args.i and (args.m or args.M):
+        parser.error("-i and -m/-M options are incompatible")
+    if args.p and not (args.m or args.M):
+        parser.error("-p only possible if -m/-M was passed")
+    if args.c and not args.a:
+        parser.error(f"AF2.conf file (-c {args.c}) given without calling -a")
+    if args.g is not None and args.g < 1:
+        parser.error("-g argument must be a positive integer")
+    if args.j < 1 or args.n < 1:
+        parser.error("-j and -n arguments must be positive integers")
+    if args.D is not None and (args.D < 1 or not (args.m or args.M)):
+        parser.error("-D must be a positive integer and it is only possible with -m/-M")
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    available_GPUs = count_GPUs() or 1
+    GPUs = min(args.g, available_GPUs) if args.g else available_GPUs
+    lanes = {"mmseqs": args.n, "colabfold": 1, "cpu": args.j, "gpu": GPUs}
+
+    os.makedirs(LINES_DIR, exist_ok=True)
+    if (args.m or args.M) and not os.path.isdir("./merged_MSA"):
+        os.mkdir("./merged_MSA")
+
+    # Permutations of the same complex are computed once (see result_cache.py)
+    stages = (["--link", "msa"] if args.m or args.M else []) + (["--link", "rf2"] if args.r else []) \
+        + (["--link", "af2"] if args.a else []) + (["--msa-dir", args.i] if args.i else [])
+    os.makedirs("./canonical_IDs", exist_ok=True)
+    canonical_table = os.path.join("./canonical_IDs", os.path.basename(args.IDs_table))
+    subprocess.run([sys.executable, RESULT_CACHE, "canonicalize", args.IDs_table, canonical_table] + stages,
+                   check=True)
+    args.IDs_table = canonical_table
+
+    # Prometheus textfile metrics, updated until the pipeline finishes (the
+    # batches run by the tasks do not start their own exporter)
+    if os.environ.get("DISCOBA_METRICS", "1") != "0" and "DISCOBA_METRICS_EXPORTER" not in os.environ:
+        os.environ["DISCOBA_METRICS_EXPORTER"] = str(os.getpid())
+        os.makedirs("./reports", exist_ok=True)
+        with open("./reports/metrics_exporter.log", "a") as exporter_log:
+            subprocess.Popen([sys.executable, METRICS_EXPORTER, "--table", args.IDs_table,
+                              "--database", args.database, "--watch-pid", str(os.getpid())],
+                             stdout=exporter_log, stderr=subprocess.STDOUT)
+
+    # Worker running the Python helpers of the tasks (see discoba_worker.py)
+    if os.environ.get("DISCOBA_WORKER", "0") == "1" and "DISCOBA_WORKER_SOCKET" not in os.environ:
+        os.environ["DISCOBA_WORKER_SOCKET"] = os.path.join(os.environ.get("TMPDIR", "/tmp"),
+                                                           f"discoba_worker.{os.getpid()}.sock")
+        os.makedirs("./reports", exist_ok=True)
+        with open("./reports/discoba_worker.log", "a") as worker_log:
+            subprocess.Popen([sys.executable, WORKER_SCRIPT, "serve", "--socket", os.environ["DISCOBA_WORKER_SOCKET"],
+                              "--watch-pid", str(os.getpid())],
+                             stdout=worker_log, stderr=subprocess.STDOUT)
+
+    add_time("STARTING pipeline...")
+    add_time(f"Lanes: {lanes}")
+    scheduler = Scheduler(lanes, gpu_ids=range(GPUs))
+    scheduler.idle_callback = RF2Batcher(scheduler)
+    build_pipeline(scheduler, args)
+    failed = scheduler.run()
+
+    add_time(f"discoba_pipeline FINISHED ({failed} failed tasks, logs in {REPORTS_DIR})")
+    sys.exit(1 if failed else 0)
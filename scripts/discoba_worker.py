@@ -0,0 +1,410 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent worker for the Python helpers of DiscobaMultimer.
+
+Each IDs line runs several short Python helpers (reformat of the MMseqs2
+tables, pairing, MSA and coevolution plots). Started one by one, most of
+their time on short proteins goes to starting the interpreter and importing
+Biopython, NumPy and matplotlib. The worker imports those modules once and
+runs each helper in a fork of itself, so the helpers start with the modules
+(and the caches they build on import, e.g. the matplotlib font cache)
+already loaded:
+
+    serve   listens on a Unix socket (DISCOBA_WORKER_SOCKET) until it is
+            stopped, the processes given with --watch-pid finish or it has
+            been idle for --idle-timeout seconds
+    run     runs a helper in the worker: run <script.py> [arguments]. The
+            helper writes to the standard output/error of the caller, runs in
+            its working directory and environment, and its exit code is the
+            exit code of run. If DISCOBA_WORKER_SOCKET is not set, no worker
+            listens on it or the worker runs another Python (e.g. helpers of
+            the RoseTTAFold environment), the helper is executed directly.
+    status  prints the PID, uptime and requests of the worker
+    watch   adds processes to --watch-pid: watch <PID> [<PID> ...] (e.g.
+            the GPU workers of a batch that exits before them)
+    stop    stops the worker (the running helpers are finished)
+
+Requests are handled concurrently (up to --jobs helpers at the same time).
+As every helper runs in its own fork, a helper cannot change the in-memory
+state of the worker or of other helpers (global variables, current
+directory, environment, atexit hooks such as the DISCOBA_PROFILE profiles).
+The helpers of a batch do share its working directory on disk, so helpers
+that can run at the same time must not write files with fixed names there
+(e.g. the pairing scripts use unique temporary files).
+"""
+
+import sys
+import os
+import argparse
+import atexit
+import json
+import signal
+import socket
+import time
+
+# Socket of the worker of the batch (set by the batch scripts when they start one)
+SOCKET = os.environ.get("DISCOBA_WORKER_SOCKET")
+
+# Modules imported by the worker before the helpers are run
+PRELOAD = ["numpy", "Bio.SeqIO", "Bio.AlignIO", "Bio.pairwise2", "Bio.Align",
+           "matplotlib.pyplot"]
+
+# Size of the messages of the protocol (one JSON object per message)
+MAX_MESSAGE = 1 << 20
+
+
+###############################################################################
+################################### Protocol ##################################
+###############################################################################
+
+def send_message(connection, message, fds=()):
+    data = json.dumps(message).encode()
+    if fds:
+        socket.send_fds(connection, [data], list(fds))
+    else:
+        connection.sendall(data)
+
+
+def receive_message(connection, max_fds=0):
+    """
+    Returns the message and the file descriptors received with it (None if
+    the other end closed the connection).
+    """
+    if max_fds:
+        data, fds, _, _ = socket.recv_fds(connection, MAX_MESSAGE, max_fds)
+    else:
+        data, fds = connection.recv(MAX_MESSAGE), []
+    if not data:
+        for fd in fds:
+            os.close(fd)
+        return None, []
+    return json.loads(data), fds
+
+
+###############################################################################
+#################################### Server ###################################
+###############################################################################
+
+def run_script(request, fds):
+    """
+    Runs a helper as __main__ (in the forked child) with the standard
+    streams, working directory, environment and arguments of the caller.
+    Returns its exit code.
+    """
+    import runpy
+    import traceback
+
+    for target, fd in enumerate(fds):
+        os.dup2(fd, target)
+        os.close(fd)
+    os.chdir(request["cwd"])
+    os.environ.clear()
+    os.environ.update(request["env"])
+    script = request["argv"][0]
+    sys.argv = list(request["argv"])
+    sys.path[0] = os.path.dirname(os.path.abspath(script))
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # Only the atexit hooks of the helper are run at its end
+    atexit._clear()
+
+    try:
+        runpy.run_path(script, run_name="__main__")
+        exit_code = 0
+    except SystemExit as exit:
+        if exit.code is None or isinstance(exit.code, int):
+            exit_code = exit.code or 0
+        else:
+            print(exit.code, file=sys.stderr)
+            exit_code = 1
+    except KeyboardInterrupt:
+        exit_code = 130
+    except BaseException as error:
+        # Traceback from the helper (without the frames of the worker)
+        tb = error.__traceback__
+        while tb is not None and os.path.abspath(tb.tb_frame.f_code.co_filename) != os.path.abspath(script):
+            tb = tb.tb_next
+        traceback.print_exception(type(error), error, tb or error.__traceback__)
+        exit_code = 1
+    atexit._run_exitfuncs()
+    for stream in (sys.stdout, sys.stderr):
+        try:
+            stream.flush()
+        except (OSError, ValueError):
+            pass
+    return exit_code
+
+
+class Worker:
+    def __init__(self, socket_path, jobs, watch_PIDs=(), idle_timeout=None):
+        self.socket_path = socket_path
+        self.jobs = jobs
+        self.watch_PIDs = list(watch_PIDs)
+        self.idle_timeout = idle_timeout
+        self.children = set()
+        self.requests = 0
+        self.start = time.time()
+        self.last_request = self.start
+        self.stopping = False
+
+    def preload(self, modules):
+        import importlib
+        import warnings
+        # The helpers only save their figures
+        os.environ.setdefault("MPLBACKEND", "Agg")
+        for module in modules:
+            start = time.time()
+            try:
+                # Deprecation warnings are shown when the helpers import them
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore")
+                    importlib.import_module(module)
+            except ImportError as error:
+                print(f"WARNING: {module} not preloaded ({error})", file=sys.stderr)
+            else:
+                print(f"Preloaded {module} ({time.time() - start:.2f} s)", file=sys.stderr)
+
+    def reap_children(self, block=False):
+        while self.children:
+            try:
+                pid, _ = os.waitpid(-1, 0 if block else os.WNOHANG)
+            except ChildProcessError:
+                self.children.clear()
+                return
+            if pid == 0:
+                return
+            self.children.discard(pid)
+            if block:
+                return
+
+    def should_exit(self):
+        if self.stopping:
+            return True
+        if self.watch_PIDs and not any(os.path.exists(f"/proc/{pid}") for pid in self.watch_PIDs):
+            return True
+        if self.idle_timeout and not self.children and time.time() - self.last_request > self.idle_timeout:
+            return True
+        return False
+
+    def handle(self, connection):
+        request, fds = receive_message(connection, max_fds=3)
+        if request is None:
+            return
+        command = request.get("command")
+        if command == "status":
+            self.reap_children()
+            send_message(connection, {"pid": os.getpid(), "uptime_s": round(time.time() - self.start, 1),
+                                      "requests": self.requests, "running": len(self.children)})
+            return
+        if command == "watch":
+            self.watch_PIDs.extend(int(pid) for pid in request.get("PIDs", []))
+            send_message(connection, {"watching": self.watch_PIDs})
+            return
+        if command == "stop":
+            self.stopping = True
+            send_message(connection, {"stopping": True})
+            return
+        if command != "run" or len(fds) != 3:
+            error = "invalid request"
+        elif os.path.realpath(request.get("python", "")) != os.path.realpath(sys.executable):
+            # Helpers of other environments (e.g. RoseTTAFold) are run by their caller
+            error = f"the worker runs {sys.executable}"
+        else:
+            error = None
+        if error:
+            for fd in fds:
+                os.close(fd)
+            send_message(connection, {"error": error})
+            return
+
+        # Run the helper in a fork
+        while len(self.children) >= self.jobs:
+            self.reap_children(block=True)
+        self.requests += 1
+        self.last_request = time.time()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 1
+            try:
+                self.listener.close()
+                send_message(connection, {"pid": os.getpid()})
+                exit_code = run_script(request, fds)
+                send_message(connection, {"exit_code": exit_code})
+            finally:
+                os._exit(exit_code)
+        self.children.add(pid)
+        for fd in fds:
+            os.close(fd)
+
+    def serve(self):
+        if os.path.exists(self.socket_path):
+            if connect(self.socket_path) is not None:
+                print(f"ERROR: a worker is already listening on {self.socket_path}", file=sys.stderr)
+                sys.exit(1)
+            os.remove(self.socket_path)     # left by a worker that was killed
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        self.listener.listen(64)
+        self.listener.settimeout(1)
+        signal.signal(signal.SIGTERM, lambda signum, frame: setattr(self, "stopping", True))
+        print(f"Worker {os.getpid()} listening on {self.socket_path}", file=sys.stderr)
+
+        try:
+            while not self.should_exit():
+                self.reap_children()
+                try:
+                    connection, _ = self.listener.accept()
+                except socket.timeout:
+                    continue
+                except InterruptedError:
+                    continue
+                with connection:
+                    connection.settimeout(10)
+                    try:
+                        self.handle(connection)
+                    except (OSError, ValueError) as error:
+                        print(f"WARNING: request failed ({error})", file=sys.stderr)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.listener.close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+            # The running helpers are finished before exiting
+            while self.children:
+                self.reap_children(block=True)
+        print(f"Worker {os.getpid()} stopped after {self.requests} requests", file=sys.stderr)
+
+
+###############################################################################
+#################################### Client ###################################
+###############################################################################
+
+def connect(socket_path):
+    """
+    Returns a connection to the worker (None if no worker listens).
+    """
+    if not socket_path:
+        return None
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path)
+    except OSError:
+        connection.close()
+        return None
+    return connection
+
+
+def run_in_worker(argv, socket_path=None):
+    """
+    Runs a helper in the worker and returns its exit code. Executes it
+    directly if no worker is listening.
+    """
+    connection = connect(socket_path or SOCKET)
+    if connection is None:
+        os.execv(sys.executable, [sys.executable] + argv)
+
+    with connection:
+        send_message(connection, {"command": "run", "argv": argv, "cwd": os.getcwd(),
+                                  "env": dict(os.environ), "python": sys.executable}, fds=(0, 1, 2))
+        reply, _ = receive_message(connection)
+        if reply is None or "pid" not in reply:
+            # Not run by the worker
+            connection.close()
+            os.execv(sys.executable, [sys.executable] + argv)
+        # Interruptions are passed to the helper
+        helper_PID = reply["pid"]
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda signum, frame: os.kill(helper_PID, signum))
+        while True:
+            try:
+                reply, _ = receive_message(connection)
+                break
+            except InterruptedError:
+                continue
+        if reply is None:
+            print(f"ERROR: {argv[0]} was killed in the worker", file=sys.stderr)
+            return 1
+        return reply["exit_code"]
+
+
+def query_worker(command, socket_path, **fields):
+    connection = connect(socket_path)
+    if connection is None:
+        print(f"ERROR: no worker listening on {socket_path}", file=sys.stderr)
+        sys.exit(1)
+    with connection:
+        send_message(connection, dict(fields, command=command))
+        reply, _ = receive_message(connection)
+    return reply
+
+
+###############################################################################
+##################################### CLI #####################################
+###############################################################################
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Persistent worker for the Python helpers of DiscobaMultimer.")
+    parser.add_argument("--socket", default=SOCKET,
+                        help="Unix socket of the worker (default: DISCOBA_WORKER_SOCKET)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve = subparsers.add_parser("serve", help="start a worker")
+    serve.add_argument("--jobs", type=int, default=os.cpu_count() or 1,
+                       help="helpers run at the same time (default: all cores)")
+    serve.add_argument("--watch-pid", type=int, nargs="+", default=[],
+                       help="stop when these processes have finished")
+    serve.add_argument("--idle-timeout", type=float, help="stop after this many seconds without requests")
+    serve.add_argument("--preload", default=",".join(PRELOAD),
+                       help="comma-separated modules imported at start (default: %(default)s)")
+
+    run = subparsers.add_parser("run", help="run a helper in the worker",
+                                usage="%(prog)s <script.py> [arguments]")
+    run.add_argument("script")
+    subparsers.add_parser("status", help="print the state of the worker")
+    watch = subparsers.add_parser("watch", help="also stop when these processes have finished")
+    watch.add_argument("PIDs", type=int, nargs="+")
+    subparsers.add_parser("stop", help="stop the worker")
+
+    # The arguments of the helper are not parsed
+    argv = sys.argv[1:]
+    if "run" in argv:
+        index = argv.index("run")
+        args = parser.parse_args(argv[:index + 2])
+        args.argv = argv[index + 1:]
+    else:
+        args = parser.parse_args(argv)
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    if args.command == "run":
+        sys.exit(run_in_worker(args.argv, args.socket))
+
+    if not args.socket:
+        print("ERROR: give the socket of the worker with --socket or DISCOBA_WORKER_SOCKET", file=sys.stderr)
+        sys.exit(1)
+
+    if args.command == "serve":
+        worker = Worker(args.socket, max(1, args.jobs), args.watch_pid, args.idle_timeout)
+        worker.preload([module for module in args.preload.split(",") if module])
+        worker.serve()
+    elif args.command == "status":
+        reply = query_worker("status", args.socket)
+        print(f"Worker {reply['pid']}: up {reply['uptime_s']} s, {reply['requests']} requests, "
+              f"{reply['running']} running")
+    elif args.command == "watch":
+        # The worker may still be importing its modules
+        deadline = time.time() + 30
+        while not os.path.exists(args.socket) and time.time() < deadline:
+            time.sleep(0.2)
+        reply = query_worker("watch", args.socket, PIDs=args.PIDs)
+        print(f"Worker on {args.socket} watching {' '.join(str(pid) for pid in reply['watching'])}")
+    elif args.command == "stop":
+        query_worker("stop", args.socket)
+        print(f"Worker on {args.socket} stopping")
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Exports the results of the IDs lines of a project to a compressed archive
+(<project_name>.tar.zst by default).
+
+The selected outputs of each IDs line are streamed from the project folder
+into the archive (without copying them to an intermediate folder) and the
+archive is compressed by a multi-threaded codec (zstd -T0, xz -T0 or pigz).
+Links (e.g. permutations of the IDs table linked to their canonical outputs
+or cached predictions) are archived as the files they point to.
+
+Next to the archive, <project_name>.manifest.tsv lists every exported file
+with its size, modification time and the archive that has it. An export with
+--since <previous.manifest.tsv> only archives the files that are new or
+changed since that export (its manifest still lists all of them, so exports
+can be chained).
+
+    cd project_folder
+    python $DiscobaMultimerPath/scripts/export_results.py -m -a IDs_table.txt project_v1
+    python $DiscobaMultimerPath/scripts/export_results.py -m -a --since project_v1.manifest.tsv IDs_table.txt project_v2
+"""
+
+import sys
+import os
+import argparse
+import shutil
+import subprocess
+import tarfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from a3m_utils import find_a3m
+
+# Codecs: (archive extension, compressor command reading the tar on stdin)
+CODECS = {
+    "zstd": (".tar.zst", ["zstd", "-T0", "-q", "-c", "-{level}"]),
+    "xz": (".tar.xz", ["xz", "-T0", "-c", "-{level}"]),
+    "gzip": (".tar.gz", ["pigz", "-c", "-{level}"]),
+}
+DEFAULT_LEVELS = {"zstd": 3, "xz": 3, "gzip": 6}
+
+MANIFEST_COLUMNS = ["path", "size", "mtime_ns", "archive"]
+
+
+###############################################################################
+############################### Artifact selection ############################
+###############################################################################
+
+def read_IDs_table(IDs_table):
+    """
+    Returns the [IDs] of each line of an IDs table (without comments, empty
+    lines and repeated lines).
+    """
+    lines, seen = [], set()
+    with open(IDs_table) as table:
+        for line in table:
+            if line.startswith("#"):
+                continue
+            IDs = [ID.strip() for ID in line.rstrip("\n").split("\t") if ID.strip()]
+            if IDs and tuple(IDs) not in seen:
+                seen.add(tuple(IDs))
+                lines.append(IDs)
+    return lines
+
+
+def line_artifacts(IDs, msa=False, plot=False, rf=False, af2=False):
+    """
+    Paths (files or folders, relative to the project folder) of the outputs
+    of an IDs line.
+    """
+    paired_name = "__vs__".join(IDs)
+    paths = []
+    if msa:
+        paths += [f"discoba_mmseqs_alignments/{ID}/{ID}.a3m" for ID in IDs]
+        paths += [f"discoba_paired_unpaired/{paired_name}.a3m",
+                  f"colabfold_MSA/{paired_name}.a3m",
+                  f"merged_MSA/{paired_name}.a3m",
+                  f"merged_MSA/{paired_name}.manifest.tsv"]
+    if plot:
+        paths.append(f"msa_plots/{paired_name}_msa.png")
+    if rf:
+        paths.append(f"RoseTTAFold_2track_results/{paired_name}")
+    if af2:
+        paths.append(f"AF2/{paired_name}")
+    return paired_name, paths
+
+
+def list_files(path):
+    """
+    Returns [(path, size, mtime_ns)] of a file or of the files of a folder
+    (following the links). Missing paths return []. MSAs (.a3m) are found
+    compressed or not.
+    """
+    if path.endswith(".a3m"):
+        path = find_a3m(path) or path
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return []
+    if not os.path.isdir(path):
+        return [(path, stat.st_size, stat.st_mtime_ns)]
+    files = []
+    for root, folders, names in os.walk(path, followlinks=True):
+        folders[:] = sorted(folder for folder in folders if not folder.startswith("."))
+        for name in sorted(names):
+            file_path = os.path.join(root, name)
+            try:
+                file_stat = os.stat(file_path)
+            except OSError:
+                continue    # broken link or removed while walking
+            files.append((file_path, file_stat.st_size, file_stat.st_mtime_ns))
+    return files
+
+
+def select_files(lines, threads, **selection):
+    """
+    Returns the [(path, size, mtime_ns)] of the selected outputs of all the
+    lines (without repeated files) and the [(paired_name, missing_paths)].
+    The project folder is walked by a pool of threads.
+    """
+    artifacts = [line_artifacts(IDs, **selection) for IDs in lines]
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        listed = executor.map(lambda artifact: [list_files(path) for path in artifact[1]], artifacts)
+        files, missing, seen = [], [], set()
+        for (paired_name, paths), path_files in zip(artifacts, listed):
+            missing_paths = [path for path, found in zip(paths, path_files)
+                             if not found and not path.endswith(".manifest.tsv")]
+            if missing_paths:
+                missing.append((paired_name, missing_paths))
+            for found in path_files:
+                for file in found:
+                    if file[0] not in seen:
+                        seen.add(file[0])
+                        files.append(file)
+    return files, missing
+
+
+###############################################################################
+################################### Manifest ##################################
+###############################################################################
+
+def read_manifest(manifest_file):
+    """
+    Returns {path: (size, mtime_ns, archive)} of a previous export.
+    """
+    manifest = {}
+    with open(manifest_file) as manifest_tsv:
+        header = manifest_tsv.readline().rstrip("\n").split("\t")
+        if header != MANIFEST_COLUMNS:
+            raise ValueError(f"{manifest_file} is not a manifest of export_results.py")
+        for line in manifest_tsv:
+            path, size, mtime_ns, archive = line.rstrip("\n").split("\t")
+            manifest[path] = (int(size), int(mtime_ns), archive)
+    return manifest
+
+
+def write_manifest(manifest_file, rows):
+    temporary_file = f"{manifest_file}.tmp"
+    with open(temporary_file, "w") as manifest_tsv:
+        manifest_tsv.write("\t".join(MANIFEST_COLUMNS) + "\n")
+        for row in rows:
+            manifest_tsv.write("\t".join(str(value) for value in row) + "\n")
+    os.replace(temporary_file, manifest_file)
+
+
+###############################################################################
+################################### Archive ###################################
+###############################################################################
+
+def compressor_command(codec, level):
+    extension, command = CODECS[codec]
+    command = [argument.format(level=level) for argument in command]
+    if codec == "gzip" and not shutil.which("pigz"):
+        command[0] = "gzip"     # single-threaded, but always available
+    if not shutil.which(command[0]):
+        return extension, None
+    return extension, command
+
+
+def write_archive(archive_file, files, project_name, command):
+    """
+    Streams the files into a tar archive (members in <project_name>/) piped
+    to the compressor. The archive is renamed when it is complete.
+    """
+    temporary_file = f"{archive_file}.tmp"
+    with open(temporary_file, "wb") as archive:
+        compressor = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=archive)
+    try:
+        with tarfile.open(fileobj=compressor.stdin, mode="w|", format=tarfile.PAX_FORMAT,
+                          dereference=True) as tar:
+            for path, _, _ in files:
+                tar.add(path, arcname=os.path.join(project_name, os.path.normpath(path)), recursive=False)
+        compressor.stdin.close()
+        if compressor.wait() != 0:
+            raise OSError(f"{command[0]} exited with code {compressor.returncode}")
+    except BaseException:
+        compressor.kill()
+        compressor.wait()
+        os.remove(temporary_file)
+        raise
+    os.replace(temporary_file, archive_file)
+
+
+###############################################################################
+##################################### CLI #####################################
+###############################################################################
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        usage="%(prog)s [-m] [-p] [-r] [-a] [options] <IDs_table.txt> <project_name>",
+        description="Exports the results of the IDs lines to a compressed archive. "
+                    "Must be run inside the folder in which discoba-multimer_batch.sh was executed.")
+    parser.add_argument("IDs_table", metavar="IDs_table.txt")
+    parser.add_argument("project_name", help="name of the archive (and of its root folder)")
+    parser.add_argument("-m", dest="msa", action="store_true", help="include all MSA types")
+    parser.add_argument("-p", dest="plot", action="store_true", help="include MSA plots")
+    parser.add_argument("-r", dest="rf", action="store_true", help="include RF2-track results")
+    parser.add_argument("-a", dest="af2", action="store_true", help="include AF2-multimer predictions")
+    parser.add_argument("--since", metavar="MANIFEST",
+                        help="only archive the files new or changed since the export of this manifest")
+    parser.add_argument("--codec", choices=list(CODECS), default="zstd", help="compression (default zstd)")
+    parser.add_argument("--level", type=int, help="compression level (default: 3 for zstd and xz, 6 for gzip)")
+    parser.add_argument("--threads", type=int, default=16, help="folders listed at the same time (default 16)")
+    args = parser.parse_args()
+    if not (args.msa or args.plot or args.rf or args.af2):
+        parser.error("select the results to export (-m, -p, -r and/or -a)")
+    if args.level is None:
+        args.level = DEFAULT_LEVELS[args.codec]
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    if not os.path.isfile(args.IDs_table):
+        print(f"ERROR: {args.IDs_table} is not a file", file=sys.stderr)
+        sys.exit(1)
+    extension, command = compressor_command(args.codec, args.level)
+    if command is None:
+        print(f"ERROR: {CODECS[args.codec][1][0]} is not installed (use --codec to choose another codec)",
+              file=sys.stderr)
+        sys.exit(1)
+    archive_file = args.project_name + extension
+    manifest_file = args.project_name + ".manifest.tsv"
+    for output_file in (archive_file, manifest_file):
+        if os.path.exists(output_file):
+            print(f"ERROR: {output_file} already exists", file=sys.stderr)
+            sys.exit(1)
+    previous = {}
+    if args.since:
+        try:
+            previous = read_manifest(args.since)
+        except (OSError, ValueError) as error:
+            print(f"ERROR: {error}", file=sys.stderr)
+            sys.exit(1)
+
+    start = time.time()
+    lines = read_IDs_table(args.IDs_table)
+    files, missing = select_files(lines, max(1, args.threads),
+                                  msa=args.msa, plot=args.plot, rf=args.rf, af2=args.af2)
+    for paired_name, missing_paths in missing:
+        print(f"WARNING: {paired_name}: not found {' '.join(missing_paths)}", file=sys.stderr)
+
+    # Files of the previous export that did not change are only listed in the manifest
+    archive_name = os.path.basename(archive_file)
+    new_files, manifest_rows = [], []
+    for path, size, mtime_ns in files:
+        previous_entry = previous.get(path)
+        if previous_entry and previous_entry[:2] == (size, mtime_ns):
+            manifest_rows.append((path, size, mtime_ns, previous_entry[2]))
+        else:
+            new_files.append((path, size, mtime_ns))
+            manifest_rows.append((path, size, mtime_ns, archive_name))
+
+    if not new_files:
+        print(f"Nothing new to export since {args.since} ({len(files)} files unchanged)")
+        sys.exit(0)
+    print(f"Exporting {len(new_files)} files ({sum(size for _, size, _ in new_files) / 1e6:.1f} MB) "
+          f"of {len(lines)} IDs lines to {archive_file}"
+          + (f" ({len(files) - len(new_files)} unchanged since {args.since})" if args.since else ""))
+    try:
+        write_archive(archive_file, new_files, args.project_name, command)
+    except OSError as error:
+        print(f"ERROR: archive not written: {error}", file=sys.stderr)
+        sys.exit(1)
+    write_manifest(manifest_file, manifest_rows)
+    print(f"Finished in {time.time() - start:.1f} s: {archive_file} "
+          f"({os.path.getsize(archive_file) / 1e6:.1f} MB) and {manifest_file}")
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+Identity-based diversity filter for paired MSAs used with RoseTTAFold 2-track.
+
+The target depth is chosen from the combined length of the pair (L1+L2) and
+the memory budget (see rf2_memory.py). If the MSA is deeper than the target,
+sequences are scanned in file order (paired MSAs are sorted by similarity to
+the query) and a sequence is kept only if its identity to every sequence
+already kept is lower than the identity cutoff (95%, like the hhfilter -id 95
+option used before). The scan stops as soon as the target depth is reached.
+
+Identities are computed on the match columns (lowercase insertions removed)
+encoded as a uint8 matrix, comparing blocks of sequences at once. Each pair
+is first screened on a subset of columns: the identical residues of the
+subset plus the residues of the other columns give an upper bound of its
+identity, and only the pairs whose bound reaches the cutoff are computed on
+all the columns. The bound is never lower than the identity, so the filter
+keeps the same sequences as comparing every pair on all the columns.
+"""
+
+import sys
+import os
+import numpy as np
+
+from a3m_utils import read_a3m, write_a3m
+import rf2_memory
+
+# Check input
+if __name__ == "__main__" and len(sys.argv) not in (4, 5):
+    print("ERROR: missing positional arguments", file=sys.stderr)
+    print("USAGE: python filter_a3m_diversity.py <input.a3m> <output.a3m> <combined_L> [<budget_GB>]", file=sys.stderr)
+    print("")
+    print("   input.a3m   paired a3m file (or MSA store, .a3mb). The first sequence is the query")
+    print("   output.a3m  filtered a3m file (can be the same as input.a3m)")
+    print("   combined_L  combined length of the pair (L1+L2)")
+    print(f"   budget_GB   memory available for RF2-track (default {rf2_memory.DEFAULT_BUDGET_GB})")
+    print("OUTPUT:")
+    print("   Prints the chosen depth and the number of remaining sequences")
+    sys.exit(1)
+
+# Same cutoff used with hhfilter (-id 95)
+IDENTITY_CUTOFF = 0.95
+
+# Sequences compared at once against the kept ones
+BLOCK_SIZE = 256
+KEPT_CHUNK_SIZE = 128
+
+# Columns used to screen the pairs before computing their identities
+SAMPLED_COLUMNS = 128
+
+# Encoding of the match columns (unknown residues are read as X)
+ALPHABET = "ARNDCQEGHILKMFPSTWYVX-"
+GAP_CODE = ALPHABET.index("-")
+X_CODE = ALPHABET.index("X")
+_ENCODING = np.full(256, X_CODE, dtype=np.uint8)
+for code, residue in enumerate(ALPHABET):
+    _ENCODING[ord(residue)] = code
+
+
+def encode_sequences(sequences, L):
+    """
+    Encodes the match columns of the sequences as a (N, L) uint8 matrix.
+    Lowercase letters (insertions) are removed. Sequences with a different
+    number of match columns are truncated or padded with gaps.
+    """
+    msa = np.full((len(sequences), L), GAP_CODE, dtype=np.uint8)
+    for i, sequence in enumerate(sequences):
+        row = np.frombuffer(sequence.encode(), dtype=np.uint8)
+        row = row[(row < ord("a")) | (row > ord("z"))][:L]
+        msa[i, :len(row)] = _ENCODING[row]
+    return msa
+
+
+def encode_store(store_file, L):
+    """
+    Same as encode_sequences for an MSA store (see msa_store.py): its match
+    columns are already split from the insertions.
+    """
+    from msa_store import MSAStore
+    matches = MSAStore(store_file).matches[:, :L]
+    msa = np.full((len(matches), L), GAP_CODE, dtype=np.uint8)
+    msa[:, :matches.shape[1]] = _ENCODING[matches]
+    return msa
+
+
+def _same_residues(block, others):
+    """
+    Number of identical residues (gaps excluded) of each pair of rows
+    (block x others).
+    """
+    return ((block[:, None, :] == others[None, :, :]) & (block[:, None, :] != GAP_CODE)).sum(axis=2)
+
+
+class _Rows:
+    """
+    Encoded rows with their number of residues, on all the columns and on
+    the sampled columns used to screen the pairs (None if all the columns
+    are compared).
+
+    _Rows.allocate creates an empty block of rows that grows with append,
+    so the rows kept by the filter are compared as a single array.
+    """
+
+    def __init__(self, msa, columns=None):
+        self.msa = msa
+        self.residues = (msa != GAP_CODE).sum(axis=1)
+        self.sampled = None if columns is None else np.ascontiguousarray(msa[:, columns])
+        self.sampled_residues = None if columns is None else (self.sampled != GAP_CODE).sum(axis=1)
+        self.count = len(msa)
+
+    @classmethod
+    def allocate(cls, capacity, like):
+        rows = cls(np.empty((capacity, like.msa.shape[1]), dtype=np.uint8))
+        if like.sampled is not None:
+            rows.sampled = np.empty((capacity, like.sampled.shape[1]), dtype=np.uint8)
+            rows.sampled_residues = np.empty(capacity, dtype=like.sampled_residues.dtype)
+        rows.count = 0
+        return rows
+
+    def __getitem__(self, selection):
+        rows = _Rows.__new__(_Rows)
+        rows.msa = self.msa[selection]
+        rows.residues = self.residues[selection]
+        rows.sampled = None if self.sampled is None else self.sampled[selection]
+        rows.sampled_residues = None if self.sampled is None else self.sampled_residues[selection]
+        rows.count = len(rows.msa)
+        return rows
+
+    def append(self, rows):
+        end = self.count + rows.count
+        self.msa[self.count:end] = rows.msa
+        self.residues[self.count:end] = rows.residues
+        if self.sampled is not None:
+            self.sampled[self.count:end] = rows.sampled
+            self.sampled_residues[self.count:end] = rows.sampled_residues
+        self.count = end
+
+
+def _redundant_pairs(block, others, identity_cutoff):
+    """
+    Boolean matrix (block x others) of the pairs of rows with an identity
+    bigger or equal than the cutoff: identical residues divided by the
+    number of residues of the shortest row.
+
+    With sampled columns, the identical residues of a pair are at most those
+    of the sampled columns plus the residues of the other columns of its
+    shortest row. Only the pairs whose bound reaches the cutoff are compared
+    on all the columns.
+    """
+    shortest = np.maximum(np.minimum(block.residues[:, None], others.residues[None, :]), 1)
+    if block.sampled is None:
+        return _same_residues(block.msa, others.msa) / shortest >= identity_cutoff
+
+    unsampled = np.minimum((block.residues - block.sampled_residues)[:, None],
+                           (others.residues - others.sampled_residues)[None, :])
+    bound = (_same_residues(block.sampled, others.sampled) + unsampled) / shortest
+    uncertain = bound >= identity_cutoff
+
+    redundant = np.zeros(uncertain.shape, dtype=bool)
+    rows = uncertain.any(axis=1)
+    if rows.any():
+        identities = _same_residues(block.msa[rows], others.msa) / shortest[rows]
+        redundant[rows] = (identities >= identity_cutoff) & uncertain[rows]
+    return redundant
+
+
+def diversity_filter(msa, depth, identity_cutoff=IDENTITY_CUTOFF):
+    """
+    Selects up to depth rows of the encoded MSA, discarding the rows with an
+    identity bigger or equal than identity_cutoff to any row already kept.
+
+    Parameters
+    ----------
+    msa : np.ndarray
+        (N, L) uint8 encoded MSA. The first row is the query and it is
+        always kept.
+    depth : int
+        Maximum number of rows to keep.
+    identity_cutoff : float
+        Identity (0 to 1) from which two rows are considered redundant.
+
+    Returns
+    -------
+    kept_indices : list of int
+        Indices of the kept rows, in the original order.
+
+    """
+    N, L = msa.shape
+    columns = None
+    if L > SAMPLED_COLUMNS:
+        columns = np.sort(np.random.default_rng(0).choice(L, SAMPLED_COLUMNS, replace=False))
+    rows = _Rows(msa, columns)
+
+    kept = _Rows.allocate(max(1, min(depth, N)), rows)
+    kept.append(rows[:1])
+    kept_indices = [0]
+    for start in range(1, N, BLOCK_SIZE):
+        if len(kept_indices) >= depth:
+            break
+
+        # Candidates of the block still not redundant
+        candidates = np.arange(start, min(start + BLOCK_SIZE, N))
+
+        # Compare against the kept rows, most recently kept first (they are
+        # the most similar to the block), discarding redundant candidates
+        for chunk_end in range(kept.count, 0, -KEPT_CHUNK_SIZE):
+            if len(candidates) == 0:
+                break
+            chunk = kept[max(0, chunk_end - KEPT_CHUNK_SIZE):chunk_end]
+            candidates = candidates[~_redundant_pairs(rows[candidates], chunk, identity_cutoff).any(axis=1)]
+
+        # Compare the surviving candidates among them, in order
+        redundant = _redundant_pairs(rows[candidates], rows[candidates], identity_cutoff)
+        selected = []
+        for position in range(len(candidates)):
+            if len(kept_indices) + len(selected) >= depth:
+                break
+            if not redundant[position, selected].any():
+                selected.append(position)
+        kept.append(rows[candidates[selected]])
+        kept_indices += candidates[selected].tolist()
+
+    return kept_indices
+
+
+def filter_a3m(input_a3m, output_a3m, combined_L, budget_GB=rf2_memory.DEFAULT_BUDGET_GB):
+    """
+    Filters input_a3m to the depth that fits budget_GB and writes output_a3m.
+
+    Returns
+    -------
+    depth : int
+        Target depth chosen from combined_L and budget_GB.
+    remaining : int
+        Number of sequences written to output_a3m.
+
+    """
+    cardinality, records = read_a3m(input_a3m)
+    depth = rf2_memory.target_depth(combined_L, budget_GB)
+
+    if len(records) > depth:
+        if input_a3m.endswith(".a3mb"):
+            msa = encode_store(input_a3m, combined_L)
+        else:
+            msa = encode_sequences([seq for _, seq in records], combined_L)
+        kept_indices = diversity_filter(msa, depth)
+        records = [records[i] for i in kept_indices]
+
+    write_a3m(output_a3m, records, cardinality)
+    return depth, len(records)
+
+
+if __name__ == "__main__":
+    input_a3m = sys.argv[1]
+    output_a3m = sys.argv[2]
+    combined_L = int(sys.argv[3])
+    budget_GB = float(sys.argv[4]) if len(sys.argv) == 5 else rf2_memory.DEFAULT_BUDGET_GB
+
+    if not os.path.isfile(input_a3m):
+        print(f"ERROR: {input_a3m} is not a file", file=sys.stderr)
+        sys.exit(1)
+
+    depth, remaining = filter_a3m(input_a3m, output_a3m, combined_L, budget_GB)
+    print(f"Target depth (L={combined_L}, budget={budget_GB} GB): {depth}")
+    print(f"Remaining sequences: {remaining}")
@@ -1,9 +1,11 @@
 #!/bin/bash -e
 
-# This script runs MMseqs2 to get Discoba MSA 
+# This script gets the ColabFold MSA of a protein or a complex from the
+# ColabFold MSA server (see scripts/colabfold_msa_client.py)
 
 # DEPENDENCIES -------------------------------------------------------------
-# colabfold_batch
+# Path to the MSA-only ColabFold client
+COLABFOLD_MSA_CLIENT=$DiscobaMultimerPath/scripts/colabfold_msa_client.py
 # --------------------------------------------------------------------------
 
 WD=`pwd`
@@ -20,6 +22,19 @@ usage() {
 	exit 1
 }
 
+# Prints the a3m file or its compressed version (<a3m>.zst or <a3m>.gz, see
+# a3m_utils.py). Returns 1 if none of them exists.
+a3m_find() {
+	local a3m
+	for a3m in "$1" "$1.zst" "$1.gz"; do
+		if [ -f "$a3m" ]; then
+			echo "$a3m"
+			return 0
+		fi
+	done
+	return 1
+}
+
 # Check input ---------------------------------------------------------
 if [ $# -lt 2 ]; then
 	echo "ERROR: 2 or more arguments are needed"
@@ -50,36 +65,6 @@ done
 
 
 
-# Aux Fx ---------------------------------------------------------------
-# Searches and finds $ID in $database. Outputs ${ID}.fasta in the WD
-get_sequence() {
-	database="$1"
-	ID="$2"
-	# Search for the ID in the fasta database and extract the sequence
-	find_flag=0
-	while read line; do
-		if [[ "$line" != ">"* ]]; then
-			continue
-		elif [[ "$line" == ">$ID" ]]; then
-			find_flag=1
-			echo "$line" > ${ID}.fasta
-			while read next_line; do
-				if [[ "$next_line" == ">"* ]]; then
-					break
-				fi
-				echo "$next_line" >> ${ID}.fasta
-			done
-			break
-		fi
-	done < $database
-	if [[ $find_flag -eq 1 ]]; then
-		echo "INFO: ID $ID found in input database ($database)" 
-	else
-		echo "ERROR: ID $ID does NOT FOUND in database ($database)"
-		exit 1
-	fi
-}
-
 # Generate the Discoba MSA ---------------------------------------------------
 
 # Output directory
@@ -99,51 +84,11 @@ done
 output_a3m_file=${output_a3m}.a3m
 
 
-# If the protein was not previously queried
-if [ ! -f "./colabfold_MSA/$output_a3m_file" ]; then
+# If the protein was not previously queried (its MSA may have been compressed)
+if ! a3m_find "./colabfold_MSA/$output_a3m_file" > /dev/null; then
 	
-	[ ! -d fasta_tmp/ ] && mkdir fasta_tmp
-
-	# Recover the sequences. If not, exit the program
-	for ID in ${IDs_array[@]}; do
-		# This generates protein_ID.fasta in the WD
-		get_sequence $database $ID || exit 1
-		mv $ID.fasta fasta_tmp/
-	done
-
-	# If it is a monomer just use the single sequence
-	if [ "${#IDs_array[@]}" == "1" ]; then
-		
-		[ ! -d tmp_MSA2 ] && mkdir tmp_MSA2
-		echo "WARNING: Is monomer"
-		cp fasta_tmp/${IDs_array}.fasta tmp_MSA2/${output_a3m}.fasta
-	        
-		#echo "WARNING: Is monomer"
-		#mv fasta_tmp/${IDs_array[i]}.fasta >> tmp_MSA2/${output_a3m}.fasta
-		
-	# If it is a complex combine the sequences into a query.fasta
-	else
-		[ ! -d tmp_MSA2 ] && mkdir tmp_MSA2
-		# Add the header
-		echo ">$output_a3m" > tmp_MSA2/${output_a3m}.fasta
-		# Add the combined sequence
-		for ((i=0; i<${#IDs_array[@]}; i++)); do
-			grep -v "^>" fasta_tmp/${IDs_array[i]}.fasta >> tmp_MSA2/${output_a3m}.fasta
-			if [ "$((i + 1))" -ne "${#IDs_array[@]}" ]; then
-				echo ":" >> tmp_MSA2/${output_a3m}.fasta
-			fi
-		done
-	fi
-
-	colabfold_batch --num-recycle 0 --num-models 1 --num-seeds -1 tmp_MSA2/${output_a3m}.fasta tmp_MSA 2> /dev/null || echo "DONE: ColabFold MSA saved."
-
-	# Move results and remove temporary files
-	mv tmp_MSA/$output_a3m_file $output_dir
-#	mv tmp_MSA/${output_a3m}_coverage.png $output_plot_dir
-#	rm ${output_a3m}.fasta
-	rm -r tmp_MSA
-	rm -r fasta_tmp/
-	rm -r tmp_MSA2/
+	# MSA-only query to the ColabFold MSA server (no AF2 prediction)
+	python $COLABFOLD_MSA_CLIENT $database "${IDs_array[@]}" || exit 1
 
 else
 	echo "WARNING: $output_a3m MSA generated beforehand. The search was not performed."
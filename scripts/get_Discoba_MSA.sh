@@ -8,6 +8,8 @@ RUN_MMSEQS_DISCOBA=$DiscobaMultimerPath/scripts/run_MMseqs2_to_get_DiscobaMSA_3.
 # Path to perform_pairing.py
 PAIRING=$DiscobaMultimerPath/scripts/perform_pairing_general_solution.py
 GREEDY_PAIRING=$DiscobaMultimerPath/scripts/perform_greedy_pairing.py
+# Path to discoba_worker.py
+WORKER_SCRIPT=$DiscobaMultimerPath/scripts/discoba_worker.py
 
 # SUB-DEPENDENCIES ---------------------------------------------------------
 # mmseqs in the PATH
@@ -19,6 +21,29 @@ command -v mmseqs >/dev/null 2>&1 || { echo >&2 "ERROR: MMseqs2 not found. Insta
 REFORMAT=$DiscobaMultimerPath/scripts/reformat_mmseq_table.py
 # --------------------------------------------------------------------------
 
+# Runs a Python helper in the worker of the batch if one is running, with its
+# modules already imported (see discoba_worker.py). Otherwise runs it directly.
+run_helper() {
+	if [ -S "${DISCOBA_WORKER_SOCKET:-}" ]; then
+		python3 -S $WORKER_SCRIPT run "$@"
+	else
+		python3 "$@"
+	fi
+}
+
+# Prints the a3m file or its compressed version (<a3m>.zst or <a3m>.gz, see
+# a3m_utils.py). Returns 1 if none of them exists.
+a3m_find() {
+	local a3m
+	for a3m in "$1" "$1.zst" "$1.gz"; do
+		if [ -f "$a3m" ]; then
+			echo "$a3m"
+			return 0
+		fi
+	done
+	return 1
+}
+
 usage() {
 	echo "USAGE: $0 [-greedy] <database> <protein_ID_1> <protein_ID_2> [<protein_ID_n>]"
 	echo "  -greedy			: Use greedy pairing method"
@@ -83,8 +108,9 @@ for i in $(seq 1 $IDs_number); do
 	echo "Parsing $ID_num: $ID_value..."
 	$RUN_MMSEQS_DISCOBA $database $ID_value
 
-	# Append file location
-	a3m_files+=(discoba_mmseqs_alignments/${ID_value}/${ID_value}.a3m)
+	# Append file location (compressed or not)
+	a3m_file=discoba_mmseqs_alignments/${ID_value}/${ID_value}.a3m
+	a3m_files+=($(a3m_find $a3m_file || echo $a3m_file))
 done
 
 # Generate paired+unpaired a3m file -----------------------------------
@@ -101,17 +127,17 @@ if [ ! -d $output_dir ]; then
 	mkdir $output_dir
 fi
 
-# Check if paired+unpaired MSA was not already created
-if [ ! -f $output_dir/$output_a3m ]; then
+# Check if paired+unpaired MSA was not already created (or compressed)
+if ! a3m_find $output_dir/$output_a3m > /dev/null; then
 	echo "Generating paired+unpaired alignment..."
 
 	# Choose the pairing method based on the greedy_mode flag
 	if [ "$greedy_mode" = true ]; then
 		# perform greedy pairing
-		python3 $GREEDY_PAIRING $output_a3m ${a3m_files[@]}
+		run_helper $GREEDY_PAIRING $output_a3m ${a3m_files[@]}
 	else
 		# perform the standard pairing
-		python3 $PAIRING $output_a3m ${a3m_files[@]}
+		run_helper $PAIRING $output_a3m ${a3m_files[@]}
 	fi
 
 	# move the results to the output dir
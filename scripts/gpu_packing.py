@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+Runs several colabfold_batch jobs at the same time on each GPU.
+
+The memory of each GPU is read from nvidia-smi and the memory footprint of
+each job is estimated from the combined length of the complex:
+
+    footprint = AF2_BASE_GB + AF2_PAIR_GB_PER_RES2 * L^2
+
+The defaults (3 GB + 6e-6 GB per squared residue, jobs using up to 90% of a
+GPU) can be changed with the AF2_BASE_GB, AF2_PAIR_GB_PER_RES2 and
+AF2_GPU_SAFETY environment variables, e.g. to fit the memory peaks measured
+on other GPUs or with other colabfold_batch options.
+
+Jobs are started longest first. A job is started on the GPU with the least
+free memory that can hold it (the estimated footprints of the jobs already
+running on a GPU can use up to SAFETY_FRACTION of its memory). A job too big
+for any GPU runs alone on the biggest one. Each job gets its GPU through
+CUDA_VISIBLE_DEVICES, and JAX is told not to preallocate the memory and to
+use at most the estimated fraction of it.
+
+The nvidia-smi and colabfold_batch executables can be changed with the
+NVIDIA_SMI and COLABFOLD_BATCH environment variables, so the scheduling can
+be tested without a GPU using a fake nvidia-smi and a stub colabfold_batch.
+"""
+
+import sys
+import os
+import time
+import shutil
+import subprocess
+
+from a3m_utils import is_compressed, plain_a3m
+from telemetry import telemetry_command
+
+# Check input
+if __name__ == "__main__" and (len(sys.argv) < 2 or sys.argv[1].startswith("-")):
+    print("ERROR: missing positional arguments", file=sys.stderr)
+    print("USAGE: python gpu_packing.py <jobs.tsv> [<colabfold_batch options>]", file=sys.stderr)
+    print("")
+    print("   jobs.tsv    TSV file with one job per line:")
+    print("               input.a3m  output_dir  combined_L")
+    print("   options     passed to every colabfold_batch call")
+    print("OUTPUT:")
+    print("   colabfold_batch outputs in each output_dir")
+    print("   One log per job in ./reports/AF2_packing/")
+    sys.exit(1)
+
+
+def float_environment(variable, default, maximum=None):
+    """
+    Positive number from an environment variable (default if it is not set).
+    """
+    value = os.environ.get(variable)
+    if not value:
+        return default
+    try:
+        number = float(value)
+    except ValueError:
+        number = None
+    if number is None or number <= 0 or (maximum is not None and number > maximum):
+        limit = f" and at most {maximum}" if maximum is not None else ""
+        print(f"ERROR: {variable} must be a number greater than 0{limit} (got {value})", file=sys.stderr)
+        sys.exit(1)
+    return number
+
+
+# Memory model of AF2-multimer jobs (GB)
+AF2_BASE_GB = float_environment("AF2_BASE_GB", 3.0)
+AF2_PAIR_GB_PER_RES2 = float_environment("AF2_PAIR_GB_PER_RES2", 6e-6)
+
+# Fraction of the GPU memory that the running jobs can use
+SAFETY_FRACTION = float_environment("AF2_GPU_SAFETY", 0.9, maximum=1.0)
+
+# Logs of the jobs
+LOGS_DIR = "./reports/AF2_packing"
+
+# Plain copies of the compressed MSAs (in the output directory of each job)
+PLAIN_DIR = ".plain_MSA"
+
+
+def estimate_footprint_GB(combined_L):
+    return AF2_BASE_GB + AF2_PAIR_GB_PER_RES2 * combined_L ** 2
+
+
+def query_GPUs(nvidia_smi=None):
+    """
+    Returns a dict {GPU index: total memory (GB)} with the GPUs reported by
+    nvidia-smi. Only the GPUs in CUDA_VISIBLE_DEVICES are used, if it is set.
+    """
+    if nvidia_smi is None:
+        nvidia_smi = os.environ.get("NVIDIA_SMI", "nvidia-smi")
+    output = subprocess.run([nvidia_smi, "--query-gpu=index,memory.total",
+                             "--format=csv,noheader,nounits"],
+                            capture_output=True, text=True, check=True).stdout
+
+    GPUs = {}
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        index, memory_MiB = (field.strip() for field in line.split(","))
+        GPUs[int(index)] = float(memory_MiB) * 1024 ** 2 / 1e9
+
+    visible = os.environ.get("CUDA_VISIBLE_DEVICES")
+    if visible:
+        indices = {int(index) for index in visible.split(",") if index.strip().isdigit()}
+        GPUs = {index: memory for index, memory in GPUs.items() if index in indices}
+    return GPUs
+
+
+def read_jobs(jobs_file):
+    """
+    Reads the jobs file. Returns a list of (input_a3m, output_dir, combined_L)
+    sorted by combined length (longest first).
+    """
+    jobs = []
+    with open(jobs_file) as jobs_tsv:
+        for line in jobs_tsv:
+            if line.startswith("#") or not line.strip():
+                continue
+            input_a3m, output_dir, combined_L = line.rstrip("\n").split("\t")[:3]
+            jobs.append((input_a3m, output_dir, int(combined_L)))
+    return sorted(jobs, key=lambda job: job[2], reverse=True)
+
+
+def choose_GPU(footprint_GB, GPUs, used_GB):
+    """
+    Chooses the GPU for a job.
+
+    Parameters
+    ----------
+    footprint_GB : float
+        Estimated memory of the job.
+    GPUs : dict
+        {GPU index: total memory (GB)}.
+    used_GB : dict
+        {GPU index: estimated memory of the jobs running on it (GB)}.
+
+    Returns
+    -------
+    int or None
+        The GPU with the least free memory that can hold the job. A job
+        bigger than every GPU is assigned to the biggest GPU when it is
+        empty. None if the job has to wait.
+
+    """
+    free_GB = {index: memory * SAFETY_FRACTION - used_GB[index] for index, memory in GPUs.items()}
+    candidates = [index for index in GPUs if free_GB[index] >= footprint_GB]
+    if candidates:
+        return min(candidates, key=lambda index: (free_GB[index], index))
+
+    biggest = max(GPUs, key=lambda index: (GPUs[index], -index))
+    if footprint_GB > GPUs[biggest] * SAFETY_FRACTION and used_GB[biggest] == 0:
+        return biggest
+    return None
+
+
+def next_job(pending, GPUs, used_GB):
+    """
+    Returns (position in pending, GPU index) of the first pending job (they
+    are sorted longest first) that can be started now, or None.
+    """
+    for position, (_, _, combined_L) in enumerate(pending):
+        GPU = choose_GPU(estimate_footprint_GB(combined_L), GPUs, used_GB)
+        if GPU is not None:
+            return position, GPU
+    return None
+
+
+def start_job(job, GPU, total_GB, colabfold_options):
+    input_a3m, output_dir, combined_L = job
+    footprint_GB = estimate_footprint_GB(combined_L)
+
+    environment = dict(os.environ)
+    environment["CUDA_VISIBLE_DEVICES"] = str(GPU)
+    environment["XLA_PYTHON_CLIENT_PREALLOCATE"] = "false"
+    environment["XLA_PYTHON_CLIENT_MEM_FRACTION"] = f"{min(1.0, footprint_GB / total_GB):.3f}"
+    environment["TF_FORCE_UNIFIED_MEMORY"] = "0"
+
+    colabfold_batch = os.environ.get("COLABFOLD_BATCH", "colabfold_batch")
+    name = os.path.basename(os.path.normpath(output_dir))
+    if is_compressed(input_a3m):
+        # colabfold_batch reads plain MSAs: temporary copy removed when the job ends
+        os.makedirs(os.path.join(output_dir, PLAIN_DIR), exist_ok=True)
+        input_a3m = plain_a3m(input_a3m, os.path.join(output_dir, PLAIN_DIR))
+    log = open(os.path.join(LOGS_DIR, f"{name}.log"), "w")
+    command = telemetry_command("af2", name, [colabfold_batch] + colabfold_options + [input_a3m, output_dir],
+                                combined_L, input_a3m)
+    process = subprocess.Popen(command,
+                               stdout=log, stderr=subprocess.STDOUT, env=environment)
+    log.close()
+    return process
+
+
+def run_jobs(jobs, GPUs, colabfold_options, poll_seconds=1.0):
+    """
+    Runs all the jobs packing them on the GPUs.
+
+    Returns
+    -------
+    failed : list of str
+        Output directories of the failed jobs.
+
+    """
+    os.makedirs(LOGS_DIR, exist_ok=True)
+    pending = list(jobs)
+    used_GB = {index: 0.0 for index in GPUs}
+    running = []        # (process, job, GPU, footprint)
+    failed = []
+
+    while pending or running:
+        # Start as many jobs as possible
+        while pending:
+            choice = next_job(pending, GPUs, used_GB)
+            if choice is None:
+                break
+            position, GPU = choice
+            job = pending.pop(position)
+            footprint_GB = estimate_footprint_GB(job[2])
+            used_GB[GPU] += footprint_GB
+            running.append((start_job(job, GPU, GPUs[GPU], colabfold_options), job, GPU, footprint_GB))
+            print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} START GPU {GPU} "
+                  f"({used_GB[GPU]:.1f}/{GPUs[GPU]:.1f} GB): {job[0]} (L={job[2]}, ~{footprint_GB:.1f} GB)",
+                  flush=True)
+
+        # Wait for any job to finish
+        time.sleep(poll_seconds)
+        for entry in list(running):
+            process, job, GPU, footprint_GB = entry
+            if process.poll() is None:
+                continue
+            running.remove(entry)
+            used_GB[GPU] -= footprint_GB
+            shutil.rmtree(os.path.join(job[1], PLAIN_DIR), ignore_errors=True)
+            status = "DONE" if process.returncode == 0 else "FAILED"
+            if process.returncode != 0:
+                failed.append(job[1])
+            print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} {status} GPU {GPU}: {job[0]}", flush=True)
+
+    return failed
+
+
+if __name__ == "__main__":
+    jobs_file = sys.argv[1]
+    colabfold_options = sys.argv[2:]
+
+    if not os.path.isfile(jobs_file):
+        print(f"ERROR: {jobs_file} is not a file", file=sys.stderr)
+        sys.exit(1)
+
+    GPUs = query_GPUs()
+    if not GPUs:
+        print("ERROR: no GPUs found with nvidia-smi", file=sys.stderr)
+        sys.exit(1)
+    print("GPUs: " + ", ".join(f"{index} ({memory:.1f} GB)" for index, memory in GPUs.items()))
+
+    failed = run_jobs(read_jobs(jobs_file), GPUs, colabfold_options)
+    if failed:
+        print(f"ERROR: {len(failed)} AF2 jobs failed: {' '.join(failed)}", file=sys.stderr)
+        sys.exit(1)
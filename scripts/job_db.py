@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+"""
+Job-state database of a DiscobaMultimer project.
+
+Each (stage, IDs line) job of discoba-multimer_batch.sh is recorded in a
+SQLite database in the project folder with its status, start and end times,
+exit code, the PID and host of the process running it and its output:
+
+    queued   added to a queue (e.g. RF2-track pairs predicted at the end)
+    running  being computed
+    done     finished successfully
+    failed   finished with a non-zero exit code
+    skipped  cannot be computed (e.g. homooligomers with RF2-track)
+
+Stages are only considered finished when they are recorded as done or
+skipped, instead of when their output files exist, so half-written outputs of
+an interrupted run are computed again. A running job whose process is not
+alive anymore is considered interrupted.
+
+The database is ./discoba_jobs.sqlite by default (DISCOBA_JOBS_DB environment
+variable). Commands:
+
+    start      record that a job started
+    queue      record that a job was queued
+    finish     record the exit code of a job
+    skip       record that a job cannot be computed
+    check      record a job as done or failed depending on its output files
+    pending    write the lines of an IDs table that still have to be computed
+               (not finished, failed or interrupted)
+    reset      forget jobs (e.g. after removing their outputs, so they are
+               computed again)
+    status     summary of the project, failed and running jobs
+"""
+
+import sys
+import os
+import argparse
+import glob
+import socket
+import sqlite3
+import subprocess
+import time
+
+# Location of the database (relative to the project folder)
+DB_FILE = os.environ.get("DISCOBA_JOBS_DB", "./discoba_jobs.sqlite")
+
+# Statuses of the jobs that are finished
+FINISHED = ("done", "skipped")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    stage TEXT NOT NULL,
+    name TEXT NOT NULL,
+    status TEXT NOT NULL,
+    pid INTEGER,
+    host TEXT,
+    output TEXT,
+    note TEXT,
+    start REAL,
+    end REAL,
+    exit_code INTEGER,
+    PRIMARY KEY (stage, name)
+)
+"""
+
+
+def connect(db_file=None):
+    """
+    Opens (and creates, if needed) the database. Several processes can use
+    it at the same time (e.g. the GPU workers of -g).
+    """
+    connection = sqlite3.connect(db_file or DB_FILE, timeout=120)
+    connection.row_factory = sqlite3.Row
+    connection.execute(SCHEMA)
+    return connection
+
+
+def paired_name(IDs):
+    return "__vs__".join(IDs)
+
+
+def is_alive(job):
+    """
+    True if the process of a running/queued job is still alive. Processes
+    of other hosts are assumed to be alive.
+    """
+    if job["pid"] is None:
+        return False
+    if job["host"] != socket.gethostname():
+        return True
+    try:
+        os.kill(job["pid"], 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+###############################################################################
+################################ Job updates ##################################
+###############################################################################
+
+def record(connection, stage, name, status, pid=None, output=None, note=None, exit_code=None):
+    """
+    Records the new status of a job. Start time is set when the job starts
+    or is queued, end time when it finishes.
+    """
+    now = time.time()
+    with connection:
+        row = connection.execute("SELECT * FROM jobs WHERE stage = ? AND name = ?",
+                                 (stage, name)).fetchone()
+        if row is None:
+            connection.execute("INSERT INTO jobs (stage, name, status) VALUES (?, ?, ?)",
+                               (stage, name, status))
+            row = {"start": None, "pid": None, "host": None, "output": None, "note": None}
+
+        if status in ("running", "queued"):
+            start, end = now, None
+            host = socket.gethostname()
+        else:
+            start, end = row["start"] or now, now
+            host = row["host"] or socket.gethostname()
+            pid = pid if pid is not None else row["pid"]
+        connection.execute(
+            "UPDATE jobs SET status = ?, pid = ?, host = ?, output = ?, note = ?, start = ?, "
+            "end = ?, exit_code = ? WHERE stage = ? AND name = ?",
+            (status, pid, host, output or row["output"], note or row["note"], start, end,
+             exit_code, stage, name))
+
+
+def finished_names(connection, stage):
+    """
+    Names of the finished jobs of a stage, and of the ones that are running
+    or queued by a process that is still alive.
+    """
+    finished, in_progress = set(), set()
+    for job in connection.execute("SELECT * FROM jobs WHERE stage = ?", (stage,)):
+        if job["status"] in FINISHED:
+            finished.add(job["name"])
+        elif job["status"] in ("running", "queued") and is_alive(job):
+            in_progress.add(job["name"])
+    return finished, in_progress
+
+
+def pending_lines(connection, stages, IDs_table_file):
+    """
+    Lines of the IDs table that still have to be computed in any of the
+    stages (not finished, not being computed by another process).
+
+    Returns
+    -------
+    pending : list of str
+        Lines to compute (without the newline).
+    total : int
+        Number of IDs lines in the table.
+
+    """
+    states = [finished_names(connection, stage) for stage in stages]
+    pending, total = [], 0
+    with open(IDs_table_file) as IDs_table:
+        for line in IDs_table:
+            if line.startswith("#") or not line.strip():
+                continue
+            total += 1
+            name = paired_name(line.rstrip("\n").split("\t"))
+            if any(name not in finished and name not in in_progress
+                   for finished, in_progress in states):
+                pending.append(line.rstrip("\n"))
+    return pending, total
+
+
+###############################################################################
+################################### Status ####################################
+###############################################################################
+
+def format_time(seconds):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(seconds)) if seconds else "-"
+
+
+def format_elapsed(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+
+def GPU_PIDs():
+    """
+    PIDs of the processes running on the GPUs (from nvidia-smi).
+    """
+    nvidia_smi = os.environ.get("NVIDIA_SMI", "nvidia-smi")
+    output = subprocess.run([nvidia_smi, "--query-compute-apps=pid", "--format=csv,noheader"],
+                            capture_output=True, text=True).stdout
+    return [int(pid) for pid in output.split() if pid.isdigit()]
+
+
+def process_ancestors(pid):
+    """
+    The PID and the PIDs of its parent processes (from /proc).
+    """
+    ancestors = []
+    while pid > 1 and pid not in ancestors:
+        ancestors.append(pid)
+        try:
+            with open(f"/proc/{pid}/stat") as stat:
+                # The command name (2nd field) may contain spaces
+                pid = int(stat.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            break
+    return ancestors
+
+
+def print_status(connection, stage=None, failed=False, PIDs=None):
+    """
+    Prints the number of jobs of each stage and status, the failed jobs
+    (with failed=True) and the running jobs. With PIDs, prints the running
+    job of each PID (the job of the PID or of one of its parent processes).
+    """
+    where, parameters = ("WHERE stage = ?", (stage,)) if stage else ("", ())
+    jobs = connection.execute(f"SELECT * FROM jobs {where} ORDER BY stage, start", parameters).fetchall()
+    running = [job for job in jobs if job["status"] == "running" and is_alive(job)]
+
+    if PIDs is not None:
+        by_PID = {job["pid"]: job for job in running}
+        for PID in PIDs:
+            job = next((by_PID[ancestor] for ancestor in process_ancestors(PID) if ancestor in by_PID), None)
+            if job is None:
+                print(f"PID {PID}: No job found")
+            else:
+                print(f"PID {PID}: {job['stage']} {job['output'] or job['name']}")
+        return
+
+    print("stage\tdone\tskipped\tqueued\trunning\tfailed\tinterrupted")
+    for job_stage in sorted({job["stage"] for job in jobs}):
+        stage_jobs = [job for job in jobs if job["stage"] == job_stage]
+        counts = {status: sum(job["status"] == status for job in stage_jobs)
+                  for status in ("done", "skipped", "queued", "failed")}
+        alive = sum(job in running for job in stage_jobs)
+        interrupted = sum(job["status"] == "running" for job in stage_jobs) - alive
+        print(f"{job_stage}\t{counts['done']}\t{counts['skipped']}\t{counts['queued']}\t"
+              f"{alive}\t{counts['failed']}\t{interrupted}")
+
+    if failed:
+        print("")
+        print("Failed jobs:")
+        for job in jobs:
+            if job["status"] == "failed" or (job["status"] == "running" and job not in running):
+                exit_code = job["exit_code"] if job["status"] == "failed" else "interrupted"
+                print(f"  {job['stage']}\t{job['name']}\texit code: {exit_code}\t"
+                      f"end: {format_time(job['end'])}")
+
+    if running:
+        print("")
+        print("Running jobs:")
+        for job in running:
+            print(f"  {job['stage']}\t{job['output'] or job['name']}\tPID {job['pid']} ({job['host']})\t"
+                  f"started {format_time(job['start'])} ({format_elapsed(time.time() - job['start'])})")
+
+
+###############################################################################
+##################################### CLI #####################################
+###############################################################################
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Job-state database of a DiscobaMultimer project.")
+    parser.add_argument("--db", help=f"database file (default {DB_FILE})")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    for command in ("start", "queue"):
+        job = subparsers.add_parser(command, help=f"record that a job was {command}ed")
+        job.add_argument("stage")
+        job.add_argument("name")
+        job.add_argument("--pid", type=int, default=os.getppid(), help="PID running the job (default: parent)")
+        job.add_argument("--output", help="output of the job")
+
+    finish = subparsers.add_parser("finish", help="record the exit code of a job")
+    finish.add_argument("stage")
+    finish.add_argument("name")
+    finish.add_argument("exit_code", type=int)
+
+    skip = subparsers.add_parser("skip", help="record that a job cannot be computed")
+    skip.add_argument("stage")
+    skip.add_argument("name")
+    skip.add_argument("reason")
+
+    check = subparsers.add_parser("check", help="record a job as done if a file matching the pattern exists")
+    check.add_argument("stage")
+    check.add_argument("name")
+    check.add_argument("pattern")
+
+    pending = subparsers.add_parser("pending", help="write the lines that still have to be computed")
+    pending.add_argument("stages", help="comma-separated stages (pending if any of them is)")
+    pending.add_argument("IDs_table")
+    pending.add_argument("output_IDs_table")
+
+    reset = subparsers.add_parser("reset", help="forget jobs (they will be computed again)")
+    reset.add_argument("stage")
+    reset.add_argument("names", nargs="+", help="paired names ('all' for every job of the stage)")
+
+    status = subparsers.add_parser("status", help="summary of the project")
+    status.add_argument("--stage", help="only this stage")
+    status.add_argument("--failed", action="store_true", help="list failed and interrupted jobs")
+    status.add_argument("--pids", nargs="+", metavar="PID",
+                        help="running job of each PID ('all' for the processes on the GPUs)")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    connection = connect(args.db)
+
+    if args.command in ("start", "queue"):
+        status = "running" if args.command == "start" else "queued"
+        record(connection, args.stage, args.name, status, pid=args.pid, output=args.output)
+
+    elif args.command == "finish":
+        record(connection, args.stage, args.name, "done" if args.exit_code == 0 else "failed",
+               exit_code=args.exit_code)
+
+    elif args.command == "skip":
+        record(connection, args.stage, args.name, "skipped", note=args.reason, exit_code=0)
+
+    elif args.command == "check":
+        exit_code = 0 if glob.glob(args.pattern) else 1
+        record(connection, args.stage, args.name, "done" if exit_code == 0 else "failed",
+               exit_code=exit_code)
+        sys.exit(exit_code)
+
+    elif args.command == "pending":
+        lines, total = pending_lines(connection, args.stages.split(","), args.IDs_table)
+        with open(args.output_IDs_table + ".tmp", "w") as output:
+            output.writelines(line + "\n" for line in lines)
+        os.replace(args.output_IDs_table + ".tmp", args.output_IDs_table)
+        print(f"{len(lines)} of {total} IDs lines pending ({args.stages})")
+
+    elif args.command == "reset":
+        with connection:
+            if args.names == ["all"]:
+                connection.execute("DELETE FROM jobs WHERE stage = ?", (args.stage,))
+            else:
+                connection.executemany("DELETE FROM jobs WHERE stage = ? AND name = ?",
+                                       [(args.stage, name) for name in args.names])
+
+    elif args.command == "status":
+        PIDs = None
+        if args.pids:
+            PIDs = GPU_PIDs() if args.pids == ["all"] else [int(PID) for PID in args.pids]
+        print_status(connection, args.stage, args.failed, PIDs)
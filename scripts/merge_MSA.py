@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""
+Merges the ColabFold MSA and the Discoba MSA of an IDs line.
+
+Heteromers: both MSAs are streamed and written after the cardinality line of
+the ColabFold MSA (ColabFold records first, then the Discoba ones). Rows that
+are exactly the same in both sources (e.g. sequences found by both searches)
+are written only once. With a maximum depth, paired rows (with residues in
+more than one protein) are kept first, then unpaired rows, in the order of
+the sources, until the depth is reached. The query rows that start each
+block of the MSA (paired query and the query of each protein) are always
+kept and they do not count as duplicates.
+
+Homo-oligomers: the Discoba monomer MSA is appended to the ColabFold MSA with
+a kernel-level copy (no deduplication or depth cap). Compressed MSAs are
+decompressed while they are copied.
+
+The inputs can be compressed (.a3m.zst or .a3m.gz) and the merged MSA is
+compressed if its name ends with .zst or .gz.
+
+The merged MSA is written atomically (temporary file renamed when complete)
+and a manifest with the rows of each source is written next to it
+(<name>.manifest.tsv): rows read, rows written, duplicates dropped and rows
+dropped by the depth cap.
+"""
+
+import sys
+import os
+import argparse
+import hashlib
+import shutil
+import tempfile
+
+from a3m_utils import (iter_a3m, read_cardinality, parse_cardinality, open_a3m, is_compressed,
+                       strip_compression)
+
+# Lowercase letters are insertions (not aligned columns)
+_DELETE_INSERTIONS = str.maketrans("", "", "abcdefghijklmnopqrstuvwxyz")
+
+MANIFEST_COLUMNS = ["source", "file", "rows", "written", "duplicates", "capped"]
+
+
+def manifest_path(output_a3m):
+    return os.path.splitext(strip_compression(output_a3m))[0] + ".manifest.tsv"
+
+
+def write_manifest(output_a3m, rows, max_depth=None):
+    """
+    Writes the manifest of a merged MSA. rows is a list of dicts with the
+    MANIFEST_COLUMNS keys (one per source).
+    """
+    with open(manifest_path(output_a3m), "w") as manifest:
+        manifest.write(f"# merged: {output_a3m}\tmax_depth: {max_depth or '-'}\n")
+        manifest.write("\t".join(MANIFEST_COLUMNS) + "\n")
+        for row in rows:
+            manifest.write("\t".join(str(row[column]) for column in MANIFEST_COLUMNS) + "\n")
+
+
+class RowClassifier:
+    """
+    Classifies the rows of a heteromer MSA using the lengths of the proteins
+    and the query sequence (first row of the ColabFold MSA).
+    """
+
+    def __init__(self, lengths, query_sequence):
+        self.bounds = []
+        start = 0
+        for length in lengths:
+            self.bounds.append((start, start + length))
+            start += length
+        query = query_sequence.translate(_DELETE_INSERTIONS)
+        self.query_chains = [query[start:end] for start, end in self.bounds]
+
+    def chains(self, sequence):
+        aligned = sequence.translate(_DELETE_INSERTIONS)
+        return [aligned[start:end] for start, end in self.bounds]
+
+    def classify(self, sequence):
+        """
+        Returns (is_query, is_paired). Query rows have the query sequence
+        (or only gaps) in each protein.
+        """
+        chains = self.chains(sequence)
+        with_residues = [chain for chain in chains if chain.strip("-")]
+        is_query = bool(with_residues) and all(
+            chain == query or not chain.strip("-") for chain, query in zip(chains, self.query_chains))
+        return is_query, len(with_residues) > 1
+
+
+def _row_key(sequence):
+    return hashlib.blake2b(sequence.encode(), digest_size=16).digest()
+
+
+def plan_merge(sources, classifier, max_depth=None):
+    """
+    First pass over the sources: decides which rows are written.
+
+    Returns
+    -------
+    keep : list of list of bool
+        One list per source with a flag per record.
+    rows : list of dict
+        Manifest rows of each source.
+
+    """
+    seen = set()
+    flags = []      # (source, is_query, is_paired) of each non-duplicated row
+    keep, rows = [], []
+    for name, a3m_file in sources:
+        source_keep = []
+        row = {"source": name, "file": a3m_file, "rows": 0, "written": 0, "duplicates": 0, "capped": 0}
+        for _, sequence in iter_a3m(a3m_file):
+            row["rows"] += 1
+            is_query, is_paired = classifier.classify(sequence)
+            key = _row_key(sequence)
+            if not is_query and key in seen:
+                row["duplicates"] += 1
+                source_keep.append(False)
+                continue
+            seen.add(key)
+            flags.append((len(keep), len(source_keep), is_query, is_paired))
+            source_keep.append(True)
+        keep.append(source_keep)
+        rows.append(row)
+
+    # Depth cap: queries, then paired rows, then unpaired rows
+    if max_depth is not None:
+        budget = max_depth - sum(1 for flag in flags if flag[2])
+        for wanted_paired in (True, False):
+            for source_index, record_index, is_query, is_paired in flags:
+                if is_query or is_paired != wanted_paired:
+                    continue
+                if budget > 0:
+                    budget -= 1
+                else:
+                    keep[source_index][record_index] = False
+                    rows[source_index]["capped"] += 1
+
+    for source_keep, row in zip(keep, rows):
+        row["written"] = sum(source_keep)
+    return keep, rows
+
+
+def merge_heteromer(colabfold_a3m, discoba_a3m, output_a3m, max_depth=None):
+    cardinality = read_cardinality(colabfold_a3m)
+    if cardinality is None:
+        print(f"ERROR: {colabfold_a3m} has no cardinality line", file=sys.stderr)
+        sys.exit(1)
+    lengths, _ = parse_cardinality(cardinality)
+    query_sequence = next(iter_a3m(colabfold_a3m))[1]
+    classifier = RowClassifier(lengths, query_sequence)
+
+    sources = [("colabfold", colabfold_a3m), ("discoba", discoba_a3m)]
+    keep, rows = plan_merge(sources, classifier, max_depth)
+
+    fd, temp_file = _temporary_file(output_a3m)
+    os.close(fd)
+    try:
+        with open_a3m(temp_file, "w") as output:
+            output.write(cardinality + "\n")
+            for (_, a3m_file), source_keep in zip(sources, keep):
+                for (header, sequence), kept in zip(iter_a3m(a3m_file), source_keep):
+                    if kept:
+                        output.write(header + "\n" + sequence + "\n")
+        os.chmod(temp_file, 0o644)
+        os.replace(temp_file, output_a3m)
+    except BaseException:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+    return rows
+
+
+def _temporary_file(output_a3m):
+    """
+    Temporary file next to the output, with its compression extension.
+    """
+    output_dir = os.path.dirname(os.path.abspath(output_a3m))
+    suffix = ".a3m" + output_a3m[len(strip_compression(output_a3m)):]
+    return tempfile.mkstemp(prefix=".tmp_", suffix=suffix, dir=output_dir)
+
+
+def _copy_file(source_file, output_fd):
+    """
+    Appends source_file to output_fd inside the kernel (copy_file_range or
+    sendfile), without reading it in user space.
+    """
+    size = os.path.getsize(source_file)
+    with open(source_file, "rb") as source:
+        copied = 0
+        while copied < size:
+            if hasattr(os, "copy_file_range"):
+                try:
+                    sent = os.copy_file_range(source.fileno(), output_fd, size - copied)
+                except OSError:
+                    sent = os.sendfile(output_fd, source.fileno(), copied, size - copied)
+                    os.lseek(source.fileno(), copied + sent, os.SEEK_SET)
+            else:
+                sent = os.sendfile(output_fd, source.fileno(), copied, size - copied)
+            if sent == 0:
+                break
+            copied += sent
+
+
+def _count_records(a3m_file):
+    with open_a3m(a3m_file, "rb") as a3m:
+        return sum(1 for line in a3m if line.startswith(b">"))
+
+
+def merge_homooligomer(colabfold_a3m, monomer_a3m, output_a3m):
+    fd, temp_file = _temporary_file(output_a3m)
+    try:
+        if any(is_compressed(a3m_file) for a3m_file in (colabfold_a3m, monomer_a3m, output_a3m)):
+            # Streamed through the (de)compressors
+            os.close(fd)
+            with open_a3m(temp_file, "wb") as output:
+                for a3m_file, separator in ((colabfold_a3m, b"\n"), (monomer_a3m, b"")):
+                    with open_a3m(a3m_file, "rb") as source:
+                        shutil.copyfileobj(source, output, 1 << 20)
+                    output.write(separator)
+        else:
+            _copy_file(colabfold_a3m, fd)
+            os.write(fd, b"\n")
+            _copy_file(monomer_a3m, fd)
+            os.close(fd)
+        os.chmod(temp_file, 0o644)
+        os.replace(temp_file, output_a3m)
+    except BaseException:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+
+    rows = []
+    for name, a3m_file in (("colabfold", colabfold_a3m), ("discoba_monomer", monomer_a3m)):
+        count = _count_records(a3m_file)
+        rows.append({"source": name, "file": a3m_file, "rows": count, "written": count,
+                     "duplicates": 0, "capped": 0})
+    return rows
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Merges the ColabFold and the Discoba MSAs of an IDs line.")
+    parser.add_argument("colabfold_a3m", help="ColabFold MSA (with cardinality line)")
+    parser.add_argument("discoba_a3m", help="Discoba paired+unpaired MSA (monomer MSA with --homooligomer)")
+    parser.add_argument("output_a3m", help="merged MSA (compressed if it ends with .zst or .gz)")
+    parser.add_argument("--homooligomer", action="store_true",
+                        help="append the Discoba monomer MSA as it is (kernel-level copy)")
+    parser.add_argument("--max-depth", type=int, help="maximum number of sequences (paired ones are kept first)")
+    args = parser.parse_args()
+
+    for a3m_file in (args.colabfold_a3m, args.discoba_a3m):
+        if not os.path.isfile(a3m_file):
+            parser.error(f"{a3m_file} is not a file")
+    if args.max_depth is not None and args.max_depth < 1:
+        parser.error("--max-depth must be a positive integer")
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    if args.homooligomer:
+        rows = merge_homooligomer(args.colabfold_a3m, args.discoba_a3m, args.output_a3m)
+    else:
+        rows = merge_heteromer(args.colabfold_a3m, args.discoba_a3m, args.output_a3m, args.max_depth)
+    write_manifest(args.output_a3m, rows, None if args.homooligomer else args.max_depth)
+
+    for row in rows:
+        print(f"{row['source']}: {row['written']}/{row['rows']} rows "
+              f"({row['duplicates']} duplicates, {row['capped']} over max depth)")
@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+"""
+Prometheus metrics of a DiscobaMultimer batch (node-exporter textfile).
+
+discoba-multimer_batch.sh starts this script in the background. It rewrites
+the metrics file every --interval seconds (atomically, as the textfile
+collector of node-exporter requires) until the processes it watches (the
+batch, or the GPU workers of -g) finish, and then writes it one last time.
+The metrics come from the files of the project:
+
+    job-state database (job_db.py)       lines per stage and status, jobs
+                                         running on each GPU
+    telemetry events (telemetry.py)      MSA rows per second
+    AF2 output directories               AF2 models per hour
+    cache lookups (telemetry.py)         hit rates of the result cache and of
+                                         the ColabFold MSA cache
+
+The file is ./reports/discoba_metrics.prom by default (DISCOBA_METRICS_FILE
+environment variable, e.g. the textfile directory of node-exporter). Every
+metric has a project label (name of the project folder). --check parses a
+metrics file and prints its samples, to verify it locally.
+"""
+
+import sys
+import os
+import argparse
+import glob
+import re
+import socket
+import subprocess
+import tempfile
+import time
+
+from a3m_utils import read_cardinality, parse_cardinality, find_a3m
+from job_db import connect, is_alive, paired_name, process_ancestors
+from telemetry import read_events, combined_length, CACHE_LOG
+
+METRICS_FILE = os.environ.get("DISCOBA_METRICS_FILE", "./reports/discoba_metrics.prom")
+
+# Outputs of the project (relative to the project folder)
+AF2_DIR = "./AF2"
+MERGED_MSA_DIR = "./merged_MSA"
+
+# Stages predicted on the GPUs
+GPU_STAGES = ("af2", "rf2")
+
+# Time window of the rates (seconds)
+RATE_WINDOW = 3600
+
+STATUSES = ("done", "failed", "skipped", "queued", "running", "interrupted", "pending")
+
+
+###############################################################################
+################################ Text format ##################################
+###############################################################################
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class MetricsText:
+    """
+    Metrics in the Prometheus text exposition format. Samples of the same
+    metric are written together after its HELP and TYPE lines.
+    """
+
+    def __init__(self, common_labels):
+        self.common_labels = common_labels
+        self.metrics = {}
+
+    def add(self, metric_name, metric_type, help_text, value, **labels):
+        metric = self.metrics.setdefault(metric_name, {"type": metric_type, "help": help_text, "samples": []})
+        metric["samples"].append(({**self.common_labels, **labels}, value))
+
+    def text(self):
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.append(f"# HELP {name} {metric['help']}")
+            lines.append(f"# TYPE {name} {metric['type']}")
+            for labels, value in metric["samples"]:
+                label_text = ",".join(f'{key}="{_escape(label)}"' for key, label in labels.items())
+                lines.append(f"{name}{{{label_text}}} {float(value):.15g}")
+        return "\n".join(lines) + "\n"
+
+
+_SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{(.*)\})? (\S+)$')
+_LABEL = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+
+
+def parse_textfile(metrics_file):
+    """
+    Parses a metrics file. Returns a list of (name, labels, value) and
+    raises ValueError if a line is not valid (sample without TYPE, bad
+    syntax or value).
+    """
+    samples, types = [], {}
+    with open(metrics_file) as metrics:
+        for number, line in enumerate(metrics, start=1):
+            line = line.rstrip("\n")
+            if not line:
+                continue
+            if line.startswith("# TYPE "):
+                _, _, name, metric_type = line.split(" ", 3)
+                if metric_type not in ("gauge", "counter"):
+                    raise ValueError(f"line {number}: unknown type {metric_type}")
+                types[name] = metric_type
+                continue
+            if line.startswith("#"):
+                continue
+            match = _SAMPLE.match(line)
+            if match is None:
+                raise ValueError(f"line {number}: invalid sample: {line}")
+            name, _, label_text, value = match.groups()
+            if name not in types:
+                raise ValueError(f"line {number}: {name} has no TYPE line")
+            labels = dict(_LABEL.findall(label_text or ""))
+            samples.append((name, labels, float(value)))
+    return samples
+
+
+def write_atomically(text, metrics_file):
+    directory = os.path.dirname(os.path.abspath(metrics_file))
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_file = tempfile.mkstemp(dir=directory, prefix=".tmp_", suffix=".prom")
+    with os.fdopen(fd, "w") as metrics:
+        metrics.write(text)
+    os.chmod(temp_file, 0o644)
+    os.replace(temp_file, metrics_file)
+
+
+###############################################################################
+################################## Collectors #################################
+###############################################################################
+
+def table_names(IDs_table_file):
+    names = []
+    if IDs_table_file and os.path.isfile(IDs_table_file):
+        with open(IDs_table_file) as IDs_table:
+            for line in IDs_table:
+                if line.startswith("#") or not line.strip():
+                    continue
+                names.append(paired_name(line.rstrip("\n").split("\t")))
+    return names
+
+
+def collect_lines(metrics, connection, names):
+    """
+    Lines of each stage by status. Lines of the IDs table without a job are
+    pending.
+    """
+    jobs = connection.execute("SELECT * FROM jobs").fetchall()
+    for stage in sorted({job["stage"] for job in jobs}):
+        counts = dict.fromkeys(STATUSES, 0)
+        recorded = set()
+        for job in jobs:
+            if job["stage"] != stage:
+                continue
+            recorded.add(job["name"])
+            status = job["status"]
+            if status in ("running", "queued") and not is_alive(job):
+                status = "interrupted"
+            counts[status] += 1
+        counts["pending"] = sum(1 for name in names if name not in recorded)
+        for status, count in counts.items():
+            metrics.add("discoba_lines", "gauge", "IDs lines of each stage by status.",
+                        count, stage=stage, status=status)
+    metrics.add("discoba_table_lines", "gauge", "IDs lines in the IDs table.", len(names))
+
+
+def process_GPU(pid, GPU_owners):
+    """
+    GPU of a job process: CUDA_VISIBLE_DEVICES of the process (GPU workers
+    of -g), or the GPU of its subprocess running on a GPU (nvidia-smi).
+    """
+    try:
+        with open(f"/proc/{pid}/environ", "rb") as environ:
+            for variable in environ.read().split(b"\0"):
+                if variable.startswith(b"CUDA_VISIBLE_DEVICES="):
+                    return variable.split(b"=", 1)[1].decode() or None
+    except OSError:
+        pass
+    return GPU_owners.get(pid)
+
+
+def GPU_owners_from_nvidia_smi():
+    """
+    {PID: GPU index} for the processes running on the GPUs and their
+    parent processes.
+    """
+    owners = {}
+    try:
+        GPU_indexes = {}
+        nvidia_smi = os.environ.get("NVIDIA_SMI", "nvidia-smi")
+        for line in subprocess.run([nvidia_smi, "--query-gpu=index,uuid", "--format=csv,noheader"],
+                                   capture_output=True, text=True).stdout.splitlines():
+            index, uuid = [field.strip() for field in line.split(",")]
+            GPU_indexes[uuid] = index
+        for line in subprocess.run([nvidia_smi, "--query-compute-apps=pid,gpu_uuid", "--format=csv,noheader"],
+                                   capture_output=True, text=True).stdout.splitlines():
+            pid, uuid = [field.strip() for field in line.split(",")]
+            for ancestor in process_ancestors(int(pid)):
+                owners.setdefault(ancestor, GPU_indexes.get(uuid, uuid))
+    except (OSError, ValueError):
+        pass
+    return owners
+
+
+def job_length(name, database=None):
+    """
+    Combined length of a line, from the cardinality line of its merged MSA
+    (compressed or not) or from the database.
+    """
+    merged_a3m = find_a3m(os.path.join(MERGED_MSA_DIR, name + ".a3m"))
+    cardinality = read_cardinality(merged_a3m) if merged_a3m else None
+    if cardinality:
+        lengths, copies = parse_cardinality(cardinality)
+        return sum(length * copy for length, copy in zip(lengths, copies))
+    if database:
+        return combined_length(database, name)
+    return None
+
+
+def collect_GPUs(metrics, connection, database=None):
+    """
+    Job running on each GPU and its combined length.
+    """
+    running = [job for job in connection.execute(
+        "SELECT * FROM jobs WHERE status = 'running' AND stage IN (%s)" % ",".join("?" * len(GPU_STAGES)),
+        GPU_STAGES) if job["host"] == socket.gethostname() and is_alive(job)]
+    GPU_owners = GPU_owners_from_nvidia_smi() if running else {}
+    for job in running:
+        GPU = process_GPU(job["pid"], GPU_owners) or "unknown"
+        metrics.add("discoba_gpu_active_job", "gauge", "Job running on each GPU (1 per job).",
+                    1, gpu=GPU, stage=job["stage"], name=job["name"])
+        length = job_length(job["name"], database)
+        if length is not None:
+            metrics.add("discoba_gpu_active_job_length", "gauge",
+                        "Combined length (residues) of the job running on each GPU.",
+                        length, gpu=GPU, stage=job["stage"], name=job["name"])
+
+
+def collect_MSA_rows(metrics, events, now, window=RATE_WINDOW):
+    """
+    Rows of the merged MSAs: total and rows per second in the last window.
+    """
+    merges = [event for event in events if event["stage"] == "msa_merge"
+              and not event.get("cached") and event["exit_code"] == 0 and event.get("depth")]
+    metrics.add("discoba_msa_rows_total", "counter", "Rows of the merged MSAs computed.",
+                sum(event["depth"] for event in merges))
+    recent = [event for event in merges if event["end"] >= now - window]
+    rate = 0.0
+    if recent:
+        first_start = min(event["start"] for event in events)
+        elapsed = now - max(now - window, first_start)
+        rate = sum(event["depth"] for event in recent) / elapsed if elapsed > 0 else 0.0
+    metrics.add("discoba_msa_rows_per_second", "gauge",
+                f"Rows of the merged MSAs computed per second (last {window} s).", rate)
+
+
+def collect_AF2_models(metrics, now, window=RATE_WINDOW):
+    """
+    AF2 models (unrelaxed PDBs) in the AF2 directory: total and models per
+    hour in the last window (by modification time).
+    """
+    total, recent, first = 0, 0, None
+    for pdb in glob.glob(os.path.join(AF2_DIR, "*", "*_unrelaxed_rank_*.pdb")):
+        try:
+            mtime = os.path.getmtime(pdb)
+        except OSError:
+            continue
+        total += 1
+        first = mtime if first is None else min(first, mtime)
+        if mtime >= now - window:
+            recent += 1
+    metrics.add("discoba_af2_models_total", "counter", "AF2 models in the AF2 directory.", total)
+    rate = 0.0
+    if recent:
+        elapsed = now - max(now - window, first)
+        rate = recent / elapsed * 3600 if elapsed > 0 else 0.0
+    metrics.add("discoba_af2_models_per_hour", "gauge", f"AF2 models per hour (last {window} s).", rate)
+
+
+def collect_cache_lookups(metrics, cache_log=None):
+    counts = {}
+    cache_log = cache_log or CACHE_LOG
+    if os.path.isfile(cache_log):
+        with open(cache_log) as lookups:
+            for line in lookups:
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) == 3:
+                    counts[(fields[1], fields[2])] = counts.get((fields[1], fields[2]), 0) + 1
+    for cache in sorted({cache for cache, _ in counts}):
+        hits, misses = counts.get((cache, "hit"), 0), counts.get((cache, "miss"), 0)
+        for outcome, count in (("hit", hits), ("miss", misses)):
+            metrics.add("discoba_cache_lookups_total", "counter", "Cache lookups by outcome.",
+                        count, cache=cache, outcome=outcome)
+        metrics.add("discoba_cache_hit_ratio", "gauge", "Fraction of cache lookups that were hits.",
+                    hits / (hits + misses) if hits + misses else 0.0, cache=cache)
+
+
+def collect(IDs_table_file=None, database=None, project=None):
+    """
+    Returns the text of the metrics file.
+    """
+    now = time.time()
+    metrics = MetricsText({"project": project or os.path.basename(os.getcwd())})
+    connection = connect()
+    try:
+        collect_lines(metrics, connection, table_names(IDs_table_file))
+        collect_GPUs(metrics, connection, database)
+    finally:
+        connection.close()
+    collect_MSA_rows(metrics, read_events(), now)
+    collect_AF2_models(metrics, now)
+    collect_cache_lookups(metrics)
+    metrics.add("discoba_metrics_last_update_timestamp_seconds", "gauge",
+                "Time of the last update of the metrics.", now)
+    return metrics.text()
+
+
+###############################################################################
+##################################### CLI #####################################
+###############################################################################
+
+def any_alive(PIDs):
+    for PID in PIDs:
+        try:
+            os.kill(PID, 0)
+            return True
+        except ProcessLookupError:
+            continue
+        except PermissionError:
+            return True
+    return False
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Prometheus textfile metrics of a DiscobaMultimer batch.")
+    parser.add_argument("--output", default=METRICS_FILE, help=f"metrics file (default {METRICS_FILE})")
+    parser.add_argument("--table", help="IDs table of the batch (to count the pending lines)")
+    parser.add_argument("--database", help="database (combined lengths of lines without merged MSA)")
+    parser.add_argument("--project", help="project label (default: name of the working directory)")
+    parser.add_argument("--interval", type=float, default=30, help="seconds between updates (default 30)")
+    parser.add_argument("--watch-pid", type=int, nargs="+", default=[], metavar="PID",
+                        help="update until these processes finish (default: write once)")
+    parser.add_argument("--check", metavar="FILE", help="parse a metrics file and print its samples")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    if args.check:
+        try:
+            samples = parse_textfile(args.check)
+        except (OSError, ValueError) as error:
+            print(f"ERROR: {args.check}: {error}", file=sys.stderr)
+            sys.exit(1)
+        for name, labels, value in samples:
+            label_text = ",".join(f"{key}={label}" for key, label in labels.items() if key != "project")
+            print(f"{name}\t{label_text}\t{value:g}")
+        sys.exit(0)
+
+    while True:
+        alive = any_alive(args.watch_pid)
+        try:
+            write_atomically(collect(args.table, args.database, args.project), args.output)
+        except Exception as error:
+            # A failed update (e.g. a file being written) must not stop the exporter
+            print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} WARNING: metrics not updated: {error}",
+                  file=sys.stderr, flush=True)
+            if not args.watch_pid:
+                sys.exit(1)
+        if not alive:
+            break
+        time.sleep(args.interval)
@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compact binary store of an a3m file (<name>.a3mb) that can be memory-mapped.
+
+Reading an a3m file means parsing its text and removing the lowercase
+insertions of every sequence again. A store keeps the MSA already split:
+
+    matches              (N, L) uint8 matrix of the match columns (the
+                         characters of the a3m without the insertions)
+    insertion_rows       (N+1) offsets, insertion runs of each row
+    insertion_columns    (R) int32, match column before which each run is
+                         inserted (L for runs at the end of a row)
+    insertion_offsets    (R+1) offsets, characters of each run in
+                         insertion_residues
+    insertion_residues   uint8, lowercase (and ".") characters of all runs
+    header_offsets       (N+1) offsets, header of each row in headers
+    headers              uint8, header lines (with ">") of all rows
+    taxid_index          (N) int32, index of the TaxID of each row in the
+                         "taxids" list of the header (-1 if none)
+
+The file starts with MAGIC, the length of a JSON header (little-endian
+uint64) and the JSON header (cardinality line, TaxIDs and the offset, dtype
+and shape of each array). Offsets are int32 (int64 if they do not fit).
+Arrays are aligned to 64 bytes, so MSAStore maps them with np.frombuffer
+without copying anything.
+
+A store is exported back to the exact a3m it was packed from. Files that
+are not in the one-line-per-record layout written by the pipeline (e.g.
+wrapped sequences) are refused, unless --normalize is used to store their
+records as a3m_utils.read_a3m reads them.
+
+    python msa_store.py pack merged_MSA/*.a3m          # writes merged_MSA/<name>.a3mb
+    python msa_store.py unpack <name>.a3mb [<name>.a3m]
+    python msa_store.py info <name>.a3mb
+
+The scripts that read a3m files with a3m_utils also accept stores.
+"""
+
+import sys
+import os
+import argparse
+import json
+import mmap
+import re
+import struct
+import tempfile
+
+import numpy as np
+
+MAGIC = b"DMSTORE1"
+STORE_EXTENSION = ".a3mb"
+ALIGNMENT = 64
+
+TAXID = re.compile(rb"TaxID=(\w+)")
+
+# Characters of the insertions: lowercase letters and "."
+_INSERTION = np.zeros(256, dtype=bool)
+_INSERTION[ord("a"):ord("z") + 1] = True
+_INSERTION[ord(".")] = True
+
+
+def is_store(path):
+    return str(path).endswith(STORE_EXTENSION)
+
+
+def store_path(a3m_file):
+    from a3m_utils import strip_compression
+    root, extension = os.path.splitext(strip_compression(a3m_file))
+    return (root if extension == ".a3m" else a3m_file) + STORE_EXTENSION
+
+
+###############################################################################
+################################### Packing ###################################
+###############################################################################
+
+def _split_records(data):
+    """
+    Returns (cardinality, headers, sequences) of an a3m in the one-line layout
+    (bytes), or None if the file has another layout.
+    """
+    if data and not data.endswith(b"\n"):
+        return None
+    lines = data.split(b"\n")[:-1]
+    cardinality = None
+    if lines and lines[0].startswith(b"#"):
+        cardinality, lines = lines[0], lines[1:]
+    headers, sequences = lines[0::2], lines[1::2]
+    if len(headers) != len(sequences):
+        return None
+    if not all(header.startswith(b">") for header in headers):
+        return None
+    if any(sequence.startswith(b">") or not sequence or sequence != sequence.strip() for sequence in sequences):
+        return None
+    return cardinality, headers, sequences
+
+
+def _normalized_records(a3m_file):
+    from a3m_utils import read_a3m
+    cardinality, records = read_a3m(a3m_file)
+    return (cardinality.encode() if cardinality is not None else None,
+            [header.encode() for header, _ in records], [sequence.encode() for _, sequence in records])
+
+
+def _offsets(lengths):
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+def _narrow(offsets):
+    """
+    Offsets as int32 if they fit (most MSAs), to keep the stores small.
+    """
+    return offsets.astype(np.int32) if offsets[-1] < 2 ** 31 else offsets
+
+
+def encode_msa(cardinality, headers, sequences):
+    """
+    Splits the records of an a3m (bytes) into the arrays of a store.
+
+    Returns
+    -------
+    header : dict
+        Cardinality line and TaxIDs of the store.
+    arrays : dict
+        Arrays of the store (see the module docstring).
+
+    """
+    n_rows = len(sequences)
+    residues = np.frombuffer(b"".join(sequences), dtype=np.uint8)
+    row_offsets = _offsets([len(sequence) for sequence in sequences])
+    inserted = _INSERTION[residues]
+
+    # Match columns of each row (number of match characters before each position)
+    matched_before = _offsets(~inserted)
+    match_counts = matched_before[row_offsets[1:]] - matched_before[row_offsets[:-1]]
+    n_columns = int(match_counts[0]) if n_rows else 0
+    wrong = np.flatnonzero(match_counts != n_columns)
+    if len(wrong):
+        raise ValueError(f"record {wrong[0] + 1} has {match_counts[wrong[0]]} match columns "
+                         f"and the query has {n_columns}")
+    matches = residues[~inserted].reshape(n_rows, n_columns)
+
+    # Insertion runs: insertion characters after a match character or at the start of a row
+    row_starts = np.zeros(len(residues), dtype=bool)
+    row_starts[row_offsets[:-1][row_offsets[:-1] < len(residues)]] = True
+    after_insertion = np.zeros(len(residues), dtype=bool)
+    after_insertion[1:] = inserted[:-1]
+    run_starts = np.flatnonzero(inserted & (row_starts | ~after_insertion))
+    run_rows = np.searchsorted(row_offsets, run_starts, side="right") - 1
+    insertion_columns = (matched_before[run_starts] - matched_before[row_offsets[run_rows]]).astype(np.int32)
+    inserted_before = _offsets(inserted)
+    insertion_offsets = _narrow(np.append(inserted_before[run_starts], inserted_before[-1]))
+    insertion_rows = _narrow(np.searchsorted(run_rows, np.arange(n_rows + 1), side="left"))
+
+    taxids, taxid_index = {}, np.full(n_rows, -1, dtype=np.int32)
+    for row, header in enumerate(headers):
+        match = TAXID.search(header)
+        if match:
+            taxid_index[row] = taxids.setdefault(match.group(1).decode(), len(taxids))
+
+    header = {"cardinality": cardinality.decode() if cardinality is not None else None,
+              "rows": n_rows, "columns": n_columns, "taxids": list(taxids)}
+    arrays = {
+        "matches": matches,
+        "insertion_rows": insertion_rows,
+        "insertion_columns": insertion_columns,
+        "insertion_offsets": insertion_offsets,
+        "insertion_residues": residues[inserted],
+        "header_offsets": _narrow(_offsets([len(line) for line in headers])),
+        "headers": np.frombuffer(b"".join(headers), dtype=np.uint8),
+        "taxid_index": taxid_index,
+    }
+    return header, arrays
+
+
+def write_store(store_file, header, arrays):
+    """
+    Writes a store atomically (temporary file renamed when complete).
+    """
+    header = dict(header, arrays={})
+    position = 0
+    for name, array in arrays.items():
+        position = -(-position // ALIGNMENT) * ALIGNMENT
+        header["arrays"][name] = {"offset": position, "dtype": array.dtype.str, "shape": list(array.shape)}
+        position += array.nbytes
+    header_bytes = json.dumps(header).encode()
+    # Data starts aligned after MAGIC, the header length and the header
+    data_start = -(-(len(MAGIC) + 8 + len(header_bytes)) // ALIGNMENT) * ALIGNMENT
+
+    output_dir = os.path.dirname(os.path.abspath(store_file))
+    fd, temp_file = tempfile.mkstemp(prefix=".tmp_", suffix=STORE_EXTENSION, dir=output_dir)
+    try:
+        with os.fdopen(fd, "wb") as store:
+            store.write(MAGIC + struct.pack("<Q", len(header_bytes)) + header_bytes)
+            for name, array in arrays.items():
+                store.write(b"\0" * (data_start + header["arrays"][name]["offset"] - store.tell()))
+                store.write(np.ascontiguousarray(array).tobytes())
+        os.replace(temp_file, store_file)
+    except BaseException:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+
+
+def pack_a3m(a3m_file, store_file=None, normalize=False):
+    """
+    Packs an a3m file into a store (by default <name>.a3mb next to it).
+
+    Parameters
+    ----------
+    a3m_file : str
+        Path to the a3m file.
+    store_file : str, optional
+        Path of the store.
+    normalize : bool
+        Store the records of files that are not in the one-line layout (their
+        export is the a3m written by a3m_utils.write_a3m, not the original).
+
+    Returns
+    -------
+    store_file : str
+        Path of the store.
+
+    """
+    from a3m_utils import open_a3m
+    store_file = store_file or store_path(a3m_file)
+    with open_a3m(a3m_file, "rb") as a3m:
+        data = a3m.read()
+    split = _split_records(data)
+    if split is None:
+        if not normalize:
+            raise ValueError(f"{a3m_file} is not in the one-line-per-record layout "
+                             "(use --normalize to store its records)")
+        split = _normalized_records(a3m_file)
+    header, arrays = encode_msa(*split)
+    write_store(store_file, header, arrays)
+    return store_file
+
+
+###############################################################################
+################################### Reading ###################################
+###############################################################################
+
+class MSAStore:
+    """
+    Memory-mapped store. The arrays (matches, taxid_index, ...) are read-only
+    views of the file: only the pages used are read.
+    """
+    def __init__(self, store_file):
+        self.store_file = store_file
+        with open(store_file, "rb") as store:
+            self._map = mmap.mmap(store.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{store_file} is not an MSA store")
+        (header_length,) = struct.unpack_from("<Q", self._map, len(MAGIC))
+        header_start = len(MAGIC) + 8
+        header = json.loads(self._map[header_start:header_start + header_length])
+        data_start = -(-(header_start + header_length) // ALIGNMENT) * ALIGNMENT
+
+        self.cardinality = header["cardinality"]
+        self.n_rows = header["rows"]
+        self.n_columns = header["columns"]
+        self.taxids = header["taxids"]
+        for name, array in header["arrays"].items():
+            dtype = np.dtype(array["dtype"])
+            count = int(np.prod(array["shape"], dtype=np.int64))
+            view = np.frombuffer(self._map, dtype=dtype, count=count, offset=data_start + array["offset"])
+            setattr(self, name, view.reshape(array["shape"]))
+
+    def __len__(self):
+        return self.n_rows
+
+    def header(self, row):
+        start, end = self.header_offsets[row:row + 2]
+        return self.headers[start:end].tobytes().decode()
+
+    def taxid(self, row):
+        index = self.taxid_index[row]
+        return self.taxids[index] if index >= 0 else None
+
+    def insertions(self, row):
+        """
+        Returns the [(column, residues)] insertion runs of a row.
+        """
+        runs = []
+        for run in range(self.insertion_rows[row], self.insertion_rows[row + 1]):
+            start, end = self.insertion_offsets[run:run + 2]
+            runs.append((int(self.insertion_columns[run]), self.insertion_residues[start:end].tobytes().decode()))
+        return runs
+
+    def sequence(self, row):
+        """
+        Returns the a3m sequence of a row (match columns and insertions).
+        """
+        matches = self.matches[row].tobytes().decode()
+        pieces, previous = [], 0
+        for column, residues in self.insertions(row):
+            pieces += [matches[previous:column], residues]
+            previous = column
+        pieces.append(matches[previous:])
+        return "".join(pieces)
+
+    def records(self):
+        for row in range(self.n_rows):
+            yield self.header(row), self.sequence(row)
+
+
+def unpack_store(store_file, a3m_file=None):
+    """
+    Writes the a3m file of a store (by default <name>.a3m next to it).
+    """
+    from a3m_utils import write_a3m
+    a3m_file = a3m_file or store_file[:-len(STORE_EXTENSION)] + ".a3m"
+    store = MSAStore(store_file)
+    write_a3m(a3m_file, store.records(), store.cardinality)
+    return a3m_file
+
+
+###############################################################################
+##################################### CLI #####################################
+###############################################################################
+
+def _pack(arguments):
+    a3m_file, store_file, normalize = arguments
+    try:
+        return a3m_file, pack_a3m(a3m_file, store_file, normalize), None
+    except (OSError, ValueError) as error:
+        return a3m_file, None, str(error)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Compact binary store of a3m files.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    pack = commands.add_parser("pack", help="pack a3m files into stores (<name>.a3mb next to each one)")
+    pack.add_argument("a3m_files", nargs="+")
+    pack.add_argument("-o", "--output", help="path of the store (only with one a3m file)")
+    pack.add_argument("--normalize", action="store_true",
+                      help="pack files that are not in the one-line layout (their export will not be exact)")
+    pack.add_argument("--jobs", type=int, default=os.cpu_count(), help="files packed at the same time")
+
+    unpack = commands.add_parser("unpack", help="export a store to its a3m file")
+    unpack.add_argument("store_file")
+    unpack.add_argument("a3m_file", nargs="?", help="default: <name>.a3m next to the store")
+
+    info = commands.add_parser("info", help="print the size, cardinality and TaxIDs of a store")
+    info.add_argument("store_file")
+    args = parser.parse_args()
+    if args.command == "pack" and args.output and len(args.a3m_files) > 1:
+        parser.error("--output can only be used with one a3m file")
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    if args.command == "pack":
+        jobs = [(a3m_file, args.output, args.normalize) for a3m_file in args.a3m_files]
+        if len(jobs) == 1 or args.jobs <= 1:
+            results = map(_pack, jobs)
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+            results = ProcessPoolExecutor(max_workers=args.jobs).map(_pack, jobs, chunksize=8)
+        failed = 0
+        for a3m_file, store_file, error in results:
+            if error:
+                failed += 1
+                print(f"ERROR: {a3m_file}: {error}", file=sys.stderr)
+            else:
+                print(f"{a3m_file} -> {store_file}")
+        sys.exit(1 if failed else 0)
+
+    if not os.path.isfile(args.store_file):
+        print(f"ERROR: {args.store_file} is not a file", file=sys.stderr)
+        sys.exit(1)
+    try:
+        if args.command == "unpack":
+            print(f"{args.store_file} -> {unpack_store(args.store_file, args.a3m_file)}")
+        else:
+            store = MSAStore(args.store_file)
+            insertions = len(store.insertion_columns)
+            print(f"rows\t{store.n_rows}\ncolumns\t{store.n_columns}\ncardinality\t{store.cardinality}\n"
+                  f"insertions\t{insertions} runs, {len(store.insertion_residues)} residues\n"
+                  f"taxids\t{len(store.taxids)}")
+    except ValueError as error:
+        print(f"ERROR: {error}", file=sys.stderr)
+        sys.exit(1)
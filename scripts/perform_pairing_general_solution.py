@@ -7,16 +7,10 @@ Created on Sun Feb 26 12:18:04 2023
 
 This script performs the pairing of two or more a3m discoba MSAs
 """
-# Remove deprecation warning
-import warnings
-from Bio import BiopythonDeprecationWarning
-warnings.simplefilter(action='ignore', category=BiopythonDeprecationWarning)
-
 import sys
 import os
-from Bio import SeqIO, pairwise2
 import re
-from Bio.Align import PairwiseAligner
+import tempfile
 from collections import Counter
 
 
@@ -45,6 +39,11 @@ if len(sys.argv) < 4:
     print("   output.a3m     : paired+unpaired a3m file with cardinality")
     sys.exit(1)
 
+# Biopython is imported once the arguments are checked (the aligners only
+# when they are used)
+from Bio import SeqIO
+from a3m_utils import open_a3m, strip_compression
+
 
 # Assign the command-line arguments to variables
 output_file = sys.argv[1]   # output file name and path
@@ -60,14 +59,30 @@ for i in range(2, len(sys.argv)):
 
 # Check if input files are in .a3m format
 for a3m_file in a3m_files.values():
-    if not a3m_file.endswith('.a3m'):
-        print("ERROR: Input files must be in .a3m format.", file=sys.stderr)
+    if not strip_compression(a3m_file).endswith('.a3m'):
+        print("ERROR: Input files must be in .a3m format (.a3m.zst and .a3m.gz are also accepted).", file=sys.stderr)
         sys.exit(1)
 
+# Opt-in profiling (DISCOBA_PROFILE, see profiling.py)
+from profiling import profile_if_enabled
+profile_if_enabled(os.path.splitext(os.path.basename(output_file))[0], output_file)
+
 ###############################################################################
 ############################### Helper functions ##############################
 ###############################################################################
 
+def parse_a3m(a3m_file):
+    """
+    Iterates over the records of a plain or compressed (.zst or .gz) a3m file.
+    The cardinality line is skipped (newer Biopython versions reject it).
+    """
+    with open_a3m(a3m_file) as handle:
+        has_cardinality = handle.read(1) == "#"
+    with open_a3m(a3m_file) as handle:
+        if has_cardinality:
+            handle.readline()
+        yield from SeqIO.parse(handle, "fasta")
+
 # Function to check if it is an homooligomer
 def is_homooligomer(a3m_files):
     """
@@ -235,7 +250,7 @@ def separate_by_tax_id(a3m_file):
     """
     
     # Load the a3m files
-    records = SeqIO.parse(a3m_file, "fasta")
+    records = parse_a3m(a3m_file)
     
     # Create an empty dictionary to store the records in the first a3m file
     records_by_taxid = {}
@@ -298,6 +313,13 @@ def global_alignment(query_seq, subject_seq):
         - Alignment score
     """
     
+    # Bio.pairwise2 is deprecated (imported without its deprecation warning)
+    import warnings
+    from Bio import BiopythonDeprecationWarning
+    with warnings.catch_warnings():
+        warnings.simplefilter(action='ignore', category=BiopythonDeprecationWarning)
+        from Bio import pairwise2
+
     alignments = pairwise2.align.globalxx(query_seq, subject_seq)
     best_alignment = alignments[0]  # Get the highest-scoring alignment
     aligned_query = best_alignment[0]
@@ -389,10 +411,11 @@ def sort_by_similarity_to_query(taxid_grouped):
 
 def sort_protein_sequences_by_similarity(input_file, output_file):
     # read in fasta file
-    records = list(SeqIO.parse(input_file, "fasta"))
+    records = list(parse_a3m(input_file))
     # set first sequence as reference
     reference_seq = records[0].seq
     # create PairwiseAligner object for global alignment
+    from Bio.Align import PairwiseAligner
     aligner = PairwiseAligner()
     aligner.mode = 'global'
     # calculate similarity scores for each sequence
@@ -546,9 +569,13 @@ def pair_a3m(grouped_sorted_a3m_list, output_file, min_coverage):
                         f.write(paired_subj_header+'\n')
                         f.write(paired_subj_seq+'\n')
     
-    sort_protein_sequences_by_similarity(output_file, "temporal_file")
-    insert_string_as_first_line("temporal_file", cardinality)
-    os.rename("temporal_file", output_file)
+    # Unique temporary file: other pairings can run in the same directory
+    fd, temporal_file = tempfile.mkstemp(prefix=".temporal_", dir=os.path.dirname(os.path.abspath(output_file)))
+    os.close(fd)
+    os.chmod(temporal_file, os.stat(output_file).st_mode & 0o777)
+    sort_protein_sequences_by_similarity(output_file, temporal_file)
+    insert_string_as_first_line(temporal_file, cardinality)
+    os.replace(temporal_file, output_file)
     
 # # Debug
 # grouped_by_taxid_a3m = separate_by_tax_id(a3m_files["a3m_1"])
@@ -588,7 +615,7 @@ def add_unpaired(output_file, a3m_files):
     for a3m_position in a3m_files.keys():
         
         # Load records
-        records = SeqIO.parse(a3m_files[a3m_position], "fasta")
+        records = parse_a3m(a3m_files[a3m_position])
         
         # Extract queries
         query = next(records)
@@ -617,7 +644,7 @@ def add_unpaired(output_file, a3m_files):
         position=int(a3m_key.split('_')[1])-1
         
         # Load records
-        records = SeqIO.parse(a3m_files[a3m_key], "fasta")
+        records = parse_a3m(a3m_files[a3m_key])
         
         # Jump query
         next(records)
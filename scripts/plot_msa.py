@@ -1,16 +1,15 @@
-import numpy as np
-import matplotlib.pyplot as plt
-from Bio import AlignIO
 import sys
 import os
 
 # Check that two command-line arguments have been provided
 if len(sys.argv) != 2:
-    print("USAGE: python plot_msa.py <input_msa.a3m>", file=sys.stderr)
+    print("USAGE: python plot_msa.py <input_msa.a3m|input_msa.a3m.zst|input_msa.a3m.gz|input_msa.a3mb>", file=sys.stderr)
     print("OUTPUT:")
     print("   input_msa_msa.png     : png file with the same name as the input")
     sys.exit(1)
 
+from a3m_utils import open_a3m, strip_compression, find_a3m
+
 def blosum62_score(res1, res2):
     blosum62 = { 
     ('A', 'A'): 4, ('R', 'A'):  -1, ('N', 'A'):  -2, ('D', 'A'):  -2, ('C', 'A'):  0, ('Q', 'A'):  -1, ('E', 'A'):  -1, ('G', 'A'):  0, ('H', 'A'):  -2, ('I', 'A'):  -1, ('L', 'A'):  -1, ('K', 'A'):  -1, ('M', 'A'):  -1, ('F', 'A'):  -2, ('P', 'A'):  -1, ('S', 'A'):  1, ('T', 'A'):  0, ('W', 'A'):  -3, ('Y', 'A'):  -2, ('V', 'A'):  0, 
@@ -38,25 +37,28 @@ def blosum62_score(res1, res2):
         return blosum62[(res1, res2)]
     except KeyError:
         if res2 == "-":
-            return np.nan
+            return float("nan")
         return 0
 
-def plot_msa(msa_file):
+def a3m_similarity_matrix(msa_file):
+    # Imported only when an a3m file is plotted
+    import numpy as np
+    from Bio import AlignIO
     
-    with open(msa_file, "r") as file_read:
+    with open_a3m(msa_file, "r") as file_read:
         for i, line in enumerate(file_read):
             if i == 0:
                 cardinality = line.lstrip("#").replace("\t", "   ")
             else:
                 break
     
-    header_to_plot = msa_file.split("/")[-1].replace(".a3m", "").replace("__vs__", ":") + "\n"
-    
     # Remove lowercase letters from file and save it as temporal
-    with open(msa_file, 'r') as f:
+    with open_a3m(msa_file, 'r') as f:
         text = f.read()
+    if text.startswith("#"):
+        text = text.split("\n", 1)[1]     # cardinality (newer Biopython versions reject it)
     new_text = ''.join(c for c in text if not c.islower())
-    new_filename = msa_file + '_temporal'
+    new_filename = strip_compression(msa_file) + '_temporal'
     with open(new_filename, 'w') as f:
         f.write(new_text)
 
@@ -76,6 +78,39 @@ def plot_msa(msa_file):
         for j in range(num_seqs):
             other_res = alignment[j][i]
             similarity_matrix[j,i] = blosum62_score(query_res, other_res)
+
+    # Remove temporal file	
+    os.remove(new_filename)
+    
+    return cardinality, similarity_matrix
+
+def store_similarity_matrix(store_file):
+    """
+    BLOSUM62 scores of the match columns of an MSA store (see msa_store.py)
+    to the query, looked up on its uint8 matrix without parsing any text.
+    """
+    import numpy as np
+    from msa_store import MSAStore
+    store = MSAStore(store_file)
+    lookup = np.zeros((256, 256))
+    codes = np.unique(store.matches)
+    for query_code in np.unique(store.matches[0]):
+        for other_code in codes:
+            lookup[query_code, other_code] = blosum62_score(chr(query_code), chr(other_code))
+    cardinality = (store.cardinality or "").lstrip("#").replace("\t", "   ") + "\n"
+    return cardinality, lookup[store.matches[0][np.newaxis, :], store.matches]
+
+def plot_msa(msa_file):
+    # Imported only when plotting
+    import matplotlib.pyplot as plt
+    
+    msa_name = strip_compression(msa_file).split("/")[-1].replace(".a3mb", ".a3m")
+    header_to_plot = msa_name.replace(".a3m", "").replace("__vs__", ":") + "\n"
+    
+    if msa_file.endswith(".a3mb"):
+        cardinality, similarity_matrix = store_similarity_matrix(msa_file)
+    else:
+        cardinality, similarity_matrix = a3m_similarity_matrix(msa_file)
     
     # Plot the similarity matrix as a heatmap
     plt.imshow(similarity_matrix, cmap='rainbow', vmin=-4, vmax=9)
@@ -89,12 +124,17 @@ def plot_msa(msa_file):
     plt.ylabel('Sequences')
     
     # Save the plot
-    out_file = str(msa_file).split("/")[-1]
-    out_file = out_file.replace(".a3m", "_msa.png")
+    out_file = msa_name.replace(".a3m", "_msa.png")
     plt.savefig(out_file, dpi=300)
 
-    # Remove temporal file	
-    os.remove(new_filename)
+# The compressed MSA is plotted if the a3m file was compressed
+a3m_file=sys.argv[1] if sys.argv[1].endswith(".a3mb") else (find_a3m(sys.argv[1]) or sys.argv[1])
+if not os.path.isfile(a3m_file):
+    print(f"ERROR: {a3m_file} not found", file=sys.stderr)
+    sys.exit(1)
+
+# Opt-in profiling (DISCOBA_PROFILE, see profiling.py)
+from profiling import profile_if_enabled
+profile_if_enabled(os.path.splitext(os.path.basename(strip_compression(a3m_file)))[0], ".")
 
-a3m_file=sys.argv[1]
 plot_msa(a3m_file)
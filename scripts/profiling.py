@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in profiling of the Python helpers.
+
+The helpers (pairing, a3m reformatting and plots) call profile_if_enabled()
+once their arguments are parsed. When the DISCOBA_PROFILE environment
+variable is not set it returns immediately (profiling costs nothing).
+When it is set, the invocation is profiled with cProfile and tracemalloc and,
+when the script exits, two files named after the paired name (or ID) are
+written next to the output of the script:
+
+    <name>.<script>.prof        cProfile stats (pstats, snakeviz, ...)
+    <name>.<script>.alloc.tsv   top allocations by line (tracemalloc), with
+                                the wall time and the peak traced memory
+
+DISCOBA_PROFILE=1 writes them next to the outputs. Any other value is used
+as the directory to write them (e.g. DISCOBA_PROFILE=$PWD/reports/profiles
+to collect the profiles of a whole batch; use an absolute path, as some
+helpers run in temporary directories). Use utils/aggregate_profiles.py to
+summarize the profiles of a batch.
+"""
+
+import sys
+import os
+
+# Allocation locations written per invocation
+TOP_ALLOCATIONS = 25
+
+_ALLOC_COLUMNS = ["size_KB", "count", "location"]
+
+
+def profile_names(name, script):
+    """
+    Names of the profile files of a script invocation (the script tag has
+    no dots, so the name can be recovered with rsplit).
+    """
+    tag = os.path.splitext(os.path.basename(script))[0].replace(".", "_")
+    return f"{name}.{tag}.prof", f"{name}.{tag}.alloc.tsv"
+
+
+def profile_if_enabled(name, output_path="."):
+    """
+    Profiles this invocation if DISCOBA_PROFILE is set.
+
+    Parameters
+    ----------
+    name : str
+        Paired name (or ID) the profiles are named after.
+    output_path : str
+        Output file (or directory) of the script: the profiles are written
+        in its directory unless DISCOBA_PROFILE gives a directory.
+
+    """
+    setting = os.environ.get("DISCOBA_PROFILE")
+    if not setting or setting.lower() in ("0", "false", "no"):
+        return
+
+    # Imported only when profiling
+    import atexit
+    import cProfile
+    import time
+    import tracemalloc
+
+    if setting.lower() not in ("1", "true", "yes"):
+        profile_dir = setting
+    elif os.path.isdir(output_path):
+        profile_dir = output_path
+    else:
+        profile_dir = os.path.dirname(os.path.abspath(output_path))
+    prof_name, alloc_name = profile_names(name, sys.argv[0])
+    prof_file = os.path.join(profile_dir, prof_name)
+    alloc_file = os.path.join(profile_dir, alloc_name)
+
+    tracemalloc.start()
+    profiler = cProfile.Profile()
+    start = time.time()
+
+    def write_profiles():
+        profiler.disable()
+        wall_s = time.time() - start
+        snapshot = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        os.makedirs(profile_dir, exist_ok=True)
+        profiler.dump_stats(prof_file)
+        with open(alloc_file, "w") as alloc:
+            alloc.write(f"# name: {name}\tscript: {os.path.basename(sys.argv[0])}\t"
+                        f"wall_s: {wall_s:.3f}\tpeak_KB: {peak / 1024:.1f}\n")
+            alloc.write("\t".join(_ALLOC_COLUMNS) + "\n")
+            for statistic in snapshot.statistics("lineno")[:TOP_ALLOCATIONS]:
+                frame = statistic.traceback[0]
+                alloc.write(f"{statistic.size / 1024:.1f}\t{statistic.count}\t"
+                            f"{frame.filename}:{frame.lineno}\n")
+        print(f"Profiles saved in {prof_file} and {alloc_file}", file=sys.stderr)
+
+    atexit.register(write_profiles)
+    profiler.enable()
@@ -17,6 +17,10 @@ if len(sys.argv) != 2:
 # Parse argument
 ID = sys.argv[1] 
 
+# Opt-in profiling (DISCOBA_PROFILE, see profiling.py)
+from profiling import profile_if_enabled
+profile_if_enabled(ID, f"{ID}.a3m")
+
 # libraries needed
 import re
 
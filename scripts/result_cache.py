@@ -0,0 +1,408 @@
+# -*- coding: utf-8 -*-
+"""
+Content-addressed cache of DiscobaMultimer results and canonical ordering of
+chain permutations.
+
+Canonical ordering
+------------------
+A__vs__B and B__vs__A are the same complex. Before any GPU time is spent, the
+lines of the IDs table are rewritten in a canonical order: the permutation
+that already has results in the working directory (merged MSA, AF2 or RF2-track
+outputs) or, if none has, the IDs sorted alphabetically. Permutations of a line
+already in the table are removed, and the names of the permutations requested
+by the user are linked to the canonical outputs (symlinks), so both names
+work. The linked outputs are not reordered: their chain order (models,
+per-chain pLDDT, MSA blocks, contact maps) and the names of their files are
+the ones of the canonical name.
+
+Result cache
+------------
+Results are keyed by the SHA-256 hash of what determines them: the kind of
+result (AF2, RF2), the ordered chain sequences, the MSA content and the
+options of the prediction (e.g. AF2.config options, or the RF2-track options
+and the GPU memory, which decides the MSA depth). Each stored result is
+kept in the cache as hard links to its files (copies if the cache is on
+another file system), so renaming or removing the project folder does not
+change it. An equivalent request (same key) is satisfied by hard linking (or
+copying, with DISCOBA_CACHE_MODE=copy) the cached files to its output
+directory, renamed after it, instead of computing it again. The cache is
+located in DISCOBA_CACHE (default ~/.cache/DiscobaMultimer), so it is shared
+between projects.
+"""
+
+import sys
+import os
+import argparse
+import hashlib
+import itertools
+import glob
+import shutil
+
+from a3m_utils import find_a3m, open_a3m
+from telemetry import record_cache_lookup
+
+# Cache location and mode
+CACHE_DIR = os.environ.get("DISCOBA_CACHE", os.path.expanduser("~/.cache/DiscobaMultimer"))
+CACHE_MODE = os.environ.get("DISCOBA_CACHE_MODE", "link")
+
+# Outputs of each stage named after the IDs line (relative to the working
+# directory). {} is replaced by the paired name (ID1__vs__ID2...)
+STAGE_OUTPUTS = {
+    "msa": "./merged_MSA/{}.a3m",
+    "af2": "./AF2/{}",
+    "rf2": "./RoseTTAFold_2track_results/{}",
+}
+
+
+def paired_name(IDs):
+    return "__vs__".join(IDs)
+
+
+def stage_output(stage, name):
+    """
+    Path of the output of a stage. MSAs can be compressed (.a3m.zst or
+    .a3m.gz): the compressed MSA is returned if only it exists.
+    """
+    output = STAGE_OUTPUTS[stage].format(name)
+    if output.endswith(".a3m"):
+        return find_a3m(output) or output
+    return output
+
+
+###############################################################################
+############################# Canonical ordering ##############################
+###############################################################################
+
+def canonical_order(IDs, msa_dir=None):
+    """
+    Returns the canonical order of the IDs of a line.
+
+    Parameters
+    ----------
+    IDs : list of str
+        IDs of the line, in the order given by the user.
+    msa_dir : str, optional
+        Directory with the MSAs to use (-i option). The chosen order must
+        have an MSA there.
+
+    Returns
+    -------
+    list of str
+        The first permutation with existing results in the working
+        directory (or with an MSA in msa_dir) or the sorted IDs.
+
+    """
+    candidates = [sorted(IDs), list(IDs)]
+    candidates += [list(p) for p in itertools.permutations(IDs) if len(IDs) <= 4]
+
+    if msa_dir is not None:
+        for candidate in candidates:
+            if find_a3m(os.path.join(msa_dir, paired_name(candidate) + ".a3m")):
+                return candidate
+        return list(IDs)
+
+    for candidate in candidates:
+        name = paired_name(candidate)
+        if any(os.path.exists(stage_output(stage, name)) for stage in STAGE_OUTPUTS):
+            return candidate
+    return candidates[0]
+
+
+def link_permutation(original, canonical, stages):
+    """
+    Links the outputs of the original permutation name to the canonical ones
+    (relative symlinks, they can be created before the outputs exist).
+    The outputs keep the chain order of the canonical name. Compressed MSAs
+    are linked with their compression extension. Existing files are never
+    replaced.
+    """
+    for stage in stages:
+        target = stage_output(stage, canonical)
+        link = STAGE_OUTPUTS[stage].format(original) + target[len(STAGE_OUTPUTS[stage].format(canonical)):]
+        if os.path.lexists(link) or os.path.lexists(stage_output(stage, original)):
+            continue
+        os.makedirs(os.path.dirname(link), exist_ok=True)
+        os.symlink(os.path.basename(target), link)
+
+
+def canonicalize_table(IDs_table_file, output_file, stages=(), msa_dir=None):
+    """
+    Writes the IDs table with the lines in canonical order and without
+    permutations of previous lines. Comments are kept.
+
+    Returns
+    -------
+    permutations : list of tuple
+        (original name, canonical name) of the lines that were changed.
+
+    """
+    seen = set()
+    permutations = []
+    with open(IDs_table_file) as IDs_table, open(output_file + ".tmp", "w") as output:
+        for line in IDs_table:
+            if line.startswith("#") or not line.strip():
+                output.write(line)
+                continue
+            IDs = line.rstrip("\n").split("\t")
+            canonical = canonical_order(IDs, msa_dir)
+            original_name, canonical_name = paired_name(IDs), paired_name(canonical)
+
+            if original_name != canonical_name:
+                permutations.append((original_name, canonical_name))
+                link_permutation(original_name, canonical_name, stages)
+
+            if canonical_name in seen:
+                continue
+            seen.add(canonical_name)
+            output.write("\t".join(canonical) + "\n")
+    os.replace(output_file + ".tmp", output_file)
+    return permutations
+
+
+###############################################################################
+################################ Result cache #################################
+###############################################################################
+
+def read_sequences(database, IDs):
+    """
+    Returns {ID: sequence} for the IDs in the fasta database.
+    """
+    wanted = set(IDs)
+    sequences = {}
+    current = None
+    with open(database) as fasta:
+        for line in fasta:
+            line = line.strip()
+            if line.startswith(">"):
+                current = line[1:] if line[1:] in wanted else None
+                if current is not None:
+                    sequences[current] = []
+            elif current is not None:
+                sequences[current].append(line)
+    missing = wanted - set(sequences)
+    if missing:
+        print(f"ERROR: IDs not found in {database}: {' '.join(sorted(missing))}", file=sys.stderr)
+        sys.exit(1)
+    return {ID: "".join(sequence) for ID, sequence in sequences.items()}
+
+
+def result_key(kind, sequences, msa_file, options=""):
+    """
+    SHA-256 key of a result.
+
+    Parameters
+    ----------
+    kind : str
+        Kind of result (AF2, RF2).
+    sequences : list of str
+        Chain sequences, in order.
+    msa_file : str
+        MSA used in the prediction. The key of a compressed MSA is the key
+        of its uncompressed content.
+    options : str
+        Options of the prediction. Whitespace is normalized.
+
+    Returns
+    -------
+    str
+        Hexadecimal key.
+
+    """
+    key = hashlib.sha256()
+    key.update(kind.encode() + b"\0")
+    key.update(":".join(sequences).encode() + b"\0")
+    with open_a3m(msa_file, "rb") as msa:
+        for chunk in iter(lambda: msa.read(1 << 20), b""):
+            key.update(chunk)
+    key.update(b"\0" + " ".join(options.split()).encode())
+    return key.hexdigest()
+
+
+def _entry(key):
+    return os.path.join(CACHE_DIR, key[:2], key)
+
+
+def _link_or_copy(source, destination):
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+def clone_result(source_dir, output_dir, name, new_name, copy=False):
+    """
+    Creates output_dir with the files of source_dir (hard links, or copies
+    with copy=True), replacing name by new_name in their names.
+    """
+    def rename(file_name):
+        return file_name.replace(name, new_name)
+
+    os.makedirs(output_dir)
+    for root, folders, files in os.walk(source_dir):
+        relative = os.path.relpath(root, source_dir)
+        destination = output_dir if relative == "." else \
+            os.path.join(output_dir, *map(rename, relative.split(os.sep)))
+        for file_name in folders + files:
+            path = os.path.join(root, file_name)
+            new_path = os.path.join(destination, rename(file_name))
+            if os.path.islink(path):
+                os.symlink(rename(os.readlink(path)), new_path)
+            elif os.path.isdir(path):
+                os.mkdir(new_path)
+            elif copy:
+                shutil.copy2(path, new_path)
+            else:
+                _link_or_copy(path, new_path)
+
+
+def _cached_result(key):
+    """
+    Returns the directory of the cached result of key (its only folder,
+    named after the output directory it was stored from) or None.
+    """
+    entry = _entry(key)
+    if os.path.islink(entry) or not os.path.isdir(entry):
+        return None     # missing, or a link to a project folder (old cache)
+    folders = [name for name in os.listdir(entry) if not name.startswith(".")]
+    return os.path.join(entry, folders[0]) if len(folders) == 1 else None
+
+
+def store(key, output_dir, required=None):
+    """
+    Stores the files of output_dir as the result of key (hard links, named
+    after output_dir). Empty or missing directories, or directories without
+    a file matching the required glob pattern (e.g. the file written when a
+    prediction finishes), are not stored. A result already in the cache is
+    kept.
+    """
+    if not os.path.isdir(output_dir) or not os.listdir(output_dir):
+        return False
+    if required is not None and not glob.glob(os.path.join(output_dir, required)):
+        return False
+    entry = _entry(key)
+    if _cached_result(key) is not None:
+        return True
+    os.makedirs(os.path.dirname(entry), exist_ok=True)
+    temporary = f"{entry}.{os.getpid()}.tmp"
+    shutil.rmtree(temporary, ignore_errors=True)
+    name = os.path.basename(os.path.realpath(output_dir))
+    clone_result(os.path.realpath(output_dir), os.path.join(temporary, name), name, name)
+    if os.path.islink(entry):
+        os.remove(entry)
+    try:
+        os.replace(temporary, entry)
+    except OSError:
+        shutil.rmtree(temporary, ignore_errors=True)    # stored at the same time by another batch
+    return True
+
+
+def store_keys(keys_file):
+    """
+    Stores the results listed in a keys file (one result per line:
+    key, output_dir and the glob pattern of a file that must exist in it)
+    and removes the file.
+
+    Returns
+    -------
+    int
+        Number of results stored.
+
+    """
+    stored = 0
+    with open(keys_file) as keys:
+        for line in keys:
+            if not line.strip():
+                continue
+            key, output_dir, required = (line.rstrip("\n").split("\t") + [None])[:3]
+            stored += store(key, output_dir, required or None)
+    os.remove(keys_file)
+    return stored
+
+
+def fetch(key, output_dir):
+    """
+    Creates output_dir with the cached result of key, if there is one. Its
+    files are hard linked (copied with DISCOBA_CACHE_MODE=copy) and renamed
+    after output_dir. An existing output_dir is never replaced.
+
+    Returns
+    -------
+    bool
+        True if the result was in the cache and output_dir was created.
+
+    """
+    cached = _cached_result(key)
+    output_dir = output_dir.rstrip("/")
+    if cached is None or os.path.lexists(output_dir):
+        return False
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_dir)), exist_ok=True)
+    temporary = os.path.join(os.path.dirname(output_dir), f".{os.path.basename(output_dir)}.{os.getpid()}.tmp")
+    shutil.rmtree(temporary, ignore_errors=True)
+    clone_result(cached, temporary, os.path.basename(cached), os.path.basename(output_dir),
+                 copy=(CACHE_MODE == "copy"))
+    os.replace(temporary, output_dir)
+    return True
+
+
+###############################################################################
+##################################### CLI #####################################
+###############################################################################
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Result cache and canonical ordering of IDs lines.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    canonicalize = subparsers.add_parser("canonicalize", help="write the IDs table in canonical order")
+    canonicalize.add_argument("IDs_table")
+    canonicalize.add_argument("output_IDs_table")
+    canonicalize.add_argument("--link", action="append", default=[], choices=sorted(STAGE_OUTPUTS),
+                              help="link the outputs of this stage for the permutations")
+    canonicalize.add_argument("--msa-dir", help="directory with the MSAs to use (-i option)")
+
+    key = subparsers.add_parser("key", help="print the key of a result")
+    key.add_argument("kind", help="kind of result (AF2, RF2)")
+    key.add_argument("database", help="fasta database with the sequences")
+    key.add_argument("msa_file")
+    key.add_argument("IDs", nargs="+")
+    key.add_argument("--options", default="", help="options of the prediction")
+
+    fetch_parser = subparsers.add_parser("fetch", help="hard link/copy a cached result (exit 1 if missing)")
+    fetch_parser.add_argument("key")
+    fetch_parser.add_argument("output_dir")
+
+    store_parser = subparsers.add_parser("store", help="add a result to the cache")
+    store_parser.add_argument("key")
+    store_parser.add_argument("output_dir")
+    store_parser.add_argument("--require", help="glob pattern of a file that must exist in output_dir")
+
+    store_keys_parser = subparsers.add_parser("store-keys", help="add the results of a keys file to the cache")
+    store_keys_parser.add_argument("keys_file", help="TSV file: key  output_dir  required_file_pattern")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    if args.command == "canonicalize":
+        permutations = canonicalize_table(args.IDs_table, args.output_IDs_table,
+                                          args.link, args.msa_dir)
+        for original, canonical in permutations:
+            print(f"Permutation: {original} --> {canonical} (outputs in the chain order of {canonical})")
+
+    elif args.command == "key":
+        sequences = read_sequences(args.database, args.IDs)
+        print(result_key(args.kind, [sequences[ID] for ID in args.IDs], args.msa_file, args.options))
+
+    elif args.command == "fetch":
+        hit = fetch(args.key, args.output_dir)
+        record_cache_lookup("result", hit)
+        sys.exit(0 if hit else 1)
+
+    elif args.command == "store":
+        sys.exit(0 if store(args.key, args.output_dir, args.require) else 1)
+
+    elif args.command == "store-keys":
+        if os.path.isfile(args.keys_file):
+            print(f"{store_keys(args.keys_file)} results added to the cache")
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+Memory model of RoseTTAFold 2-track predictions.
+
+The peak memory of a run is approximated as:
+
+    peak = BASE + MSA_COEF * N * L + PAIR_COEF * L^2
+
+where N is the MSA depth (number of sequences) and L the combined length of
+both proteins (L1+L2). BASE accounts for the CUDA context and the network
+weights, the MSA term for the MSA embeddings and the pair term for the pair
+features and attention maps.
+
+The coefficients can be calibrated with the peak memory measured in previous
+runs (runs log written by RoseTTAFold_2track_batch.py), and plan_run uses the
+model to decide before launching a prediction whether it fits the GPU, the MSA
+must be cropped to fit or it must run on CPU.
+"""
+
+import os
+
+# Default coefficients of the model (bytes)
+BASE = 1.5e9
+MSA_COEF = 1000.0
+PAIR_COEF = 2000.0
+
+# Default memory budget (GB) for the MSA filtering
+DEFAULT_BUDGET_GB = 12
+
+# Depth limits for the diversity filter
+MIN_DEPTH = 100
+MAX_DEPTH = 50000
+
+
+def estimate_peak_memory(combined_L, depth, coefficients=None):
+    """
+    Estimates the peak memory (bytes) of an RF2-track run.
+
+    Parameters
+    ----------
+    combined_L : int
+        Combined length of the pair (L1+L2).
+    depth : int
+        Number of sequences in the MSA.
+    coefficients : tuple, optional
+        (BASE, MSA_COEF, PAIR_COEF). Module defaults are used if not given.
+
+    Returns
+    -------
+    float
+        Estimated peak memory in bytes.
+
+    """
+    base, msa_coef, pair_coef = coefficients or (BASE, MSA_COEF, PAIR_COEF)
+    return base + msa_coef * depth * combined_L + pair_coef * combined_L ** 2
+
+
+def max_depth_for_budget(combined_L, budget_GB, coefficients=None):
+    """
+    Returns the biggest MSA depth whose estimated peak memory fits in the
+    budget. It can be 0 (or negative) if not even the pair features fit.
+
+    Parameters
+    ----------
+    combined_L : int
+        Combined length of the pair (L1+L2).
+    budget_GB : float
+        Available memory in GB.
+    coefficients : tuple, optional
+        (BASE, MSA_COEF, PAIR_COEF). Module defaults are used if not given.
+
+    Returns
+    -------
+    int
+        Maximum depth.
+
+    """
+    base, msa_coef, pair_coef = coefficients or (BASE, MSA_COEF, PAIR_COEF)
+    free_bytes = budget_GB * 1e9 - base - pair_coef * combined_L ** 2
+    return int(free_bytes // (msa_coef * combined_L))
+
+
+def target_depth(combined_L, budget_GB, coefficients=None):
+    """
+    Depth to use with the diversity filter: the maximum depth that fits the
+    budget, clamped between MIN_DEPTH and MAX_DEPTH.
+    """
+    depth = max_depth_for_budget(combined_L, budget_GB, coefficients)
+    return max(MIN_DEPTH, min(MAX_DEPTH, depth))
+
+
+###############################################################################
+############################ Calibration and planning #########################
+###############################################################################
+
+# Minimum number of recorded GPU runs needed to calibrate the coefficients
+MIN_CALIBRATION_RUNS = 5
+
+# Fraction of the GPU memory that the estimated peak can use
+GPU_SAFETY_FRACTION = 0.9
+
+# Cropping is preferred over CPU if it keeps at least this fraction of the MSA
+MIN_CROP_FRACTION = 0.5
+
+# Columns of the runs log (TSV) written by RoseTTAFold_2track_batch.py
+RUNS_LOG_COLUMNS = ["name", "combined_L", "depth", "device", "used_depth",
+                    "estimated_GB", "peak_GB", "seconds", "status"]
+
+
+def read_runs_log(runs_log):
+    """
+    Reads the runs log. Returns a list of dicts (one per run) or an empty
+    list if the file does not exist.
+    """
+    if not os.path.isfile(runs_log):
+        return []
+    runs = []
+    with open(runs_log) as log:
+        for line in log:
+            fields = line.rstrip("\n").split("\t")
+            if fields[0] == "name" or len(fields) != len(RUNS_LOG_COLUMNS):
+                continue
+            runs.append(dict(zip(RUNS_LOG_COLUMNS, fields)))
+    return runs
+
+
+def append_run(runs_log, run):
+    """
+    Appends a run (dict with RUNS_LOG_COLUMNS keys) to the runs log, writing
+    the header if the file is new.
+    """
+    new_file = not os.path.isfile(runs_log)
+    with open(runs_log, "a") as log:
+        if new_file:
+            log.write("\t".join(RUNS_LOG_COLUMNS) + "\n")
+        log.write("\t".join(str(run[column]) for column in RUNS_LOG_COLUMNS) + "\n")
+
+
+def fit_coefficients(runs):
+    """
+    Fits (BASE, MSA_COEF, PAIR_COEF) by least squares to the measured peak
+    memory of successful GPU runs.
+
+    Parameters
+    ----------
+    runs : list of dict
+        Runs as returned by read_runs_log.
+
+    Returns
+    -------
+    tuple or None
+        Fitted coefficients, or None if there are not enough runs or the
+        fit is not physically meaningful (negative coefficients).
+
+    """
+    measured = [(int(run["combined_L"]), int(run["used_depth"]), float(run["peak_GB"]) * 1e9)
+                for run in runs
+                if run["device"] in ("gpu", "crop") and run["status"] == "done"
+                and float(run["peak_GB"]) > 0]
+    if len(measured) < MIN_CALIBRATION_RUNS:
+        return None
+
+    import numpy as np      # only needed to calibrate
+
+    L, N, peak = (np.array(values, dtype=float) for values in zip(*measured))
+    design = np.column_stack([np.ones_like(L), N * L, L ** 2])
+    coefficients, *_ = np.linalg.lstsq(design, peak, rcond=None)
+    if (coefficients < 0).any():
+        return None
+    return tuple(float(c) for c in coefficients)
+
+
+def calibrated_coefficients(runs_log):
+    """
+    Coefficients fitted from the runs log, or the module defaults if they
+    cannot be fitted.
+    """
+    return fit_coefficients(read_runs_log(runs_log)) or (BASE, MSA_COEF, PAIR_COEF)
+
+
+def plan_run(combined_L, depth, gpu_GB, coefficients=None, min_crop_fraction=MIN_CROP_FRACTION):
+    """
+    Decides where to run a prediction before launching it.
+
+    Parameters
+    ----------
+    combined_L : int
+        Combined length of the pair (L1+L2).
+    depth : int
+        Number of sequences in the MSA.
+    gpu_GB : float
+        Total memory of the GPU (0 if there is no GPU).
+    coefficients : tuple, optional
+        (BASE, MSA_COEF, PAIR_COEF). Module defaults are used if not given.
+    min_crop_fraction : float
+        Minimum fraction of the MSA to keep when cropping. If the MSA has to
+        be cropped more than that, the prediction is run on CPU instead.
+
+    Returns
+    -------
+    device : str
+        "gpu", "crop" (GPU with the MSA cropped to used_depth) or "cpu".
+    used_depth : int
+        Depth to use in the prediction.
+    estimated_GB : float
+        Estimated peak memory (GB) with used_depth.
+
+    """
+    budget_GB = gpu_GB * GPU_SAFETY_FRACTION
+    estimated_GB = estimate_peak_memory(combined_L, depth, coefficients) / 1e9
+    if estimated_GB <= budget_GB:
+        return "gpu", depth, estimated_GB
+
+    max_depth = max_depth_for_budget(combined_L, budget_GB, coefficients)
+    if max_depth >= max(MIN_DEPTH, depth * min_crop_fraction):
+        return "crop", max_depth, estimate_peak_memory(combined_L, max_depth, coefficients) / 1e9
+
+    return "cpu", depth, estimated_GB
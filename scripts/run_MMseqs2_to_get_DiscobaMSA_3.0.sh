@@ -8,28 +8,56 @@ command -v mmseqs >/dev/null 2>&1 || { echo >&2 "ERROR: MMseqs2 not found. Insta
 # DiscobaDB as env variable (Installation folder)
 : "${DiscobaDB:? ERROR: DiscobaDB not found. Install it using installation script. Aborting.}"
 : "${DiscobaMultimerPath:? ERROR: DiscobaMultimerPath not found. Install it using installation script. Aborting.}"
-DISCOBA_tmp=$DiscobaMultimerPath/discoba/tmp4
 # Path to reformat_mmseqs_alignment.py
 REFORMAT=$DiscobaMultimerPath/scripts/reformat_mmseq_table_2.0.py
+# Path to discoba_worker.py
+WORKER_SCRIPT=$DiscobaMultimerPath/scripts/discoba_worker.py
 # --------------------------------------------------------------------------
 
 usage() {
-	echo "USAGE: $0 <database.fasta> <protein_ID>"
+	echo "USAGE: $0 [-t <threads>] <database.fasta> <protein_ID>"
 	echo "OPTIONS:"
-	echo "	- To be implemented..."
+	echo "	-t <threads>	: threads used by MMseqs2 (default: all cores)"
 	echo "OUTPUT: stored in ./mmseqs_alignments/<protein_ID> directory"
 	echo "	- protein_ID.a3m"
 	echo "	- other files produced by MMseqs2"
 	echo "NOTES:"
 	echo "	- MMseqs2 and DiscobaDB must be installed in advance"
 	echo "	  by running install_MMseqs2_and_DiscobaDB.sh"
+	echo "	- Each search uses its own work and tmp directories, so several"
+	echo "	  searches can run at the same time from the same directory. The"
+	echo "	  results are moved to the output directory only when complete."
 	exit 1
 }
 
-# Searches and finds $ID in $database. Outputs ${ID}.fasta in the WD
+# Runs a Python helper in the worker of the batch if one is running, with its
+# modules already imported (see discoba_worker.py). Otherwise runs it directly.
+run_helper() {
+	if [ -S "${DISCOBA_WORKER_SOCKET:-}" ]; then
+		python -S $WORKER_SCRIPT run "$@"
+	else
+		python "$@"
+	fi
+}
+
+# Prints the a3m file or its compressed version (<a3m>.zst or <a3m>.gz, see
+# a3m_utils.py). Returns 1 if none of them exists.
+a3m_find() {
+	local a3m
+	for a3m in "$1" "$1.zst" "$1.gz"; do
+		if [ -f "$a3m" ]; then
+			echo "$a3m"
+			return 0
+		fi
+	done
+	return 1
+}
+
+# Searches and finds $ID in $database. Outputs it to $fasta_file
 get_sequence() {
 	database="$1"
 	ID="$2"
+	fasta_file="$3"
 	# Search for the ID in the fasta database and extract the sequence
 	find_flag=0
 	while read line; do
@@ -37,12 +65,12 @@ get_sequence() {
 			continue
 		elif [[ "$line" == ">$ID" ]]; then
 			find_flag=1
-			echo "$line" > ${ID}.fasta
+			echo "$line" > $fasta_file
 			while read next_line; do
 				if [[ "$next_line" == ">"* ]]; then
 					break
 				fi
-				echo "$next_line" >> ${ID}.fasta
+				echo "$next_line" >> $fasta_file
 			done
 			break
 		fi
@@ -57,6 +85,17 @@ get_sequence() {
 
 # Check input ---------------------------------------------------------------
 
+# Threads used by MMseqs2 (all cores by default)
+threads=$(nproc)
+if [ "$1" == "-t" ]; then
+	threads=$2
+	shift 2
+	if [[ ! $threads =~ ^[0-9]+$ ]] || [ $threads -eq 0 ]; then
+		echo "ERROR: -t argument must be a positive integer"
+		usage
+	fi
+fi
+
 if [ $# -ne 2 ]; then
 	usage
 elif [ ! -f $1 ]; then
@@ -77,43 +116,49 @@ WD=`pwd`
 output_dir=discoba_mmseqs_alignments/${ID}
 output_file=discoba_mmseqs_alignments/${ID}/${ID}.a3m
 
-# If the protein was not previously queried
-if [ ! -f "$output_file" ]; then
-
-	# recover the sequence. If not found, exit the program
-	get_sequence $database $ID || exit 1
+# If the protein was not previously queried (its MSA may have been compressed)
+if ! a3m_find $output_file > /dev/null; then
 
-	# create directory to store results
-	mkdir -p $output_dir
-	rm -f $output_dir/*
+	# Private work directory (in the same filesystem than the output, so the
+	# results can be moved atomically). Removed if the search fails.
+	mkdir -p discoba_mmseqs_alignments
+	work_dir=$(mktemp -d discoba_mmseqs_alignments/.${ID}.XXXXXX)
+	chmod 755 $work_dir
+	trap "rm -rf $WD/$work_dir" EXIT
 
-	# Move the fasta file with the sequence to the output_dir
-	mv ${ID}.fasta $output_dir/query.fasta
+	# recover the sequence. If not found, exit the program
+	get_sequence $database $ID $work_dir/query.fasta || exit 1
 
 	# search DiscobaDB and produce Discoba MSA
-	cd $output_dir
+	cd $work_dir
 		echo "Converting query.fasta to database..."
 		mmseqs createdb query.fasta queryDB -v 2
 		echo "Searching Discoba database..."
-		mmseqs search queryDB $DiscobaDB resultDB $DISCOBA_tmp --remove-tmp-files 1 -v 2
+		mmseqs search queryDB $DiscobaDB resultDB tmp --remove-tmp-files 1 --threads $threads -v 2
 		echo "Aligning hits..."
-		mmseqs align queryDB $DiscobaDB resultDB alignDB -a -v 2
+		mmseqs align queryDB $DiscobaDB resultDB alignDB -a --threads $threads -v 2
 		echo "Formatting result..."
-		mmseqs convertalis queryDB $DiscobaDB alignDB queryDB.tab --format-output target,qlen,qstart,qend,tstart,tend,tseq,cigar,taln -v 2
+		mmseqs convertalis queryDB $DiscobaDB alignDB queryDB.tab --format-output target,qlen,qstart,qend,tstart,tend,tseq,cigar,taln --threads $threads -v 2
 		echo "Reformatting mmseqs table to a3m..."
 		# Reformat the mmseqs table to a3m
-		python $REFORMAT $ID
+		run_helper $REFORMAT $ID
 		# Add query to the start of the a3m file
 		head -1 query.fasta > a3m.tmp
 		echo `tail -n +2 query.fasta | tr -d '\n'` >> a3m.tmp
 		cat ${ID}.a3m >> a3m.tmp
 		mv a3m.tmp ${ID}.a3m
+		rm -rf tmp
+	cd $WD
+
+	# Move the complete results to the output directory (a previous
+	# incomplete output is replaced)
+	[ -d "$output_dir" ] && ! a3m_find $output_file > /dev/null && rm -rf $output_dir
+	if ! mv -T $work_dir $output_dir 2> /dev/null; then
+		echo "WARNING: $ID Discoba MSA was generated at the same time by another search"
+	fi
 
-		echo "Results in $output_dir"
+	echo "Results in $output_dir"
 else
 	echo "WARNING: $ID Discoba MSA generated beforehand. The search was not performed"
 	exit 0
 fi
-
-
-cd $WD
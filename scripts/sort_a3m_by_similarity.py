@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+Sorts the sequences of an a3m file by decreasing similarity to the query (the
+first sequence).
+
+Similarity is the global alignment score computed in-process with the same
+parameters used by EMBOSS needle in the previous implementation (EBLOSUM62,
+gap open 10.0, gap extend 0.5, end gaps not penalized). Scores are computed in
+parallel across the available cores and no temporary files are written, so
+several runs can share the same working directory.
+"""
+
+import sys
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from a3m_utils import read_a3m, write_a3m
+
+# Check input
+if __name__ == "__main__" and len(sys.argv) not in (3, 4):
+    print("ERROR: missing positional arguments", file=sys.stderr)
+    print("USAGE: python sort_a3m_by_similarity.py <input.a3m> <output.a3m> [<threads>]", file=sys.stderr)
+    print("")
+    print("   input.a3m   a3m file to sort. The first sequence is the query")
+    print("   output.a3m  sorted a3m file (can be the same as input.a3m)")
+    print("   threads     number of processes to use (default: all cores)")
+    sys.exit(1)
+
+# Same values used with needle
+GAP_OPEN = 10.0
+GAP_EXTEND = 0.5
+
+# Below this number of sequences the parallelization is not worth it
+MIN_SEQS_TO_PARALLELIZE = 200
+
+# Aligner of each worker process (built once by _init_worker)
+_aligner = None
+_query = None
+
+
+def build_aligner():
+    """
+    Returns a PairwiseAligner that reproduces the EMBOSS needle defaults
+    (EBLOSUM62, -gapopen 10.0 -gapextend 0.5, free end gaps).
+    """
+    from Bio.Align import PairwiseAligner, substitution_matrices
+
+    aligner = PairwiseAligner()
+    aligner.mode = "global"
+    aligner.substitution_matrix = substitution_matrices.load("BLOSUM62")
+    aligner.open_gap_score = -GAP_OPEN
+    aligner.extend_gap_score = -GAP_EXTEND
+    aligner.end_gap_score = 0
+    return aligner
+
+
+def clean_sequence(sequence, alphabet):
+    """
+    Removes gaps and converts the sequence to the residues known by the
+    substitution matrix (needle also uppercases its inputs and reads
+    unknown residues as X).
+    """
+    sequence = sequence.replace("-", "").replace(".", "").upper()
+    return "".join(c if c in alphabet else "X" for c in sequence)
+
+
+def _init_worker(query):
+    global _aligner, _query
+    _aligner = build_aligner()
+    _query = clean_sequence(query, _aligner.substitution_matrix.alphabet)
+
+
+def _score_chunk(sequences):
+    alphabet = _aligner.substitution_matrix.alphabet
+    return [_aligner.score(_query, clean_sequence(seq, alphabet)) for seq in sequences]
+
+
+def compute_scores(query, sequences, threads=None):
+    """
+    Computes the global alignment score of each sequence against the query.
+
+    Parameters
+    ----------
+    query : str
+        Query sequence.
+    sequences : list of str
+        Sequences to score.
+    threads : int, optional
+        Number of processes. By default, all the available cores.
+
+    Returns
+    -------
+    scores : list of float
+        One score per sequence, in the same order.
+
+    """
+    if threads is None:
+        threads = os.cpu_count() or 1
+
+    if threads == 1 or len(sequences) < MIN_SEQS_TO_PARALLELIZE:
+        _init_worker(query)
+        return _score_chunk(sequences)
+
+    # Big chunks keep the inter-process communication low
+    chunk_size = max(1, len(sequences) // (threads * 4))
+    chunks = [sequences[i:i + chunk_size] for i in range(0, len(sequences), chunk_size)]
+
+    scores = []
+    with ProcessPoolExecutor(max_workers=threads, initializer=_init_worker,
+                             initargs=(query,)) as executor:
+        for chunk_scores in executor.map(_score_chunk, chunks):
+            scores.extend(chunk_scores)
+    return scores
+
+
+def sort_a3m(input_a3m, output_a3m, threads=None):
+    """
+    Sorts the sequences of input_a3m by decreasing similarity to the query and
+    writes them to output_a3m. The query (and cardinality line, if any) stay
+    at the top.
+
+    Ties are ordered as `sort -rn` did with the "header sequence score" table
+    of the previous implementation (reverse byte order of the whole row).
+
+    Returns
+    -------
+    None.
+
+    """
+    cardinality, records = read_a3m(input_a3m)
+    if len(records) == 0:
+        print(f"ERROR: {input_a3m} contains no sequences", file=sys.stderr)
+        sys.exit(1)
+
+    query_record = records[0]
+    subjects = records[1:]
+    scores = compute_scores(query_record[1], [seq for _, seq in subjects], threads)
+
+    sorted_subjects = sorted(zip(scores, subjects),
+                             key=lambda x: (x[0], x[1][0].encode() + b"\t" + x[1][1].encode()),
+                             # From highest to lowest
+                             reverse=True)
+
+    write_a3m(output_a3m,
+              [query_record] + [record for _, record in sorted_subjects],
+              cardinality)
+
+
+if __name__ == "__main__":
+    input_a3m = sys.argv[1]
+    output_a3m = sys.argv[2]
+    threads = int(sys.argv[3]) if len(sys.argv) == 4 else None
+
+    if not os.path.isfile(input_a3m):
+        print(f"ERROR: {input_a3m} is not a file", file=sys.stderr)
+        sys.exit(1)
+
+    sort_a3m(input_a3m, output_a3m, threads)
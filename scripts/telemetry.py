@@ -0,0 +1,408 @@
+# -*- coding: utf-8 -*-
+"""
+Per-stage telemetry of DiscobaMultimer runs.
+
+Each command of a stage (e.g. the Discoba MSA of an IDs line or its AF2
+prediction) is run through this script, which appends a JSON-lines event to
+./reports/telemetry.jsonl (DISCOBA_TELEMETRY environment variable):
+
+    {"stage": "af2", "name": "A__vs__B", "start": ..., "end": ..., "wall_s": ...,
+     "cpu_s": ..., "max_rss_MB": ..., "L": 812, "depth": 4096, "exit_code": 0,
+     "cached": false, "host": ...}
+
+CPU time and peak RSS are measured on the command and its subprocesses. L is
+the combined length of the IDs of the line (given by the caller, or read from
+the length index of the database, see database_lengths) and depth the
+number of sequences of the MSA used or produced by the command. Commands
+whose output already existed (nothing was computed) are recorded as cached
+and they are not used for the statistics. Lookups of the result cache and
+the ColabFold MSA cache are appended to ./reports/cache_lookups.tsv
+(DISCOBA_CACHE_LOG environment variable).
+
+Commands:
+
+    run        runs a command and records its event (exits with its exit code)
+    summary    number of jobs, failures, throughput and latency percentiles of
+               each stage, and the ETA of the rest of an IDs table
+    lengths    writes the length index of a database (if it changed) and
+               prints its path
+"""
+
+import sys
+import os
+import argparse
+import json
+import signal
+import socket
+import subprocess
+import tempfile
+import time
+
+from a3m_utils import find_a3m, open_a3m
+
+# Location of the events (relative to the project folder)
+TELEMETRY_FILE = os.environ.get("DISCOBA_TELEMETRY", "./reports/telemetry.jsonl")
+
+# Lookups of the result cache and the ColabFold MSA cache (hit or miss)
+CACHE_LOG = os.environ.get("DISCOBA_CACHE_LOG", "./reports/cache_lookups.tsv")
+
+# Lengths of the databases read by the process {database: (index header, {ID: length})}
+_LENGTHS = {}
+
+
+def paired_name(IDs):
+    return "__vs__".join(IDs)
+
+
+###############################################################################
+################################ Input sizes ##################################
+###############################################################################
+
+def fasta_lengths(database):
+    """
+    {ID: length} of the sequences of a FASTA file.
+    """
+    lengths = {}
+    current = None
+    with open(database) as fasta:
+        for line in fasta:
+            if line.startswith(">"):
+                current = line[1:].strip()
+                lengths[current] = 0
+            elif current is not None:
+                lengths[current] += len(line.strip())
+    return lengths
+
+
+def length_index_file(database):
+    """
+    Length index of a database, next to the telemetry events.
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(TELEMETRY_FILE)), "database_lengths",
+                        os.path.basename(database) + ".lengths.tsv")
+
+
+def database_lengths(database):
+    """
+    {ID: length} of the sequences of a database. The database is read once:
+    the lengths are written to its length index (ID and length per line,
+    after a header with the path, size and modification time of the
+    database), which is read instead until the database changes. The lengths
+    are also kept in memory for the next calls of the process.
+    """
+    stat = os.stat(database)
+    header = f"#{os.path.abspath(database)}\t{stat.st_size}\t{stat.st_mtime_ns}\n"
+    if database in _LENGTHS and _LENGTHS[database][0] == header:
+        return _LENGTHS[database][1]
+
+    index_file = length_index_file(database)
+    lengths = None
+    try:
+        with open(index_file) as index:
+            if index.readline() == header:
+                lengths = {ID: int(length) for ID, length in (line.rstrip("\n").rsplit("\t", 1) for line in index)}
+    except (OSError, ValueError):
+        lengths = None
+
+    if lengths is None:
+        lengths = fasta_lengths(database)
+        try:
+            # Written to a temporary file and renamed, so concurrent readers
+            # never see a partial index
+            os.makedirs(os.path.dirname(index_file), exist_ok=True)
+            fd, temporary_file = tempfile.mkstemp(prefix=".lengths_", dir=os.path.dirname(index_file))
+            with os.fdopen(fd, "w") as index:
+                index.write(header)
+                index.writelines(f"{ID}\t{length}\n" for ID, length in lengths.items())
+            os.replace(temporary_file, index_file)
+        except OSError:
+            pass    # the lengths are only used for the statistics
+
+    _LENGTHS[database] = (header, lengths)
+    return lengths
+
+
+def combined_length(database, name):
+    """
+    Sum of the lengths of the IDs of a paired name (None if an ID is not in
+    the database).
+    """
+    lengths = database_lengths(database)
+    IDs = name.split("__vs__")
+    if any(ID not in lengths for ID in IDs):
+        return None
+    return sum(lengths[ID] for ID in IDs)
+
+
+def MSA_depth(a3m_file):
+    """
+    Number of sequences of an a3m file or of its compressed version (None
+    if it does not exist).
+    """
+    a3m_file = find_a3m(a3m_file) if a3m_file else None
+    if a3m_file is None:
+        return None
+    with open_a3m(a3m_file, "rb") as a3m:
+        return sum(1 for line in a3m if line.startswith(b">"))
+
+
+###############################################################################
+################################### Events ####################################
+###############################################################################
+
+def write_event(event, telemetry_file=None):
+    telemetry_file = telemetry_file or TELEMETRY_FILE
+    os.makedirs(os.path.dirname(os.path.abspath(telemetry_file)), exist_ok=True)
+    # A single append per event, so concurrent writers do not mix lines
+    with open(telemetry_file, "a") as events:
+        events.write(json.dumps(event) + "\n")
+
+
+def record_cache_lookup(cache, hit):
+    """
+    Appends a cache lookup (time, cache and hit/miss) to CACHE_LOG.
+    """
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(CACHE_LOG)), exist_ok=True)
+        with open(CACHE_LOG, "a") as lookups:
+            lookups.write(f"{time.time():.3f}\t{cache}\t{'hit' if hit else 'miss'}\n")
+    except OSError:
+        pass    # the lookups are only used for the metrics
+
+
+def read_events(telemetry_file=None):
+    events = []
+    telemetry_file = telemetry_file or TELEMETRY_FILE
+    if not os.path.isfile(telemetry_file):
+        return events
+    with open(telemetry_file) as lines:
+        for line in lines:
+            try:
+                events.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue    # line of an interrupted write
+    return events
+
+
+def run(stage, name, command, database=None, length=None, a3m_file=None, output=None):
+    """
+    Runs a command and records its event. Returns the exit code.
+    """
+    cached = output is not None and os.path.exists(output)
+    start = time.time()
+    cpu_s, max_rss_MB = 0.0, 0.0
+    try:
+        process = subprocess.Popen(command)
+    except OSError as error:
+        print(f"ERROR: {command[0]}: {error}", file=sys.stderr)
+        exit_code = 127
+    else:
+        # The command handles Ctrl-C itself (its exit code is recorded) and
+        # termination requests are passed to it
+        previous_handlers = (signal.signal(signal.SIGINT, signal.SIG_IGN),
+                             signal.signal(signal.SIGTERM, lambda signum, frame: process.send_signal(signum)))
+        try:
+            _, status, usage = os.wait4(process.pid, 0)
+        finally:
+            signal.signal(signal.SIGINT, previous_handlers[0])
+            signal.signal(signal.SIGTERM, previous_handlers[1])
+        process.returncode = exit_code = os.waitstatus_to_exitcode(status)
+        if exit_code < 0:
+            exit_code = 128 - exit_code
+        cpu_s, max_rss_MB = usage.ru_utime + usage.ru_stime, usage.ru_maxrss / 1024
+    end = time.time()
+
+    if length is None and database is not None:
+        length = combined_length(database, name)
+    write_event({
+        "stage": stage,
+        "name": name,
+        "start": round(start, 3),
+        "end": round(end, 3),
+        "wall_s": round(end - start, 3),
+        "cpu_s": round(cpu_s, 3),
+        "max_rss_MB": round(max_rss_MB, 1),
+        "L": length,
+        "depth": MSA_depth(a3m_file),
+        "exit_code": exit_code,
+        "cached": cached,
+        "host": socket.gethostname(),
+    })
+    return exit_code
+
+
+def telemetry_command(stage, name, command, length=None, a3m_file=None, output=None, database=None):
+    """
+    The command wrapped to be run through this script (for Python scripts
+    that launch the commands themselves). The script only needs the standard
+    library, so Python starts without site-packages.
+    """
+    wrapped = [sys.executable, "-S", os.path.abspath(__file__), "run", stage, name]
+    for option, value in (("--length", length), ("--a3m", a3m_file), ("--output", output),
+                          ("--database", database)):
+        if value is not None:
+            wrapped += [option, str(value)]
+    return wrapped + ["--"] + list(command)
+
+
+###############################################################################
+################################### Summary ###################################
+###############################################################################
+
+def percentile(values, fraction):
+    """
+    Nearest-rank percentile of a list of values.
+    """
+    values = sorted(values)
+    index = max(0, min(len(values) - 1, int(round(fraction * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return "-"
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+
+def stage_statistics(events):
+    """
+    Statistics of the events of a stage (cached events are not used).
+    Throughput is the number of successful jobs per hour between the start
+    of the first job and the end of the last one, so jobs running at the
+    same time are taken into account.
+    """
+    computed = [event for event in events if not event.get("cached")]
+    done = [event for event in computed if event["exit_code"] == 0]
+    statistics = {"jobs": len(computed), "failed": len(computed) - len(done),
+                  "cached": len(events) - len(computed), "done_names": {event["name"] for event in events
+                                                                        if event["exit_code"] == 0}}
+    if not done:
+        return statistics
+
+    walls = [event["wall_s"] for event in done]
+    span = max(event["end"] for event in done) - min(event["start"] for event in done)
+    residues = [event["L"] for event in done if event.get("L")]
+    statistics.update({
+        "p50": percentile(walls, 0.50),
+        "p90": percentile(walls, 0.90),
+        "p99": percentile(walls, 0.99),
+        "max": max(walls),
+        "cpu_s": sum(event["cpu_s"] for event in done),
+        "max_rss_MB": max(event["max_rss_MB"] for event in done),
+        "per_hour": len(done) / span * 3600 if span > 0 else None,
+        "residues_per_s": sum(residues) / sum(walls) if residues and sum(walls) > 0 else None,
+    })
+    return statistics
+
+
+def remaining_names(IDs_table_file, done_names):
+    remaining = 0
+    with open(IDs_table_file) as IDs_table:
+        for line in IDs_table:
+            if line.startswith("#") or not line.strip():
+                continue
+            if paired_name(line.rstrip("\n").split("\t")) not in done_names:
+                remaining += 1
+    return remaining
+
+
+def print_summary(events, stages=None, IDs_table_file=None):
+    by_stage = {}
+    for event in events:
+        by_stage.setdefault(event["stage"], []).append(event)
+    stages = stages or sorted(by_stage)
+    if not stages:
+        print(f"No telemetry events in {TELEMETRY_FILE}")
+        return
+
+    print("stage\tjobs\tfailed\tcached\tjobs/h\tp50\tp90\tp99\tmax\tCPU\tmax_RSS_MB\tresidues/s"
+          + ("\tremaining\tETA" if IDs_table_file else ""))
+    total_ETA = 0.0
+    for stage in stages:
+        statistics = stage_statistics(by_stage.get(stage, []))
+        columns = [stage, statistics["jobs"], statistics["failed"], statistics["cached"]]
+        if "p50" in statistics:
+            per_hour = statistics["per_hour"]
+            residues_per_s = statistics["residues_per_s"]
+            columns += [f"{per_hour:.1f}" if per_hour else "-",
+                        format_duration(statistics["p50"]), format_duration(statistics["p90"]),
+                        format_duration(statistics["p99"]), format_duration(statistics["max"]),
+                        format_duration(statistics["cpu_s"]), f"{statistics['max_rss_MB']:.0f}",
+                        f"{residues_per_s:.2f}" if residues_per_s else "-"]
+        else:
+            columns += ["-"] * 8
+
+        if IDs_table_file:
+            remaining = remaining_names(IDs_table_file, statistics["done_names"])
+            ETA = None
+            if remaining == 0:
+                ETA = 0.0
+            elif statistics.get("per_hour"):
+                ETA = remaining / statistics["per_hour"] * 3600
+            total_ETA = None if ETA is None or total_ETA is None else total_ETA + ETA
+            columns += [remaining, format_duration(ETA)]
+        print("\t".join(str(column) for column in columns))
+
+    if IDs_table_file:
+        print("")
+        print(f"ETA of the IDs table ({', '.join(stages)} one after the other): {format_duration(total_ETA)}")
+
+
+###############################################################################
+##################################### CLI #####################################
+###############################################################################
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Per-stage telemetry of DiscobaMultimer runs.")
+    parser.add_argument("--file", help=f"events file (default {TELEMETRY_FILE})")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="run a command and record its event",
+                                       usage="%(prog)s [options] stage name -- command [arguments]")
+    run_parser.add_argument("stage")
+    run_parser.add_argument("name", help="paired name of the IDs line")
+    run_parser.add_argument("--database", help="database to compute the combined length")
+    run_parser.add_argument("--length", type=int, help="combined length (instead of --database)")
+    run_parser.add_argument("--a3m", help="MSA whose depth is recorded (read after the command)")
+    run_parser.add_argument("--output", help="output of the command (if it exists, the event is cached)")
+
+    lengths = subparsers.add_parser("lengths", help="write the length index of a database and print its path")
+    lengths.add_argument("database")
+
+    summary = subparsers.add_parser("summary", help="throughput, latencies and ETA of each stage")
+    summary.add_argument("--stages", help="comma-separated stages (default: all)")
+    summary.add_argument("--table", help="IDs table to compute the ETA of its remaining lines")
+
+    # The command to run is everything after "--"
+    argv, command = sys.argv[1:], []
+    if "--" in argv:
+        argv, command = argv[:argv.index("--")], argv[argv.index("--") + 1:]
+    args = parser.parse_args(argv)
+    args.cmd = command
+    if args.command == "run" and not args.cmd:
+        parser.error("missing command to run (after --)")
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    if args.file:
+        TELEMETRY_FILE = args.file
+
+    if args.command == "run":
+        sys.exit(run(args.stage, args.name, args.cmd, args.database, args.length, args.a3m, args.output))
+
+    elif args.command == "lengths":
+        if not os.path.isfile(args.database):
+            print(f"ERROR: {args.database} is not a file", file=sys.stderr)
+            sys.exit(1)
+        database_lengths(args.database)
+        print(length_index_file(args.database))
+
+    elif args.command == "summary":
+        if args.table and not os.path.isfile(args.table):
+            print(f"ERROR: {args.table} is not a file", file=sys.stderr)
+            sys.exit(1)
+        print_summary(read_events(), args.stages.split(",") if args.stages else None, args.table)
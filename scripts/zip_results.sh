@@ -1,5 +1,10 @@
 #!/bin/bash
 
+# The results are exported by export_results.py, which streams them into a
+# compressed archive without copying them first (see its --help for the
+# codecs and --since incremental exports).
+EXPORT_RESULTS=$DiscobaMultimerPath/scripts/export_results.py
+
 usage() {
 	echo "USAGE:"
 	echo " $0 [OPTIONS] <IDs_table.txt> <project_name>"
@@ -8,9 +13,12 @@ usage() {
 	echo " -p : include MSA plots"
 	echo " -r : include RF2-track results"
 	echo " -a : include AF2-multimer predictions"
+	echo " -s <manifest.tsv> : only export the results new since a previous export"
 	echo "NOTES:"
 	echo " - Must be run inside the dir in which discoba-multimer_batch.sh"
 	echo "   was executed"
+	echo " - Output: <project_name>.tar.zst and <project_name>.manifest.tsv"
+	echo "   (extract with: tar -I zstd -xf <project_name>.tar.zst)"
 	exit 1
 }
 
@@ -19,16 +27,11 @@ usage_error(){
 	usage
 }
 
-retrieve_msa=false
-retrieve_plot=false
-retrieve_rf=false
-retrieve_af2=false
-while getopts "mpra" opt; do
+options=()
+while getopts "mpras:" opt; do
 	case ${opt} in
-		m) retrieve_msa=true ;;
-		p) retrieve_plot=true ;;
-		r) retrieve_rf=true ;;
-		a) retrieve_af2=true ;;
+		m|p|r|a) options+=(-$opt) ;;
+		s) options+=(--since "$OPTARG") ;;
 		\?) echo "ERROR: invalid option" ; usage ;;
 	esac
 done
@@ -38,45 +41,5 @@ shift $((OPTIND -1))
 IDs_table=$1
 project_name=$2
 [ ! -f $IDs_table ] && usage_error "IDs_list is not a file"
-[ -f ${project_name}.zip ] && usage_error "${project_name}.zip already exists"
-[ -d ${project_name} ] && usage_error "${project_name} already exists"
-
-while read line; do
-	
-	# Read IDs from the line
-	IFS=$'\t' read -r -a IDs_array <<< "$line"
-	paired_name=`printf '%s__vs__' "${IDs_array[@]}" | sed 's/__vs__$//'`
-	IDs_number=${#IDs_array[@]}
-
-	echo "$paired_name ----------------------------------------"
-	
-	mono_discoba_msa_found=false
-	paired_discoba_msa_found=false
-	colabfold_msa_found=false
-	merged_msa_found=false
-	if [ "$retrieve_msa" == "true" ]; then
-		echo "Retrieving MSA..."
-	fi
-	
-	plot_found=false
-	if [ "$retrieve_plot" == "true" ]; then
-		echo "Retrieving plot..."
-	fi
-	
-	rf_found=false
-	if [ "$retrieve_rf" == "true" ]; then
-		echo "Retrieving RF2-track results..."
-	fi
-	
-	af2_found=false
-	if [ "$retrieve_af2" == "true" ]; then
-		echo "Retrieving AF2-multimer results..."
-	fi
-
-done < $IDs_table
-echo "Zipping results..."
-
-zip -r $project_name.zip $project_name
-
 
-echo "Finished"
+python $EXPORT_RESULTS "${options[@]}" $IDs_table $project_name
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Aggregates the profiles written by the Python helpers with DISCOBA_PROFILE
+(see scripts/profiling.py) across a batch.
+
+For each script it prints the number of profiled invocations, their total,
+mean and maximum wall time and peak memory, the slowest invocations, the
+functions with most time in all the invocations (merged cProfile stats) and
+the lines that allocated most memory (summed over the invocations).
+"""
+
+import sys
+import os
+import argparse
+import glob
+import io
+import pstats
+
+
+def find_profiles(paths):
+    """
+    Returns {script: [(name, prof_file, alloc_file or None)]} for the .prof
+    files in the given files/directories (searched recursively).
+    """
+    prof_files = []
+    for path in paths:
+        if os.path.isdir(path):
+            prof_files += glob.glob(os.path.join(path, "**", "*.prof"), recursive=True)
+        elif path.endswith(".prof"):
+            prof_files.append(path)
+
+    profiles = {}
+    for prof_file in sorted(prof_files):
+        parts = os.path.basename(prof_file).rsplit(".", 2)
+        if len(parts) != 3:
+            continue
+        name, script, _ = parts
+        alloc_file = prof_file[:-len(".prof")] + ".alloc.tsv"
+        profiles.setdefault(script, []).append(
+            (name, prof_file, alloc_file if os.path.isfile(alloc_file) else None))
+    return profiles
+
+
+def read_alloc(alloc_file):
+    """
+    Returns the header values (wall_s, peak_KB) and the allocations
+    {location: (size_KB, count)} of an .alloc.tsv file.
+    """
+    header, allocations = {}, {}
+    with open(alloc_file) as alloc:
+        for line in alloc:
+            line = line.rstrip("\n")
+            if line.startswith("#"):
+                for field in line[1:].strip().split("\t"):
+                    key, _, value = field.partition(": ")
+                    header[key] = value
+            elif line and not line.startswith("size_KB"):
+                size_KB, count, location = line.split("\t", 2)
+                allocations[location] = (float(size_KB), int(count))
+    return header, allocations
+
+
+def summarize_script(script, invocations, top, sort, merged_dir=None):
+    print(f"==================== {script} ({len(invocations)} invocations) ====================")
+
+    walls, peaks, allocations = [], [], {}
+    stats = None
+    for name, prof_file, alloc_file in invocations:
+        if stats is None:
+            stats = pstats.Stats(prof_file, stream=io.StringIO())
+        else:
+            stats.add(prof_file)
+        if alloc_file:
+            header, invocation_allocations = read_alloc(alloc_file)
+            walls.append((float(header.get("wall_s", 0)), name))
+            peaks.append(float(header.get("peak_KB", 0)))
+            for location, (size_KB, count) in invocation_allocations.items():
+                total_KB, total_count = allocations.get(location, (0.0, 0))
+                allocations[location] = (total_KB + size_KB, total_count + count)
+
+    if walls:
+        total = sum(wall for wall, _ in walls)
+        print(f"Wall time: total {total:.1f} s, mean {total / len(walls):.2f} s, "
+              f"max {max(walls)[0]:.2f} s ({max(walls)[1]})")
+        print(f"Peak traced memory: mean {sum(peaks) / len(peaks) / 1024:.1f} MB, "
+              f"max {max(peaks) / 1024:.1f} MB")
+        print("")
+        print("Slowest invocations:")
+        for wall, name in sorted(walls, reverse=True)[:top]:
+            print(f"  {wall:10.2f} s  {name}")
+
+    # Merged cProfile stats of all the invocations
+    print("")
+    output = io.StringIO()
+    stats.stream = output
+    stats.sort_stats(sort).print_stats(top)
+    print(output.getvalue().strip())
+    if merged_dir:
+        os.makedirs(merged_dir, exist_ok=True)
+        merged_file = os.path.join(merged_dir, f"{script}.merged.prof")
+        stats.dump_stats(merged_file)
+        print(f"Merged stats saved in {merged_file}")
+
+    if allocations:
+        print("")
+        print("Top allocations (summed over the invocations):")
+        print(f"  {'size_MB':>10}  {'count':>10}  location")
+        for location, (size_KB, count) in sorted(allocations.items(), key=lambda item: -item[1][0])[:top]:
+            print(f"  {size_KB / 1024:10.2f}  {count:10d}  {location}")
+    print("")
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Aggregates the DISCOBA_PROFILE profiles of a batch.")
+    parser.add_argument("paths", nargs="+", help="directories (searched recursively) or .prof files")
+    parser.add_argument("--top", type=int, default=20, help="rows of each table (default 20)")
+    parser.add_argument("--sort", default="cumulative", choices=["cumulative", "tottime", "ncalls"],
+                        help="order of the functions (default cumulative)")
+    parser.add_argument("--script", help="only this script (e.g. perform_greedy_pairing)")
+    parser.add_argument("--merged-dir", help="save the merged stats of each script in this directory")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    profiles = find_profiles(args.paths)
+    if args.script:
+        profiles = {script: invocations for script, invocations in profiles.items()
+                    if script == args.script.replace(".py", "").replace(".", "_")}
+    if not profiles:
+        print(f"ERROR: no profiles found in {' '.join(args.paths)}", file=sys.stderr)
+        sys.exit(1)
+
+    for script in sorted(profiles):
+        summarize_script(script, profiles[script], args.top, args.sort, args.merged_dir)
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Renames the AF2 prediction folders of a project (and their files) replacing
+the IDs by the protein symbols of an annotations file (TSV with the IDs in
+the first column and the symbols in the last one, see annotations.txt). IDs
+without symbol (N/A) are kept.
+
+The whole rename plan is computed before anything is renamed. The plan is
+not applied if it has conflicts, i.e. two folders or files that would get
+the same name, or names that already exist (use --skip-conflicts to rename
+the other folders). With --dry-run it is only printed. Links to folders (e.g.
+the permutations of an IDs line, or results linked from other projects) are
+renamed, but the files of their targets are not.
+
+Folders are renamed in parallel. Each rename is written to a journal as soon
+as it is done, so a rename (even an interrupted one) can be reversed with:
+
+    annotate_AF2_models.py --undo <journal.tsv>
+"""
+
+import sys
+import os
+import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+NO_SYMBOL = ("", "N/A")
+
+
+###############################################################################
+################################## Planning ###################################
+###############################################################################
+
+def read_annotations(annotations_file):
+    """
+    Returns {ID: symbol} of the annotations file (first and last columns).
+    """
+    symbols = {}
+    with open(annotations_file) as annotations:
+        for line in annotations:
+            columns = line.rstrip("\n").split("\t")
+            if len(columns) < 2:
+                continue
+            symbol = columns[-1].strip()
+            if symbol not in NO_SYMBOL:
+                symbols[columns[0].strip()] = symbol
+    return symbols
+
+
+def annotated_name(name, symbols):
+    return "__vs__".join(symbols.get(ID, ID) for ID in name.split("__vs__"))
+
+
+def plan_folder(folder_path, new_name):
+    """
+    Renames [(old_path, new_path)] of the entries of a folder (their names
+    contain the name of the folder) and the folder itself, and the conflicts
+    of the folder. Only the link itself is renamed if the folder is a link.
+    """
+    name = os.path.basename(folder_path)
+    new_folder_path = os.path.join(os.path.dirname(folder_path), new_name)
+    if os.path.islink(folder_path):
+        return [(folder_path, new_folder_path)], []
+    with os.scandir(folder_path) as entries:
+        names = [entry.name for entry in entries]
+
+    renames, conflicts = [], []
+    existing = set(names)
+    targets = {}
+    for entry_name in names:
+        new_entry_name = entry_name.replace(name, new_name)
+        if new_entry_name == entry_name:
+            continue
+        if new_entry_name in targets:
+            conflicts.append(f"{entry_name} and {targets[new_entry_name]} would be renamed to {new_entry_name}")
+        elif new_entry_name in existing:
+            conflicts.append(f"{new_entry_name} already exists")
+        targets[new_entry_name] = entry_name
+        renames.append((os.path.join(folder_path, entry_name), os.path.join(folder_path, new_entry_name)))
+    renames.append((folder_path, new_folder_path))
+    return renames, conflicts
+
+
+def make_plan(AF2_folder, symbols, threads):
+    """
+    Returns {folder_name: [(old_path, new_path)]} of the folders to rename,
+    {folder_name: [conflicts]} and the number of folders without symbols.
+    """
+    with os.scandir(AF2_folder) as entries:
+        folders = sorted(entry.name for entry in entries if entry.is_dir() and not entry.name.startswith("."))
+    existing = set(folders)
+
+    new_names = {}
+    for name in folders:
+        new_name = annotated_name(name, symbols)
+        if new_name != name:
+            new_names[name] = new_name
+
+    conflicts = {}
+    by_new_name = {}
+    for name, new_name in new_names.items():
+        if "/" in new_name:
+            conflicts.setdefault(name, []).append(f"symbol with '/' in {new_name}")
+        elif new_name in by_new_name:
+            conflicts.setdefault(name, []).append(f"{by_new_name[new_name]} would also be renamed to {new_name}")
+        elif new_name in existing:
+            conflicts.setdefault(name, []).append(f"{new_name} already exists")
+        by_new_name.setdefault(new_name, name)
+
+    # The entries of the folders are listed in parallel
+    plan = {}
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        folder_plans = executor.map(lambda name: plan_folder(os.path.join(AF2_folder, name), new_names[name]),
+                                    new_names)
+        for name, (renames, folder_conflicts) in zip(new_names, folder_plans):
+            plan[name] = renames
+            if folder_conflicts:
+                conflicts.setdefault(name, []).extend(folder_conflicts)
+    return plan, conflicts, len(folders) - len(new_names)
+
+
+###############################################################################
+################################## Renaming ###################################
+###############################################################################
+
+class Journal:
+    """
+    Renames done (folder, old_path, new_path), one line per rename written
+    as soon as it is done.
+    """
+    def __init__(self, journal_file):
+        self.lock = threading.Lock()
+        self.journal = open(journal_file, "a")
+
+    def record(self, folder, old_path, new_path):
+        with self.lock:
+            self.journal.write(f"{folder}\t{old_path}\t{new_path}\n")
+            self.journal.flush()
+
+    def close(self):
+        self.journal.close()
+
+
+def rename_all(renames_by_folder, threads, journal=None):
+    """
+    Applies the renames of each folder (in order) in parallel. Returns the
+    errors {folder: message} (the renames of a folder stop at its first error).
+    """
+    def rename_folder(folder, renames):
+        for old_path, new_path in renames:
+            if os.path.lexists(new_path):
+                raise FileExistsError(f"{new_path} already exists")
+            os.rename(old_path, new_path)
+            if journal:
+                journal.record(folder, old_path, new_path)
+
+    errors = {}
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = {folder: executor.submit(rename_folder, folder, renames)
+                   for folder, renames in renames_by_folder.items()}
+        for folder, future in futures.items():
+            try:
+                future.result()
+            except OSError as error:
+                errors[folder] = str(error)
+    return errors
+
+
+def read_journal(journal_file):
+    """
+    Returns {folder: [(new_path, old_path)]}, the renames that reverse the
+    renames of a journal (in reverse order).
+    """
+    undo = {}
+    with open(journal_file) as journal:
+        for line in journal:
+            columns = line.rstrip("\n").split("\t")
+            if len(columns) != 3:
+                continue    # line of an interrupted write
+            folder, old_path, new_path = columns
+            undo.setdefault(folder, []).append((new_path, old_path))
+    for renames in undo.values():
+        renames.reverse()
+    return undo
+
+
+###############################################################################
+##################################### CLI #####################################
+###############################################################################
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        usage="%(prog)s <annotations_file> <AF2_folder_path> [options] | --undo <journal.tsv>",
+        description="Renames the AF2 prediction folders replacing the IDs by protein symbols.")
+    parser.add_argument("annotations_file", nargs="?", help="TSV with IDs (first column) and symbols (last column)")
+    parser.add_argument("AF2_folder", nargs="?", metavar="AF2_folder_path", help="AF2 folder of the project")
+    parser.add_argument("--dry-run", action="store_true", help="only print the rename plan")
+    parser.add_argument("--skip-conflicts", action="store_true",
+                        help="rename the folders without conflicts (by default nothing is renamed)")
+    parser.add_argument("--journal", help="journal of the renames (default: "
+                                          "./annotate_AF2_models.<date>.journal.tsv)")
+    parser.add_argument("--threads", type=int, default=16, help="folders renamed at the same time (default 16)")
+    parser.add_argument("--undo", metavar="JOURNAL", help="reverse the renames of a journal")
+    args = parser.parse_args()
+    if not args.undo and not (args.annotations_file and args.AF2_folder):
+        parser.error("the annotations file and the AF2 folder are required (or --undo <journal>)")
+    args.threads = max(1, args.threads)
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    if args.undo:
+        if not os.path.isfile(args.undo):
+            print(f"ERROR: File '{args.undo}' not found.", file=sys.stderr)
+            sys.exit(1)
+        undo = read_journal(args.undo)
+        errors = rename_all(undo, args.threads)
+        for folder, error in errors.items():
+            print(f"ERROR: {folder} not restored: {error}", file=sys.stderr)
+        print(f"{len(undo) - len(errors)} folders restored from {args.undo}")
+        sys.exit(1 if errors else 0)
+
+    if not os.path.isdir(args.AF2_folder):
+        print(f"ERROR: Folder '{args.AF2_folder}' not found.", file=sys.stderr)
+        sys.exit(1)
+    if not os.path.isfile(args.annotations_file):
+        print(f"ERROR: File '{args.annotations_file}' not found.", file=sys.stderr)
+        sys.exit(1)
+
+    start = time.time()
+    symbols = read_annotations(args.annotations_file)
+    plan, conflicts, unannotated = make_plan(args.AF2_folder, symbols, args.threads)
+    entries = sum(len(renames) for renames in plan.values())
+    print(f"Plan: {len(plan)} folders to rename ({entries} renames), {unannotated} folders without "
+          f"annotations, {len(conflicts)} folders with conflicts ({time.time() - start:.2f} s)")
+    for folder, folder_conflicts in conflicts.items():
+        for conflict in folder_conflicts:
+            print(f"CONFLICT: {folder}: {conflict}", file=sys.stderr)
+
+    if args.dry_run:
+        for folder, renames in plan.items():
+            marker = "SKIP " if folder in conflicts else ""
+            print(f"{marker}{folder} -> {os.path.basename(renames[-1][1])}")
+            for old_path, new_path in renames[:-1]:
+                print(f"{marker}    {os.path.basename(old_path)} -> {os.path.basename(new_path)}")
+        sys.exit(0)
+
+    if conflicts:
+        if not args.skip_conflicts:
+            print("ERROR: nothing renamed because of the conflicts (see --dry-run and --skip-conflicts)",
+                  file=sys.stderr)
+            sys.exit(1)
+        plan = {folder: renames for folder, renames in plan.items() if folder not in conflicts}
+    if not plan:
+        print("Nothing to rename")
+        sys.exit(0)
+
+    journal_file = args.journal or f"./annotate_AF2_models.{time.strftime('%Y%m%d_%H%M%S')}.journal.tsv"
+    journal = Journal(journal_file)
+    try:
+        errors = rename_all(plan, args.threads, journal)
+    finally:
+        journal.close()
+    for folder, error in errors.items():
+        print(f"ERROR: {folder} not renamed: {error}", file=sys.stderr)
+    print(f"{len(plan) - len(errors)} folders renamed. To reverse it: "
+          f"python {sys.argv[0]} --undo {journal_file}")
+    sys.exit(1 if errors else 0)
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checks the RoseTTAFold 2-track batch runner (scripts/RoseTTAFold_2track_batch.py)
+on CPU with the stub predictor (RF2_PREDICT_MSA=stub), without RoseTTAFold or
+a GPU. A queue of small pairs is run in a temporary folder and the outputs are
+checked:
+
+    run          every pair gets its direct and switched .npz files, the runs
+                 log one line per prediction and the queue its MSA depth
+    skip         pairs whose .npz files already exist are not predicted again
+    gpu failure  an MSA that fails on GPU is retried alone on CPU
+    crop         an MSA too deep for the GPU is predicted from a cropped copy,
+                 the queue gets the cropped depth and the copy is removed
+    command line the script runs a queue with RF2_PREDICT_MSA=stub
+
+Exits with 1 if any check fails:
+
+    python $DiscobaMultimerPath/utils/check_RF2_batch.py
+"""
+
+import sys
+import os
+import argparse
+import shutil
+import subprocess
+import tempfile
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO, "scripts"))
+
+import RoseTTAFold_2track_batch as batch_runner
+import rf2_memory
+
+L1, L2 = 12, 8
+
+
+###############################################################################
+################################### Inputs ####################################
+###############################################################################
+
+def write_pair(work_dir, name, depth):
+    """
+    Writes the direct and switched MSAs of a pair with depth sequences and
+    returns its queue line (with its depth in the 8th column).
+    """
+    direct = "ACDEFGHIKLMN" + "PQRSTVWY"
+    switched = direct[L1:] + direct[:L1]
+    fields = []
+    for suffix, query, L in (("", direct, L1), ("_switched", switched, L2)):
+        a3m_file = os.path.join(work_dir, f"{name}{suffix}.a3m")
+        with open(a3m_file, "w") as a3m:
+            a3m.write(f"#{L1},{L2}\t1,1\n")
+            for index in range(depth):
+                gaps = index % len(query)
+                a3m.write(f">seq{index}\n{query[:len(query) - gaps]}{'-' * gaps}\n")
+        fields += [a3m_file, os.path.join(work_dir, f"{name}{suffix}.npz"), str(L)]
+    return "\t".join(fields + ["30", str(depth)]) + "\n"
+
+
+def write_queue(work_dir, lines):
+    queue_file = os.path.join(work_dir, "queue.tsv")
+    with open(queue_file, "w") as queue:
+        queue.writelines(lines)
+    return queue_file
+
+
+def queue_depths(queue_file):
+    with open(queue_file) as queue:
+        return [int(line.rstrip("\n").split("\t")[7]) for line in queue if not line.startswith("#")]
+
+
+class FailingGPUPredictor(batch_runner.StubPredictor):
+    """
+    Stub predictor whose GPU predictions fail (e.g. out of memory).
+    """
+
+    def predict(self, a3m_file, npz_file, L1):
+        if not self.use_cpu:
+            raise RuntimeError("CUDA out of memory (simulated)")
+        super().predict(a3m_file, npz_file, L1)
+
+
+###############################################################################
+################################### Checks ####################################
+###############################################################################
+
+def check_run(work_dir):
+    queue_file = write_queue(work_dir, [write_pair(work_dir, f"A{index}__vs__B{index}", 20) for index in range(3)])
+    runs_log = os.path.join(work_dir, "runs.tsv")
+    failed = batch_runner.run_queue(queue_file, use_cpu=True, predict_msa=batch_runner.load_predict_msa("stub"),
+                                    runs_log=runs_log)
+    import numpy as np
+    npz_files = [os.path.join(work_dir, f"A{index}__vs__B{index}{suffix}.npz")
+                 for index in range(3) for suffix in ("", "_switched")]
+    shapes = [np.load(npz_file)["dist"].shape for npz_file in npz_files if os.path.isfile(npz_file)]
+    errors = []
+    if failed:
+        errors.append(f"{failed} pairs failed")
+    if shapes != [(L1 + L2, L1 + L2)] * 6:
+        errors.append(f"contact maps {shapes}, expected 6 of {(L1 + L2, L1 + L2)}")
+    if len(rf2_memory.read_runs_log(runs_log)) != 6:
+        errors.append(f"{len(rf2_memory.read_runs_log(runs_log))} runs logged, expected 6")
+    if queue_depths(queue_file) != [20, 20, 20]:
+        errors.append(f"queue depths {queue_depths(queue_file)}, expected [20, 20, 20]")
+    return errors
+
+
+def check_skip(work_dir):
+    queue_file = write_queue(work_dir, [write_pair(work_dir, "A__vs__B", 20)])
+    runs_log = os.path.join(work_dir, "runs.tsv")
+    for name in ("A__vs__B.npz", "A__vs__B_switched.npz"):
+        open(os.path.join(work_dir, name), "w").close()
+    batch_runner.run_queue(queue_file, use_cpu=True, predict_msa=batch_runner.load_predict_msa("stub"),
+                           runs_log=runs_log)
+    if os.path.exists(runs_log) or os.path.getsize(os.path.join(work_dir, "A__vs__B.npz")):
+        return ["a pair with its .npz files was predicted again"]
+    return []
+
+
+def check_gpu_failure(work_dir):
+    queue_file = write_queue(work_dir, [write_pair(work_dir, "A__vs__B", 20)])
+    runs_log = os.path.join(work_dir, "runs.tsv")
+    os.environ["RF2_GPU_GB"] = "80"
+    try:
+        failed = batch_runner.run_queue(queue_file, predict_msa=type("stub", (), {"Predictor": FailingGPUPredictor}),
+                                        runs_log=runs_log)
+    finally:
+        del os.environ["RF2_GPU_GB"]
+    runs = [(run["device"], run["status"]) for run in rf2_memory.read_runs_log(runs_log)]
+    expected = [("gpu", "failed"), ("cpu", "done")] * 2
+    errors = []
+    if failed:
+        errors.append("the pair failed")
+    if runs != expected:
+        errors.append(f"runs {runs}, expected {expected}")
+    return errors
+
+
+def check_crop(work_dir):
+    depth = 400
+    queue_file = write_queue(work_dir, [write_pair(work_dir, "A__vs__B", depth)])
+    runs_log = os.path.join(work_dir, "runs.tsv")
+    # GPU that fits about 3/4 of the MSA
+    fitting_GB = rf2_memory.estimate_peak_memory(L1 + L2, depth * 3 // 4) / 1e9
+    os.environ["RF2_GPU_GB"] = str(fitting_GB / rf2_memory.GPU_SAFETY_FRACTION)
+    try:
+        failed = batch_runner.run_queue(queue_file, predict_msa=batch_runner.load_predict_msa("stub"),
+                                        runs_log=runs_log)
+    finally:
+        del os.environ["RF2_GPU_GB"]
+    runs = rf2_memory.read_runs_log(runs_log)
+    errors = []
+    if failed:
+        errors.append("the pair failed")
+    if [run["device"] for run in runs] != ["crop", "crop"]:
+        errors.append(f"devices {[run['device'] for run in runs]}, expected ['crop', 'crop']")
+    used_depth = min(int(run["used_depth"]) for run in runs) if runs else None
+    if queue_depths(queue_file) != [used_depth] or not used_depth or used_depth >= depth:
+        errors.append(f"queue depth {queue_depths(queue_file)}, expected the cropped depth ({used_depth})")
+    leftovers = [name for name in os.listdir(work_dir) if "_cropped" in name]
+    if leftovers:
+        errors.append(f"cropped MSAs not removed: {' '.join(leftovers)}")
+    return errors
+
+
+def check_command_line(work_dir):
+    queue_file = write_queue(work_dir, [write_pair(work_dir, "A__vs__B", 20)])
+    environment = dict(os.environ, RF2_PREDICT_MSA="stub", RF2_RUNS_LOG=os.path.join(work_dir, "runs.tsv"))
+    process = subprocess.run([sys.executable, os.path.join(REPO, "scripts", "RoseTTAFold_2track_batch.py"),
+                              queue_file, "--cpu"], cwd=work_dir, env=environment,
+                             stdin=subprocess.DEVNULL, capture_output=True, text=True, timeout=120)
+    if process.returncode != 0 or not process.stdout.startswith("done\tA__vs__B.npz"):
+        return [f"exit code {process.returncode}: {process.stdout.strip()} {process.stderr.strip()}"]
+    return []
+
+
+CHECKS = {
+    "run": check_run,
+    "skip": check_skip,
+    "gpu failure": check_gpu_failure,
+    "crop": check_crop,
+    "command line": check_command_line,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Checks the RoseTTAFold 2-track batch runner with a stub model.")
+    parser.parse_args()
+
+    failed = 0
+    for name, check in CHECKS.items():
+        work_dir = tempfile.mkdtemp(prefix="discoba_check_RF2.")
+        try:
+            errors = check(work_dir)
+        except Exception as error:
+            errors = [f"{type(error).__name__}: {error}"]
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        print(f"{name:<14}{'FAILED' if errors else 'OK'}")
+        for error in errors:
+            print(f"    {error}")
+        failed += bool(errors)
+
+    if failed:
+        print(f"ERROR: {failed} checks failed", file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checks the diversity filter of scripts/filter_a3m_diversity.py against a
+reference that compares every pair of sequences on all the columns. The
+filter screens the pairs on a subset of columns, so it must keep exactly the
+same sequences as the reference. The MSAs are random families of mutated
+sequences with gaps, with and without the screening (more or fewer columns
+than SAMPLED_COLUMNS), and MSAs whose near-identical pairs (95-97%) have all
+their mismatches in the sampled columns, the worst case for the screening.
+
+Exits with 1 if any check fails:
+
+    python $DiscobaMultimerPath/utils/check_diversity_filter.py [--seed N]
+"""
+
+import sys
+import os
+import argparse
+import time
+import numpy as np
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO, "scripts"))
+
+import filter_a3m_diversity as diversity
+
+GAP = diversity.GAP_CODE
+
+
+###############################################################################
+#################################### MSAs #####################################
+###############################################################################
+
+def family_msa(N, L, rng):
+    """
+    Query followed by sequences mutated (1 to 60%) from a previous one, each
+    with a random gap stretch.
+    """
+    msa = np.empty((N, L), dtype=np.uint8)
+    msa[0] = rng.integers(0, 20, L)
+    for i in range(1, N):
+        row = msa[rng.integers(i)].copy()
+        mutated = rng.random(L) < rng.choice([0.01, 0.03, 0.05, 0.08, 0.3, 0.6])
+        row[mutated] = rng.integers(0, 20, mutated.sum())
+        gap_start = rng.integers(L)
+        row[gap_start:gap_start + rng.integers(L // 2)] = GAP
+        msa[i] = row
+    return msa
+
+
+def sampled_mismatches_msa(N, L, rng):
+    """
+    Sequences 95 to 97% identical to the query, with every mismatch in the
+    columns sampled by the filter.
+    """
+    columns = np.sort(np.random.default_rng(0).choice(L, diversity.SAMPLED_COLUMNS, replace=False))
+    msa = np.repeat(rng.integers(0, 20, L).astype(np.uint8)[None, :], N, axis=0)
+    for i in range(1, N):
+        mismatches = rng.choice(columns, int(L * rng.uniform(0.03, 0.05)), replace=False)
+        msa[i, mismatches] = (msa[0, mismatches] + rng.integers(1, 20, len(mismatches))) % 20
+    return msa
+
+
+def reference_filter(msa, depth, identity_cutoff=diversity.IDENTITY_CUTOFF):
+    """
+    Keeps a row if its identity on all the columns to every kept row is lower
+    than the cutoff.
+    """
+    residues = (msa != GAP).sum(axis=1)
+    kept = [0]
+    for i in range(1, len(msa)):
+        if len(kept) >= depth:
+            break
+        same = ((msa[kept] == msa[i]) & (msa[i] != GAP)).sum(axis=1)
+        if not (same / np.maximum(np.minimum(residues[kept], residues[i]), 1) >= identity_cutoff).any():
+            kept.append(i)
+    return kept
+
+
+###############################################################################
+################################### Checks ####################################
+###############################################################################
+
+CASES = [
+    # (name, MSA generator, N, L, depth)
+    ("few columns", family_msa, 600, 90, 400),
+    ("families", family_msa, 1500, 300, 1000),
+    ("families, deep", family_msa, 2500, 700, 800),
+    ("sampled mismatches", sampled_mismatches_msa, 400, 1000, 400),
+]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Checks the diversity filter against an all-pairs reference.")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random MSAs (default 0)")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    failed = 0
+    for name, generator, N, L, depth in CASES:
+        msa = generator(N, L, rng)
+        start = time.time()
+        kept = diversity.diversity_filter(msa, depth)
+        seconds = time.time() - start
+        expected = reference_filter(msa, depth)
+        status = "OK" if kept == expected else "FAILED"
+        print(f"{name:<20}N={N:<6}L={L:<6}kept {len(kept):<6}{seconds:6.2f} s  {status}")
+        if kept != expected:
+            differences = sorted(set(kept) ^ set(expected))
+            print(f"    {len(differences)} rows differ from the reference (e.g. {differences[:5]})")
+            failed += 1
+
+    if failed:
+        print(f"ERROR: {failed} checks failed", file=sys.stderr)
+        sys.exit(1)
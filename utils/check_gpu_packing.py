@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checks the packing of AF2 predictions on the GPUs (scripts/gpu_packing.py)
+without a GPU: nvidia-smi is replaced by a script that reports two fake GPUs
+and colabfold_batch by a stub that records on which GPU and when each job
+ran. The checks:
+
+    best fit         a job goes to the GPU with the least free memory that can
+                     hold it, and a job bigger than every GPU waits for the
+                     biggest one to be empty
+    packing          the jobs of a queue share the GPUs, but the estimated
+                     footprints of the jobs running on a GPU never exceed
+                     SAFETY_FRACTION of its memory
+    memory model     AF2_BASE_GB, AF2_PAIR_GB_PER_RES2 and AF2_GPU_SAFETY
+                     change the footprints and the margin
+    failed job       a failed job is reported and the script exits with 1
+
+Exits with 1 if any check fails:
+
+    python $DiscobaMultimerPath/utils/check_gpu_packing.py
+"""
+
+import sys
+import os
+import argparse
+import shutil
+import subprocess
+import tempfile
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GPU_PACKING = os.path.join(REPO, "scripts", "gpu_packing.py")
+sys.path.insert(0, os.path.join(REPO, "scripts"))
+
+import gpu_packing
+
+# Two fake GPUs (MiB, as reported by nvidia-smi)
+GPUS_MIB = {0: 16384, 1: 40960}
+
+# Combined lengths of the jobs of the queue (footprints of 3 to 18 GB)
+LENGTHS = [1600, 1000, 1000, 800, 500, 500, 300, 300, 300, 300]
+
+FAKE_NVIDIA_SMI = "#!/bin/sh\n" + "".join(f"echo '{index}, {memory}'\n" for index, memory in GPUS_MIB.items())
+
+# Records "name GPU start end" for each job in $STUB_RUNS (fails the jobs named fail*)
+STUB_COLABFOLD_BATCH = """#!/bin/sh
+for argument in "$@"; do input=$output; output=$argument; done
+name=$(basename $output)
+start=$(date +%s.%N)
+sleep 0.4
+mkdir -p $output
+echo "$name $CUDA_VISIBLE_DEVICES $start $(date +%s.%N)" >> $STUB_RUNS
+case $name in fail*) exit 1 ;; esac
+touch $output/$name.done.txt
+"""
+
+
+###############################################################################
+################################### Inputs ####################################
+###############################################################################
+
+def write_executable(path, content):
+    with open(path, "w") as executable:
+        executable.write(content)
+    os.chmod(path, 0o755)
+    return path
+
+
+def write_jobs(work_dir, names_lengths):
+    jobs_file = os.path.join(work_dir, "jobs.tsv")
+    with open(jobs_file, "w") as jobs:
+        for name, length in names_lengths:
+            a3m_file = os.path.join(work_dir, f"{name}.a3m")
+            with open(a3m_file, "w") as a3m:
+                a3m.write(f"#{length}\t1\n>101\n{'A' * length}\n")
+            jobs.write(f"{a3m_file}\t{os.path.join(work_dir, 'AF2', name)}\t{length}\n")
+    return jobs_file
+
+
+def run_packing(work_dir, names_lengths, memory_model=None):
+    """
+    Runs gpu_packing.py on a queue. Returns (process, {name: (GPU, start, end)}).
+    """
+    jobs_file = write_jobs(work_dir, names_lengths)
+    environment = {variable: value for variable, value in os.environ.items()
+                   if variable not in ("AF2_BASE_GB", "AF2_PAIR_GB_PER_RES2", "AF2_GPU_SAFETY",
+                                       "CUDA_VISIBLE_DEVICES")}
+    environment.update(memory_model or {})
+    environment.update({
+        "NVIDIA_SMI": write_executable(os.path.join(work_dir, "nvidia-smi"), FAKE_NVIDIA_SMI),
+        "COLABFOLD_BATCH": write_executable(os.path.join(work_dir, "colabfold_batch"), STUB_COLABFOLD_BATCH),
+        "STUB_RUNS": os.path.join(work_dir, "stub_runs.txt"),
+        "DISCOBA_TELEMETRY": os.path.join(work_dir, "telemetry.jsonl"),
+    })
+    process = subprocess.run([sys.executable, GPU_PACKING, jobs_file, "--num-recycle", "1"], cwd=work_dir,
+                             env=environment, stdin=subprocess.DEVNULL, capture_output=True, text=True,
+                             timeout=300)
+    runs = {}
+    if os.path.isfile(environment["STUB_RUNS"]):
+        with open(environment["STUB_RUNS"]) as stub_runs:
+            for line in stub_runs:
+                name, GPU, start, end = line.split()
+                runs[name] = (int(GPU), float(start), float(end))
+    return process, runs
+
+
+def packing_errors(runs, names_lengths, base_GB, pair_GB, safety):
+    """
+    Errors if the footprints of the jobs running on a GPU at the start of a
+    job exceed its margin (unless the job runs alone). Also returns the
+    highest number of jobs that ran at the same time on a GPU.
+    """
+    lengths = dict(names_lengths)
+    errors = []
+    most_jobs = 0
+    for name, (GPU, start, _) in runs.items():
+        running = [other for other, (other_GPU, other_start, other_end) in runs.items()
+                   if other_GPU == GPU and other_start <= start < other_end]
+        most_jobs = max(most_jobs, len(running))
+        used_GB = sum(base_GB + pair_GB * lengths[other] ** 2 for other in running)
+        budget_GB = GPUS_MIB[GPU] * 1024 ** 2 / 1e9 * safety
+        if len(running) > 1 and used_GB > budget_GB + 1e-6:
+            errors.append(f"GPU {GPU}: {' '.join(sorted(running))} use ~{used_GB:.1f} GB "
+                          f"(margin {budget_GB:.1f} GB)")
+    return errors, most_jobs
+
+
+###############################################################################
+################################### Checks ####################################
+###############################################################################
+
+def check_best_fit(work_dir):
+    GPUs = {index: memory * 1024 ** 2 / 1e9 for index, memory in GPUS_MIB.items()}
+    errors = []
+    # 4 GB fit on both GPUs: the one with less free memory is used
+    if gpu_packing.choose_GPU(4.0, GPUs, {0: 0.0, 1: 0.0}) != 0:
+        errors.append("a small job did not go to the GPU with the least free memory")
+    if gpu_packing.choose_GPU(4.0, GPUs, {0: 13.0, 1: 0.0}) != 1:
+        errors.append("a job was put on a GPU without room for it")
+    # 50 GB fit on no GPU: alone on the biggest one
+    if gpu_packing.choose_GPU(50.0, GPUs, {0: 0.0, 1: 1.0}) is not None:
+        errors.append("a job bigger than every GPU did not wait for the biggest one to be empty")
+    if gpu_packing.choose_GPU(50.0, GPUs, {0: 5.0, 1: 0.0}) != 1:
+        errors.append("a job bigger than every GPU was not run on the biggest one")
+    return errors
+
+
+def check_packing(work_dir):
+    names_lengths = [(f"job{index}_L{length}", length) for index, length in enumerate(LENGTHS)]
+    process, runs = run_packing(work_dir, names_lengths)
+    errors = []
+    if process.returncode != 0:
+        errors.append(f"exit code {process.returncode}: {process.stderr.strip()}")
+    if sorted(runs) != sorted(name for name, _ in names_lengths):
+        errors.append(f"{len(runs)} of {len(names_lengths)} jobs ran")
+    margin_errors, most_jobs = packing_errors(runs, names_lengths, gpu_packing.AF2_BASE_GB,
+                                              gpu_packing.AF2_PAIR_GB_PER_RES2, gpu_packing.SAFETY_FRACTION)
+    errors += margin_errors
+    if most_jobs < 2:
+        errors.append("no GPU ran several jobs at the same time")
+    if not all(os.path.isfile(os.path.join(work_dir, "reports", "AF2_packing", f"{name}.log"))
+               for name, _ in names_lengths):
+        errors.append("missing logs in reports/AF2_packing")
+    return errors
+
+
+def check_memory_model(work_dir):
+    names_lengths = [(f"job{index}_L300", 300) for index in range(4)]
+    # 8 GB per job and 30% of the GPUs: one job at a time on GPU 0, 1 on GPU 1
+    memory_model = {"AF2_BASE_GB": "8", "AF2_PAIR_GB_PER_RES2": "1e-9", "AF2_GPU_SAFETY": "0.3"}
+    process, runs = run_packing(work_dir, names_lengths, memory_model)
+    errors = []
+    if process.returncode != 0:
+        errors.append(f"exit code {process.returncode}: {process.stderr.strip()}")
+    margin_errors, most_jobs = packing_errors(runs, names_lengths, 8.0, 1e-9, 0.3)
+    errors += margin_errors
+    if most_jobs != 1:
+        errors.append(f"{most_jobs} jobs ran at the same time on a GPU, expected 1")
+
+    shutil.rmtree(os.path.join(work_dir, "AF2"))
+    process, _ = run_packing(work_dir, names_lengths, {"AF2_GPU_SAFETY": "1.5"})
+    if process.returncode == 0 or "AF2_GPU_SAFETY" not in process.stderr:
+        errors.append("AF2_GPU_SAFETY=1.5 was accepted")
+    return errors
+
+
+def check_failed_job(work_dir):
+    names_lengths = [("fail_L400", 400), ("job_L300", 300)]
+    process, runs = run_packing(work_dir, names_lengths)
+    errors = []
+    if process.returncode != 1 or "1 AF2 jobs failed" not in process.stderr:
+        errors.append(f"exit code {process.returncode}: {process.stderr.strip()}")
+    if not os.path.isfile(os.path.join(work_dir, "AF2", "job_L300", "job_L300.done.txt")):
+        errors.append("the other job did not finish")
+    return errors
+
+
+CHECKS = {
+    "best fit": check_best_fit,
+    "packing": check_packing,
+    "memory model": check_memory_model,
+    "failed job": check_failed_job,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Checks the packing of AF2 predictions on fake GPUs.")
+    parser.parse_args()
+
+    failed = 0
+    for name, check in CHECKS.items():
+        work_dir = tempfile.mkdtemp(prefix="discoba_check_packing.")
+        try:
+            errors = check(work_dir)
+        except Exception as error:
+            errors = [f"{type(error).__name__}: {error}"]
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        print(f"{name:<14}{'FAILED' if errors else 'OK'}")
+        for error in errors:
+            print(f"    {error}")
+        failed += bool(errors)
+
+    if failed:
+        print(f"ERROR: {failed} checks failed", file=sys.stderr)
+        sys.exit(1)
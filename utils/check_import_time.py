@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checks the import time of the Python entry points against a budget.
+
+Each entry point is run with representative arguments (COMMANDS) on small
+inputs created in an empty directory, with `python -X importtime`, so it
+imports the modules of its real code path, including the ones imported
+only when they are needed (NumPy, Biopython, matplotlib, ...). Heavy modules
+must be imported only on the code paths that use them. The import time of a
+script is the sum of the cumulative times of the modules it imports (the
+modules imported by the interpreter itself are not counted). Its best time of
+--repeat runs is compared with its budget in COMMANDS.
+
+A script that exits with an error is reported as FAILED (it did not reach its
+real code path), and one that needs a module that is not installed (e.g.
+matplotlib for the plots) as NOT RUN. Exits with 1 if any script failed or is
+over its budget, e.g. after a change that adds a heavy import to a path that
+does not need it:
+
+    python $DiscobaMultimerPath/utils/check_import_time.py
+    python $DiscobaMultimerPath/utils/check_import_time.py --verbose scripts/plot_msa.py
+
+The budgets were set on a workstation with a warm disk cache. On slower
+machines use --factor to scale all of them.
+"""
+
+import sys
+import os
+import argparse
+import re
+import shutil
+import subprocess
+import tempfile
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Import-time budget of each entry point (milliseconds, without the
+# interpreter start-up, about twice its time when it was set) and the
+# arguments of a representative run on the inputs of write_inputs. Entry
+# points that only start services or need the network are run with --help.
+COMMANDS = {
+    "scripts/RoseTTAFold_2track_plot_coev.py": (300, ["--metrics-only", "A__vs__B.npz", "B__vs__A.npz", "5", "3"]),
+    "scripts/RoseTTAFold_2track_batch.py": (270, ["queue.tsv", "--cpu"]),
+    "scripts/perform_greedy_pairing.py": (400, ["A__vs__B.a3m", "A.a3m", "B.a3m"]),
+    "scripts/perform_pairing_general_solution.py": (400, ["A__vs__B.a3m", "A.a3m", "B.a3m"]),
+    "scripts/plot_msa.py": (600, ["pair.a3m"]),
+    "scripts/reformat_mmseq_table_2.0.py": (30, ["A"]),
+    "scripts/merge_MSA.py": (60, ["pair.a3m", "discoba_pair.a3m", "merged.a3m"]),
+    "scripts/msa_store.py": (250, ["pack", "pair.a3m"]),
+    "scripts/sort_a3m_by_similarity.py": (300, ["pair.a3m", "sorted.a3m", "1"]),
+    "scripts/filter_a3m_diversity.py": (250, ["pair.a3m", "filtered.a3m", "20"]),
+    "scripts/af2_buckets.py": (75, ["jobs.tsv"]),
+    "scripts/gpu_packing.py": (75, ["jobs.tsv"]),
+    "scripts/colabfold_msa_client.py": (250, ["--help"]),
+    "scripts/compress_msa.py": (70, ["compress", "--codec", "gz", "pair.a3m"]),
+    "scripts/discoba_pipeline.py": (120, ["--help"]),
+    "scripts/discoba_worker.py": (60, ["--help"]),
+    "scripts/export_results.py": (90, ["-a", "IDs.txt", "export"]),
+    "scripts/job_db.py": (80, ["status"]),
+    "scripts/metrics_exporter.py": (80, ["--table", "IDs.txt", "--database", "database.fasta", "--interval", "0"]),
+    "scripts/result_cache.py": (80, ["key", "AF2", "database.fasta", "pair.a3m", "A", "B"]),
+    "scripts/telemetry.py": (60, ["summary"]),
+    "utils/aggregate_profiles.py": (80, ["--help"]),
+    "utils/annotate_AF2_models.py": (80, ["annotations.tsv", "AF2", "--dry-run"]),
+    "utils/extract_pLDDT_pTM_ipTM.py": (100, ["AF2", "scores.tsv", "--no-cache"]),
+    "utils/generate_2mers_combinations.py": (60, ["single_IDs.txt", "pairs.txt"]),
+}
+
+SEQUENCES = {"A": "MKTAYIAKQRQISFVKSHFSRQ", "B": "GSHMLEDPVDAFQEIAKRLGE"}
+
+# Predictor of the RF2-track runner (no network is loaded)
+STUB_PREDICTOR = """\
+import numpy as np
+
+class Predictor:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def predict(self, a3m_file, npz_file, L1):
+        np.savez_compressed(npz_file, dist=np.zeros((1, 1)))
+"""
+
+
+def write_inputs(work_dir):
+    """
+    Writes the small inputs of COMMANDS in work_dir (a project folder with
+    two proteins, A and B) and returns the environment of the runs.
+    """
+    import numpy as np
+
+    def write(name, text):
+        os.makedirs(os.path.join(work_dir, os.path.dirname(name)), exist_ok=True)
+        with open(os.path.join(work_dir, name), "w") as output:
+            output.write(text)
+
+    A, B = SEQUENCES["A"], SEQUENCES["B"]
+    write("database.fasta", "".join(f">{ID}\n{sequence}\n" for ID, sequence in SEQUENCES.items()))
+    write("IDs.txt", "A\tB\n")
+    write("single_IDs.txt", "A\nB\n")
+    write("annotations.tsv", "A\tprotA\nB\tprotB\n")
+    for ID, sequence in SEQUENCES.items():
+        hits = "".join(f">UniRef100_{ID}{index} n=1 Tax=Species TaxID={index}\n{sequence[:-index]}{'-' * index}\n"
+                       for index in (1, 2, 3))
+        write(f"{ID}.a3m", f">{ID}\n{sequence}\n{hits}")
+    write("pair.a3m", f"#{len(A)},{len(B)}\t1,1\n>101\t102\n{A}{B}\n"
+          + "".join(f">hit{index}\n{A[:-index]}{'-' * index}{B}\n" for index in (1, 2, 3)))
+    write("discoba_pair.a3m", f"#{len(A)},{len(B)}\t1,1\n>101\t102\n{A}{B}\n>hit4\n{A}{B[:-4]}----\n")
+    write("queryDB.tab", "")
+    write("AF2/A__vs__B/A__vs__B.done.txt", "")
+    write("jobs.tsv", f"pair.a3m\tAF2/A__vs__B\t{len(A) + len(B)}\n")
+    write("nvidia-smi", "#!/bin/sh\necho '0, 16384'\n")
+    os.chmod(os.path.join(work_dir, "nvidia-smi"), 0o755)
+    write("stub_predict_msa.py", STUB_PREDICTOR)
+    write("queue.tsv", "pair.a3m\tA__vs__B.npz\t{0}\tpair.a3m\tB__vs__A.npz\t{1}\n".format(len(A), len(B)))
+    for name in ("A__vs__B.npz", "B__vs__A.npz"):
+        np.savez_compressed(os.path.join(work_dir, name), dist=np.random.default_rng(0).random((len(A) + len(B),) * 2))
+
+    environment = dict(os.environ, DiscobaMultimerPath=REPO, NVIDIA_SMI=os.path.join(work_dir, "nvidia-smi"),
+                       COLABFOLD_BATCH="true", RF2_PREDICT_MSA=os.path.join(work_dir, "stub_predict_msa.py"),
+                       RF2_RUNS_LOG=os.path.join(work_dir, "RF2_runs.tsv"))
+    environment.pop("DISCOBA_PROFILE", None)
+    environment.pop("DISCOBA_WORKER_SOCKET", None)
+    return environment
+
+
+def parse_importtime(stderr):
+    """
+    Returns the (cumulative_us, module) of the top-level imports of an
+    `-X importtime` report (nested imports are included in their parents).
+    """
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, module = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():
+            continue    # header
+        # Nested imports are indented with two spaces per level
+        if module.startswith("  "):
+            continue
+        imports.append((int(cumulative), module.strip()))
+    return imports
+
+
+def run_importtime(command, work_dir, environment=None):
+    """
+    Runs a command with `-X importtime`. Returns its exit code, its
+    top-level imports and its standard error (without the import times).
+    """
+    process = subprocess.run([sys.executable, "-X", "importtime"] + command, cwd=work_dir,
+                             stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                             stderr=subprocess.PIPE, text=True, timeout=120, env=environment)
+    errors = "\n".join(line for line in process.stderr.splitlines() if not line.startswith("import time:"))
+    return process.returncode, parse_importtime(process.stderr), errors
+
+
+def script_imports(script, baseline, repeat):
+    """
+    Runs a script repeat times (each run with new inputs). Returns its state
+    (OK, FAILED or NOT RUN with the missing module), its best import time
+    (ms) and its imports in that run (module, ms), without the modules of
+    the interpreter start-up.
+    """
+    best = None
+    for _ in range(repeat):
+        work_dir = tempfile.mkdtemp(prefix="discoba_importtime.")
+        try:
+            environment = write_inputs(work_dir)
+            exit_code, imports, errors = run_importtime([os.path.join(REPO, script)] + COMMANDS[script][1],
+                                                        work_dir, environment)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        if exit_code != 0:
+            missing = re.search(r"ModuleNotFoundError: No module named '([^']+)'", errors)
+            if missing:
+                return f"NOT RUN (no {missing.group(1)})", 0.0, []
+            return "FAILED", 0.0, [(line, 0.0) for line in errors.splitlines()[-3:]]
+        imports = [(module, cumulative / 1000) for cumulative, module in imports if module not in baseline]
+        total = sum(ms for _, ms in imports)
+        if best is None or total < best[0]:
+            best = (total, imports)
+    return "OK", best[0], best[1]
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Checks the import time of the Python entry points.")
+    parser.add_argument("scripts", nargs="*", help="entry points to check (default: all of COMMANDS)")
+    parser.add_argument("--repeat", type=int, default=5, help="runs of each script, the best is used (default 5)")
+    parser.add_argument("--factor", type=float, default=1.0, help="scale the budgets (e.g. 2 on a slow machine)")
+    parser.add_argument("--verbose", action="store_true", help="list the slowest imports of each script")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    scripts = args.scripts or list(COMMANDS)
+    for script in scripts:
+        if script not in COMMANDS:
+            print(f"ERROR: no budget for {script} (add it to COMMANDS)", file=sys.stderr)
+            sys.exit(1)
+
+    work_dir = tempfile.mkdtemp(prefix="discoba_importtime.")
+    try:
+        _, baseline_imports, _ = run_importtime(["-c", "pass"], work_dir)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    baseline = {module for _, module in baseline_imports}
+
+    failed = 0
+    print(f"{'script':<48}{'import_ms':>10}{'budget_ms':>10}  status")
+    for script in scripts:
+        budget = COMMANDS[script][0] * args.factor
+        status, total, imports = script_imports(script, baseline, max(1, args.repeat))
+        if status == "OK" and total > budget:
+            status = "OVER BUDGET"
+        failed += status in ("FAILED", "OVER BUDGET")
+        print(f"{script:<48}{total:10.1f}{budget:10.1f}  {status}")
+        if status == "FAILED":
+            for line, _ in imports:
+                print(f"    {line}")
+        elif args.verbose or status == "OVER BUDGET":
+            for module, ms in sorted(imports, key=lambda item: -item[1])[:5]:
+                print(f"    {ms:8.1f} ms  {module}")
+
+    if failed:
+        print(f"ERROR: {failed} scripts failed or are over their import-time budget", file=sys.stderr)
+        sys.exit(1)
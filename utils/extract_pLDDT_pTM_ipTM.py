@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Extracts the mean pLDDT, pTM and ipTM of each model of the AF2 prediction
+folders (ID1__vs__ID2) of a project to a TSV table:
+
+    ID1  ID2  rank  pLDDT  pTM  ipTM
+
+The values are read from the ranking lines of the ColabFold log.txt of each
+folder (the same values as in the log). If the log has no ranking lines (e.g.
+it was removed), they are computed from the score files
+(*_scores_rank_*.json). Complexes of more than two proteins have the rest of
+their IDs in ID2 (ID2__vs__ID3...) and monomers have an empty ipTM.
+
+The folders are scanned with a pool of threads. The values of each folder
+are cached with the modification times of the folder and its log (in
+<AF2_folder>/.scores_cache.json by default), so later runs only read the
+folders that are new or changed.
+"""
+
+import sys
+import os
+import argparse
+import glob
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+COLUMNS = ["ID1", "ID2", "rank", "pLDDT", "pTM", "ipTM"]
+
+# Ranking line of the ColabFold log, e.g.
+# 2024-01-01 12:00:00,000 rank_001_alphafold2_multimer_v3_model_2_seed_000 pLDDT=85.2 pTM=0.812 ipTM=0.79
+RANK_LINE = re.compile(r"rank_0*(\d+)_\S*\s+pLDDT=([0-9.]+)\s+pTM=([0-9.]+)(?:\s+ipTM=([0-9.]+))?")
+# Start of the section of each query, e.g. 2024-01-01 12:00:00,000 Query 1/1: ID1__vs__ID2 (length 512)
+QUERY_LINE = re.compile(r"Query \d+/\d+: (\S+)")
+SCORES_FILE = re.compile(r"_scores_rank_0*(\d+)_")
+
+# Version of the cached values (cached entries of other versions are read again)
+CACHE_VERSION = 2
+
+
+###############################################################################
+################################### Parsing ###################################
+###############################################################################
+
+def parse_log(log_file, name=None):
+    """
+    Returns the [rank, pLDDT, pTM, ipTM] of the ranking lines of a log (the
+    last ranking if the prediction was run more than once). If the log has
+    the sections of several queries (e.g. the log of a whole AF2 bucket),
+    only the ranking lines of the query name are read.
+    """
+    rows, query = [], None
+    with open(log_file, errors="replace") as log:
+        lines = log.readlines()
+    queries = {match.group(1) for match in map(QUERY_LINE.search, lines) if match}
+    if len(queries) > 1 and name not in queries:
+        return []
+    for line in lines:
+        match = QUERY_LINE.search(line)
+        if match:
+            query = match.group(1)
+            continue
+        if "rank_" not in line or (len(queries) > 1 and query != name):
+            continue
+        match = RANK_LINE.search(line)
+        if not match:
+            continue
+        rank, pLDDT, pTM, ipTM = match.groups()
+        if rank == "1":
+            rows = []   # a new ranking
+        rows.append([rank, pLDDT, pTM, ipTM or ""])
+    return rows
+
+
+def parse_score_files(folder):
+    """
+    Returns the [rank, pLDDT, pTM, ipTM] of the score files of a folder
+    (formatted as in the log).
+    """
+    rows = []
+    for scores_file in glob.glob(os.path.join(folder, "*_scores_rank_*.json")):
+        match = SCORES_FILE.search(os.path.basename(scores_file))
+        if not match:
+            continue
+        with open(scores_file) as scores_json:
+            scores = json.load(scores_json)
+        if not scores.get("plddt") or "ptm" not in scores:
+            continue
+        pLDDT = sum(scores["plddt"]) / len(scores["plddt"])
+        rows.append([match.group(1), f"{pLDDT:.3g}", f"{scores['ptm']:.3g}",
+                     f"{scores['iptm']:.3g}" if "iptm" in scores else ""])
+    return sorted(rows, key=lambda row: int(row[0]))
+
+
+def folder_state(folder):
+    """
+    Modification times (and size of the log) that change when the results
+    of a folder change.
+    """
+    state = [os.stat(folder).st_mtime_ns]
+    log_file = os.path.join(folder, "log.txt")
+    if os.path.exists(log_file):
+        log_stat = os.stat(log_file)
+        state += [log_stat.st_mtime_ns, log_stat.st_size]
+    return state
+
+
+def extract_folder(folder, cached):
+    """
+    Returns (name, state, rows, was_read) of a prediction folder. The cached
+    rows are used if the folder did not change.
+    """
+    name = os.path.basename(folder)
+    try:
+        state = folder_state(folder)
+    except OSError:
+        return name, None, [], False    # removed while scanning
+    if cached and cached.get("state") == state:
+        return name, state, cached["rows"], False
+
+    rows = []
+    log_file = os.path.join(folder, "log.txt")
+    try:
+        if os.path.exists(log_file):
+            rows = parse_log(log_file, name)
+        if not rows:
+            rows = parse_score_files(folder)
+    except (OSError, ValueError) as error:
+        print(f"WARNING: {name}: {error}", file=sys.stderr)
+    return name, state, rows, True
+
+
+###############################################################################
+#################################### Cache ####################################
+###############################################################################
+
+def read_cache(cache_file):
+    if not cache_file or not os.path.isfile(cache_file):
+        return {}
+    try:
+        with open(cache_file) as cache_json:
+            cache = json.load(cache_json)
+    except ValueError:
+        return {}   # corrupted: everything is read again
+    if cache.get("version") != CACHE_VERSION:
+        return {}
+    return cache.get("folders", {})
+
+
+def write_atomically(path, write):
+    temporary_file = f"{path}.tmp.{os.getpid()}"
+    with open(temporary_file, "w") as output:
+        write(output)
+    os.replace(temporary_file, path)
+
+
+###############################################################################
+##################################### CLI #####################################
+###############################################################################
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Extracts the pLDDT, pTM and ipTM of the AF2 models of a project.")
+    parser.add_argument("AF2_folder", help="folder with the AF2 prediction folders (e.g. ./AF2)")
+    parser.add_argument("output_file", help="output TSV table")
+    parser.add_argument("--threads", type=int, default=16, help="folders read at the same time (default 16)")
+    parser.add_argument("--cache", help="cache of the values of each folder "
+                                        "(default: <AF2_folder>/.scores_cache.json)")
+    parser.add_argument("--no-cache", action="store_true", help="read all the folders (the cache is rewritten)")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    if not os.path.isdir(args.AF2_folder):
+        print(f"ERROR: {args.AF2_folder} is not a directory", file=sys.stderr)
+        sys.exit(1)
+    cache_file = args.cache or os.path.join(args.AF2_folder, ".scores_cache.json")
+    cache = {} if args.no_cache else read_cache(cache_file)
+
+    with os.scandir(args.AF2_folder) as entries:
+        folders = sorted(entry.path for entry in entries
+                         if entry.is_dir() and not entry.name.startswith("."))
+    with ThreadPoolExecutor(max_workers=max(1, args.threads)) as executor:
+        results = list(executor.map(lambda folder: extract_folder(folder, cache.get(os.path.basename(folder))),
+                                    folders))
+
+    def write_table(output):
+        output.write("\t".join(COLUMNS) + "\n")
+        for name, _, rows, _ in results:
+            ID_1, _, ID_2 = name.partition("__vs__")
+            for row in rows:
+                output.write("\t".join([ID_1, ID_2] + row) + "\n")
+
+    write_atomically(args.output_file, write_table)
+    new_cache = {name: {"state": state, "rows": rows} for name, state, rows, _ in results if state is not None}
+    try:
+        write_atomically(cache_file, lambda output: json.dump({"version": CACHE_VERSION, "folders": new_cache}, output))
+    except OSError as error:
+        print(f"WARNING: cache not saved in {cache_file} ({error})", file=sys.stderr)
+
+    read = sum(was_read for _, _, _, was_read in results)
+    models = sum(len(rows) for _, _, rows, _ in results)
+    print(f"{models} models of {len(results)} folders saved in {args.output_file} "
+          f"({read} folders read, {len(results) - read} unchanged)")
@@ -1,11 +1,16 @@
 #!/bin/bash
 
+# The values are now extracted by extract_pLDDT_pTM_ipTM.py, which caches the
+# values of each folder (later runs only read the new or changed folders).
+EXTRACT_SCORES=$DiscobaMultimerPath/utils/extract_pLDDT_pTM_ipTM.py
+
 AF2_models_folder=$1
 output_file=$2
 
-echo "ID1 ID2 rank pLDDT pTM ipTM" > $output_file
+if [ -z "$AF2_models_folder" ] || [ -z "$output_file" ]; then
+	echo "Usage: $0 <AF2_folder_path> <output_file_name>"
+	echo "Same as: python \$DiscobaMultimerPath/utils/extract_pLDDT_pTM_ipTM.py <AF2_folder_path> <output_file_name>"
+	exit 1
+fi
 
-grep "rank_00" $AF2_models_folder/*/log.txt | \
-	grep -oE '[^/]+__vs__[^/ ]+|rank_00[0-9.]+|pLDDT=[0-9.]+|pTM=[0-9.]+|ipTM=[0-9.]+' | \
-	awk 'ORS=NR%5?FS:RS' | \
-	awk '{gsub("__vs__"," "); gsub("rank_00",""); gsub("pLDDT=",""); gsub(" pTM="," "); gsub("ipTM=",""); print}' >> $output_file
+python $EXTRACT_SCORES $AF2_models_folder $output_file
@@ -1,54 +1,260 @@
 #!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Generates the IDs table of all the pairwise combinations (2-mers) of a list
+of IDs.
+
+The pairs are written as they are generated (the combinations are never
+held in memory, so a whole proteome can be combined). Optionally:
+
+    --database / --sizes   only the pairs whose combined length is in the
+                           range of the batch -s option (IDs that cannot be
+                           in any pair of the range are removed up front)
+    --exclude              skip the pairs of IDs tables or lists of paired
+                           names (e.g. the folders in ./AF2) already computed
+    --sample / --max-pairs deterministic random sample of the pairs: a pair
+                           is sampled from a hash of its IDs and --seed, so it
+                           does not depend on the other IDs of the list
+    --shards N             N output tables balanced by the estimated cost of
+                           their pairs (combined length squared, or number of
+                           pairs without --database)
+"""
 
-import itertools
 import sys
 import os
+import argparse
+import hashlib
+import heapq
+import itertools
+
+
+###############################################################################
+################################## Inputs #####################################
+###############################################################################
+
+def read_IDs(input_file):
+    """
+    IDs of the input file (one per line) without blank lines and duplicates.
+    """
+    IDs, seen = [], set()
+    with open(input_file) as IDs_file:
+        for line in IDs_file:
+            ID = line.strip()
+            if not ID or ID in seen:
+                continue
+            seen.add(ID)
+            IDs.append(ID)
+    return IDs
+
+
+def read_lengths(database, IDs):
+    """
+    Returns {ID: length} of the given IDs in a fasta database.
+    """
+    lengths = {}
+    wanted = set(IDs)
+    current = None
+    with open(database) as fasta:
+        for line in fasta:
+            if line.startswith(">"):
+                current = line[1:].strip()
+                if current in wanted:
+                    lengths[current] = 0
+                else:
+                    current = None
+            elif current is not None:
+                lengths[current] += len(line.strip())
+    return lengths
+
+
+def pair_key(ID_1, ID_2):
+    return (ID_1, ID_2) if ID_1 <= ID_2 else (ID_2, ID_1)
+
+
+def read_exclusions(exclude_files):
+    """
+    Pairs to skip (in any order): lines with two IDs separated by tabs or
+    paired names (ID1__vs__ID2). Lines with other numbers of IDs are ignored.
+    """
+    excluded = set()
+    for exclude_file in exclude_files:
+        with open(exclude_file) as exclusions:
+            for line in exclusions:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                IDs = os.path.basename(line.rstrip("/")).split("__vs__") if "__vs__" in line else line.split()
+                if len(IDs) == 2:
+                    excluded.add(pair_key(*IDs))
+    return excluded
+
+
+###############################################################################
+################################# Generation ##################################
+###############################################################################
+
+def sampling_value(ID_1, ID_2, seed):
+    """
+    Uniform value in [0, 1) of a pair (the same for the same pair and seed).
+    """
+    digest = hashlib.blake2b(f"{seed}\t{ID_1}\t{ID_2}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") / 2 ** 64
 
-def generate_combinations(input_file, output_file, exclude_self):
+
+def iter_pairs(IDs, exclude_self=False, lengths=None, min_size=None, max_size=None, excluded=()):
+    """
+    Yields (ID_1, ID_2, combined_L) in the order of combinations_with_replacement.
+    combined_L is None without lengths.
+    """
+    if lengths and (min_size is not None or max_size is not None):
+        # Remove the IDs that cannot be in any pair of the range
+        shortest, longest = min(lengths.values()), max(lengths.values())
+        IDs = [ID for ID in IDs
+               if (max_size is None or lengths[ID] + shortest <= max_size)
+               and (min_size is None or lengths[ID] + longest >= min_size)]
+
+    for ID_1, ID_2 in itertools.combinations_with_replacement(IDs, 2):
+        if exclude_self and ID_1 == ID_2:
+            continue
+        combined_L = None
+        if lengths is not None:
+            combined_L = lengths[ID_1] + lengths[ID_2]
+            if (min_size is not None and combined_L < min_size) or \
+               (max_size is not None and combined_L > max_size):
+                continue
+        if excluded and pair_key(ID_1, ID_2) in excluded:
+            continue
+        yield ID_1, ID_2, combined_L
+
+
+def sample_pairs(pairs, fraction=None, max_pairs=None, seed=0):
+    """
+    Deterministic sample of the pairs (in their order). With max_pairs, the
+    max_pairs pairs with the lowest sampling values are kept (only them are
+    held in memory).
+    """
+    if max_pairs is None:
+        for pair in pairs:
+            if fraction is None or sampling_value(pair[0], pair[1], seed) < fraction:
+                yield pair
+        return
+
+    kept = []   # heap of (-value, order, pair): the highest value is replaced first
+    for order, pair in enumerate(pairs):
+        value = sampling_value(pair[0], pair[1], seed)
+        if fraction is not None and value >= fraction:
+            continue
+        if len(kept) < max_pairs:
+            heapq.heappush(kept, (-value, order, pair))
+        elif -kept[0][0] > value:
+            heapq.heapreplace(kept, (-value, order, pair))
+    for _, _, pair in sorted(kept, key=lambda item: item[1]):
+        yield pair
+
+
+def shard_files(output_file, shards):
+    if shards == 1:
+        return [output_file]
+    root, extension = os.path.splitext(output_file)
+    return [f"{root}_shard{index + 1}{extension}" for index in range(shards)]
+
+
+def write_shards(pairs, output_files):
+    """
+    Writes each pair to the shard with the lowest total cost so far. Returns
+    the number of pairs and the cost of each shard. The outputs are renamed
+    when they are complete.
+    """
+    temporary_files = [f"{output_file}.tmp" for output_file in output_files]
+    outputs = [open(temporary_file, "w") for temporary_file in temporary_files]
+    loads = [(0, index) for index in range(len(outputs))]   # heap of (cost, shard)
+    counts = [0] * len(outputs)
+    costs = [0] * len(outputs)
     try:
-        # Read input file
-        with open(input_file, 'r') as file:
-            ids = [line.strip() for line in file.readlines()]
-
-        # Generate combinations
-        combinations = list(itertools.combinations_with_replacement(ids, 2))
-        
-        # If -e flag was passed
-        if exclude_self:
-            combinations = [comb for comb in combinations if comb[0] != comb[1]]
-
-        # Write output file
-        with open(output_file, 'w') as file:
-            for combo in combinations:
-                file.write('\t'.join(combo) + '\n')
-
-        print(f"Combinations generated successfully and saved to {output_file}")
-
-    except Exception as e:
-        print(f"Error: {e}")
-        sys.exit(1)
-
-def usage():
-    print("Usage: ./generate_2mers_combinations.py <single_IDs.txt> <output_IDs_table.txt> [-e]")
-    print("")
-    print("Parameters:")
-    print("   single_IDs.txt        : File with one ID/protein name per line.")
-    print("   output_IDs_table.txt  : Name of the output TSV file.")
-    print("   -e (optional)         : Excludes homodimers combinations.")
-    sys.exit(1)
+        for ID_1, ID_2, combined_L in pairs:
+            pair_cost = combined_L ** 2 if combined_L is not None else 1
+            if len(outputs) == 1:
+                index = 0
+            else:
+                cost, index = loads[0]
+                heapq.heapreplace(loads, (cost + pair_cost, index))
+            outputs[index].write(f"{ID_1}\t{ID_2}\n")
+            counts[index] += 1
+            costs[index] += pair_cost
+    finally:
+        for output in outputs:
+            output.close()
+    for temporary_file, output_file in zip(temporary_files, output_files):
+        os.replace(temporary_file, output_file)
+    return counts, costs
+
+
+###############################################################################
+##################################### CLI #####################################
+###############################################################################
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        usage="%(prog)s <single_IDs.txt> <output_IDs_table.txt> [-e] [options]",
+        description="Generates the IDs table of all the pairwise combinations (2-mers) of a list of IDs.")
+    parser.add_argument("input_file", metavar="single_IDs.txt", help="file with one ID/protein name per line")
+    parser.add_argument("output_file", metavar="output_IDs_table.txt", help="name of the output TSV file")
+    parser.add_argument("-e", dest="exclude_self", action="store_true", help="excludes homodimers combinations")
+    parser.add_argument("--database", help="proteome (fasta) with the lengths of the IDs")
+    parser.add_argument("--sizes", metavar="MIN_MAX",
+                        help="only pairs with a combined length in this range (as -s of the batch, needs --database)")
+    parser.add_argument("--exclude", action="append", default=[], metavar="FILE",
+                        help="IDs table or list of paired names of pairs to skip (can be repeated)")
+    parser.add_argument("--sample", type=float, metavar="FRACTION", help="keep this fraction of the pairs")
+    parser.add_argument("--max-pairs", type=int, metavar="N", help="keep at most N pairs (random sample)")
+    parser.add_argument("--seed", default="0", help="seed of the sampling (default 0)")
+    parser.add_argument("--shards", type=int, default=1, metavar="N",
+                        help="write N tables balanced by the estimated cost of their pairs")
+    args = parser.parse_args()
+
+    args.min_size = args.max_size = None
+    if args.sizes:
+        min_size, _, max_size = args.sizes.partition("_")
+        if not (min_size.isdigit() and max_size.isdigit()) or int(min_size) > int(max_size):
+            parser.error(f"--sizes must be MIN_MAX with MIN <= MAX (e.g. 100_1500), not {args.sizes}")
+        if not args.database:
+            parser.error("--sizes needs --database to know the lengths of the IDs")
+        args.min_size, args.max_size = int(min_size), int(max_size)
+    if args.sample is not None and not 0 < args.sample <= 1:
+        parser.error("--sample must be a fraction between 0 and 1")
+    if args.max_pairs is not None and args.max_pairs < 1:
+        parser.error("--max-pairs must be at least 1")
+    if args.shards < 1:
+        parser.error("--shards must be at least 1")
+    return args
+
 
 if __name__ == "__main__":
-    # Check if correct number of arguments is provided
-    if len(sys.argv) < 3 or len(sys.argv) > 4:
-        usage()
+    args = parse_arguments()
+
+    # Check if input files exist
+    for input_file in [args.input_file, args.database] + args.exclude:
+        if input_file and not os.path.exists(input_file):
+            print(f"ERROR: Input file '{input_file}' not found.", file=sys.stderr)
+            sys.exit(1)
 
-    input_file = sys.argv[1]
-    output_file = sys.argv[2]
-    exclude_self = "-e" in sys.argv
+    IDs = read_IDs(args.input_file)
+    lengths = None
+    if args.database:
+        lengths = read_lengths(args.database, IDs)
+        missing = [ID for ID in IDs if ID not in lengths]
+        if missing:
+            print(f"ERROR: {len(missing)} IDs not found in {args.database}: {' '.join(missing[:10])}"
+                  + (" ..." if len(missing) > 10 else ""), file=sys.stderr)
+            sys.exit(1)
+    excluded = read_exclusions(args.exclude)
 
-    # Check if input file exists
-    if not os.path.exists(input_file):
-        print(f"Error: Input file '{input_file}' not found.")
-        sys.exit(1)
+    pairs = iter_pairs(IDs, args.exclude_self, lengths, args.min_size, args.max_size, excluded)
+    if args.sample is not None or args.max_pairs is not None:
+        pairs = sample_pairs(pairs, args.sample, args.max_pairs, args.seed)
+    output_files = shard_files(args.output_file, args.shards)
+    counts, costs = write_shards(pairs, output_files)
 
-    generate_combinations(input_file, output_file, exclude_self)
+    print(f"Combinations generated successfully: {sum(counts)} pairs of {len(IDs)} IDs")
+    for output_file, count, cost in zip(output_files, counts, costs):
+        print(f"  {output_file}\t{count} pairs" + (f"\tcost {cost:.3g} (sum of L^2)" if lengths else ""))
@@ -1,13 +1,19 @@
 #!/bin/bash
 
+# The running jobs are now recorded in the job-state database of the project
+# (see scripts/job_db.py). Run it from the project folder.
+JOB_DB=$DiscobaMultimerPath/scripts/job_db.py
+
 usage(){
 	echo ""
 	echo "Usage: $0 all [pid] | PID1 PID2 ... PIDn"
 	echo ""
 	echo "	all	: lists all the AF2 folders for all the current GPU running PIDs"
-	echo "	pid	: adds the PIDs for each AF2 folder"
+	echo "	pid	: kept for compatibility (the PIDs are always shown)"
 	echo "	PIDn	: a list of PIDs to get AF2 folder locations"
 	echo ""
+	echo "Same as: python \$DiscobaMultimerPath/scripts/job_db.py status --pids all | PID1 PID2 ... PIDn"
+	echo ""
 	exit 1
 }
 
@@ -15,15 +21,7 @@ usage(){
 
 # Pass all as first argument to get all PIDs
 if [ "$1" == all  ]; then
-	pids_list=($(nvidia-smi --query-compute-apps=pid --format=csv,noheader))
+	python $JOB_DB status --pids all
 else
-	pids_list="$@"
+	python $JOB_DB status --pids "$@"
 fi
-
-
-# Pass PIDs as positional arguments
-for arg in ${pids_list[@]}; do
-	[ "$2" == "pid" ] && echo "PID $arg:"
-	ps aux | grep $arg | grep -o '\./AF2/[^ ]*'
-	[ $? -ne 0 ] && echo "No process found"
-done